@@ -151,7 +151,7 @@ def add_argument(parser):
         "--record_mode",
         type=str,
         default="ram",
-        help="use RAM or FILE to store video frames",
+        help="keep video frames in RAM or stream them to a FILE with a background encoder",
         choices=["ram", "file"],
     )
     parser.add_argument(
@@ -283,6 +283,24 @@ def add_argument(parser):
     parser.add_argument(
         "--render", type=str2bool, default=False, help="whether to render camera"
     )
+    parser.add_argument(
+        "--lazy_visual_ob",
+        type=str2bool,
+        default=False,
+        help="render visual obs only when they are read",
+    )
+    parser.add_argument(
+        "--render_interval",
+        type=int,
+        default=1,
+        help="render visual obs every k steps and reuse the last frame in between",
+    )
+    parser.add_argument(
+        "--render_workers",
+        type=int,
+        default=0,
+        help="number of processes rendering visual obs asynchronously (MuJoCo rendering only)",
+    )
 
     # cursor agent
     parser.add_argument("--cursor_boundary", type=float, default=1.5)
@@ -4,6 +4,7 @@ import logging
 import os
 import pickle
 import time
+import weakref
 from collections import OrderedDict
 from sys import platform
 
@@ -19,6 +20,14 @@ from . import transform_utils as T
 from .base import EnvMeta
 from .image_utils import color_segmentation
 from .mjcf_utils import xml_path_completion
+from .offscreen_renderer import OffscreenRenderer
+from .render_pool import (
+    RenderPool,
+    get_render_state,
+    set_render_state,
+    is_render_state,
+)
+from .lazy_ob import LazyOb
 from .models import (
     background_names,
     furniture_name2id,
@@ -108,7 +117,6 @@ class FurnitureEnv(metaclass=EnvMeta):
         self._segmentation_ob = config.segmentation_ob
         self._depth_ob = config.depth_ob
         self._camera_ids = config.camera_ids
-        self._camera_name = "frontview"
         self._is_render = False
         self._furniture_id = None
         self._background = None
@@ -172,6 +180,23 @@ class FurnitureEnv(metaclass=EnvMeta):
             self._action_repeat = 3
 
         self._viewer = None
+        self._renderer = None
+        self._snapshot_sim = None
+        self._snapshot_renderer = None
+        self._render_pool = None
+        if config.render_workers > 0 and not config.unity and self._visual_ob:
+            self._render_pool = RenderPool(
+                config.render_workers,
+                self._camera_ids,
+                self._screen_width,
+                self._screen_height,
+                depth=self._depth_ob,
+            )
+        self._lazy_visual_ob = config.lazy_visual_ob
+        self._render_interval = max(1, config.render_interval)
+        self._render_step = 0
+        self._visual_ob_cache = None
+        self._pending_visual_obs = weakref.WeakValueDictionary()
         self._unity = None
         self._unity_updated = False
         if config.unity:
@@ -323,6 +348,12 @@ class FurnitureEnv(metaclass=EnvMeta):
         """
         if self._record_demo:
             self._demo.reset()
+        # lazy visual obs of the last episode cannot be rendered after the reset
+        for visual_ob in list(self._pending_visual_obs.values()):
+            visual_ob.resolve()
+        self._pending_visual_obs.clear()
+        self._render_step = 0
+        self._visual_ob_cache = None
         self._reset(furniture_id=furniture_id, background=background)
         self._after_reset()
 
@@ -390,16 +421,20 @@ class FurnitureEnv(metaclass=EnvMeta):
         """
         self._unity_updated = False
         self._connected = False
+        self._render_step += 1
 
-    def _update_unity(self):
+    def _update_unity(self, sim=None):
         """
-        Updates unity rendering with qpos. Call this after you change qpos
+        Updates unity rendering with qpos of @sim (self.sim by default).
+        Call this after you change qpos
         """
-        self._unity.set_qpos(self.sim.data.qpos)
+        if sim is None:
+            sim = self.sim
+        self._unity.set_qpos(sim.data.qpos)
         if self._agent_type == "Cursor":
             for cursor_i in range(2):
                 cursor_name = "cursor%d" % cursor_i
-                cursor_pos = self._get_pos(cursor_name)
+                cursor_pos = sim.data.get_body_xpos(cursor_name).copy()
                 self._unity.set_geom_pos(cursor_name, cursor_pos)
 
     def _step(self, a):
@@ -600,35 +635,20 @@ class FurnitureEnv(metaclass=EnvMeta):
         if mode == "rgb_array":
             if self._unity:
                 img, _ = self._unity.get_images(self._camera_ids)
+                # img = img[:, ::-1, :, :] / 255.0
+                img = img[:, ::-1, :, :]
             else:
-                img = self.sim.render(
-                    camera_name=self._camera_name,
-                    width=self._screen_width,
-                    height=self._screen_height,
-                    depth=False,
-                )
-                img = np.expand_dims(img, axis=0)
+                # the renderer already flips images
+                img, _ = self._get_renderer().render(depth=False, copy=True)
             assert len(img.shape) == 4
-            # img = img[:, ::-1, :, :] / 255.0
-            img = img[:, ::-1, :, :]
             return img
 
         elif mode == "rgbd_array":
-            depth = None
-            if self._unity:
-                img, depth = self._unity.get_images(self._camera_ids, self._depth_ob)
-            else:
-                camera_obs = self.sim.render(
-                    camera_name=self._camera_name,
-                    width=self._screen_width,
-                    height=self._screen_height,
-                    depth=self._depth_ob,
-                )
-                if self._depth_ob:
-                    img, depth = camera_obs
-                else:
-                    img = camera_obs
-                img = np.expand_dims(img, axis=0)
+            if not self._unity:
+                # RGB and depth of all cameras in one pass, already flipped
+                return self._get_renderer().render(depth=self._depth_ob, copy=True)
+
+            img, depth = self._unity.get_images(self._camera_ids, self._depth_ob)
             # img = img[:, ::-1, :, :] / 255.0
             img = img[:, ::-1, :, :]
 
@@ -672,6 +692,20 @@ class FurnitureEnv(metaclass=EnvMeta):
         """
         pass
 
+    def _get_renderer(self):
+        """
+        Returns the offscreen renderer for @self._camera_ids, or instantiates a new one
+        """
+        if self._renderer is None:
+            self._renderer = OffscreenRenderer(
+                self.sim,
+                self._camera_ids,
+                self._screen_width,
+                self._screen_height,
+                depth=self._depth_ob,
+            )
+        return self._renderer
+
     def _get_viewer(self):
         """
         Returns the viewer instance, or instantiates a new one
@@ -689,6 +723,8 @@ class FurnitureEnv(metaclass=EnvMeta):
         """
         if self._unity:
             self._unity.disconnect_to_unity()
+        if self._render_pool:
+            self._render_pool.close()
         self._destroy_viewer()
 
     def __delete__(self):
@@ -1341,6 +1377,97 @@ class FurnitureEnv(metaclass=EnvMeta):
             "rotation": T.quat2mat(T.quat_multiply(old_quat, action[3:7])),
         }
 
+    def _get_visual_ob(self):
+        """
+        Returns a dictionary with camera_ob (and depth_ob) of the current state.
+        Frames are rendered every @self._render_interval steps and reused in
+        between. With the render pool or --lazy_visual_ob, a LazyOb is returned
+        and frames are only rendered when they are read.
+        """
+        source = self._visual_ob_cache
+        if source is None or self._render_step % self._render_interval == 0:
+            if self._render_pool:
+                # frames are rendered by the pool while the next step is simulated
+                source = LazyOb()
+                future = self._render_pool.submit(self.sim)
+                source.set_lazy("camera_ob", lambda: future.result()[0])
+                if self._depth_ob:
+                    source.set_lazy("depth_ob", lambda: future.result()[1])
+            elif self._lazy_visual_ob:
+                source = LazyOb()
+                snapshot = get_render_state(self.sim)
+                frames = []
+
+                def render_snapshot():
+                    if not frames:
+                        frames.extend(self._render_snapshot(snapshot))
+                    return frames
+
+                source.set_lazy("camera_ob", lambda: render_snapshot()[0])
+                if self._depth_ob:
+                    source.set_lazy("depth_ob", lambda: render_snapshot()[1])
+                self._pending_visual_obs[id(source)] = source
+            else:
+                camera_obs, depth_obs = self.render("rgbd_array")
+                source = OrderedDict([("camera_ob", camera_obs)])
+                if depth_obs is not None:
+                    source["depth_ob"] = depth_obs
+            self._visual_ob_cache = source
+
+        if not isinstance(source, LazyOb):
+            return OrderedDict(source)
+
+        # share the frames (or their pending render) of @source
+        visual_ob = LazyOb()
+        for k in source.keys():
+            visual_ob.set_lazy(k, lambda k=k: source[k])
+        return visual_ob
+
+    def _render_snapshot(self, snapshot):
+        """
+        Renders (camera_ob, depth_ob) of @snapshot from get_render_state. If the
+        simulation has moved on, @snapshot is rendered from a separate MjSim, so
+        that self.sim (including the warm start of the solver) is not touched.
+        """
+        if is_render_state(self.sim, snapshot):
+            return self.render("rgbd_array")
+
+        sim = self._get_snapshot_sim()
+        set_render_state(sim, snapshot)
+        sim.forward()
+        if not self._unity:
+            return self._snapshot_renderer.render(depth=self._depth_ob, copy=True)
+
+        self._update_unity(sim)
+        self._unity_updated = True
+        try:
+            return self.render("rgbd_array")
+        finally:
+            # unity shows @snapshot now, so sync self.sim before the next render
+            self._unity_updated = False
+
+    def _get_snapshot_sim(self):
+        """
+        Returns a separate MjSim of the current model for rendering state
+        snapshots, or instantiates a new one (with its offscreen renderer)
+        """
+        if self._snapshot_sim is None:
+            self._snapshot_sim = mujoco_py.MjSim(
+                mujoco_py.load_model_from_xml(self.mujoco_model.get_xml())
+            )
+            if not self._unity:
+                self._snapshot_renderer = OffscreenRenderer(
+                    self._snapshot_sim,
+                    self._camera_ids,
+                    self._screen_width,
+                    self._screen_height,
+                    depth=self._depth_ob,
+                )
+        # cameras may have been moved since
+        self._snapshot_sim.model.cam_pos[:] = self.sim.model.cam_pos
+        self._snapshot_sim.model.cam_quat[:] = self.sim.model.cam_quat
+        return self._snapshot_sim
+
     def _get_obs(self, include_qpos=False):
         """
         Returns observation dictionary
@@ -1349,10 +1476,7 @@ class FurnitureEnv(metaclass=EnvMeta):
 
         # visual obs
         if self._visual_ob:
-            camera_obs, depth_obs = self.render("rgbd_array")
-            state["camera_ob"] = camera_obs
-            if depth_obs is not None:
-                state["depth_ob"] = depth_obs
+            state = self._get_visual_ob()
 
         if self._segmentation_ob:
             segmentation_obs = self.render("segmentation")
@@ -1836,6 +1960,10 @@ class FurnitureEnv(metaclass=EnvMeta):
         # construct mujoco model from xml
         self.mjpy_model = self.mujoco_model.get_model(mode="mujoco_py")
         self.sim = mujoco_py.MjSim(self.mjpy_model)
+        # the offscreen context is bound to the previous MjSim
+        self._renderer = None
+        self._snapshot_sim = None
+        self._snapshot_renderer = None
         self.initialize_time()
 
         self._is_render = self._visual_ob or self._render_mode != "no"
@@ -1858,6 +1986,13 @@ class FurnitureEnv(metaclass=EnvMeta):
         # necessary to refresh MjData
         self.sim.forward()
 
+        if self._render_pool:
+            self._render_pool.set_model(
+                self.mujoco_model.get_xml(),
+                self.sim.model.cam_pos,
+                self.sim.model.cam_quat,
+            )
+
         # setup mocap for ik control
         if (
             self._control_type in ["ik", "ik_quaternion"]
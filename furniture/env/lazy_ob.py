@@ -0,0 +1,79 @@
+""" Observation dictionary with values computed on first access. """
+
+from collections import OrderedDict
+
+
+class LazyOb(OrderedDict):
+    """
+    OrderedDict whose values can be deferred with @set_lazy.
+
+    A deferred value is computed by calling its function the first time the key
+    is read (indexing, get, pop, items, values, copy, pickling). Keys are always
+    visible, so the observation keeps the layout of the observation space.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._lazy = {}
+        super().__init__(*args, **kwargs)
+
+    def set_lazy(self, key, fn):
+        """ Defers the value of @key to the result of calling @fn(). """
+        OrderedDict.__setitem__(self, key, None)
+        self._lazy[key] = fn
+
+    def is_resolved(self, key):
+        return key not in self._lazy
+
+    def _resolve(self, key):
+        fn = self._lazy.pop(key, None)
+        if fn is not None:
+            OrderedDict.__setitem__(self, key, fn())
+
+    def resolve(self):
+        """ Computes all deferred values and returns self. """
+        for key in list(self._lazy.keys()):
+            self._resolve(key)
+        return self
+
+    def __getitem__(self, key):
+        self._resolve(key)
+        return OrderedDict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self._lazy.pop(key, None)
+        OrderedDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._lazy.pop(key, None)
+        OrderedDict.__delitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *args):
+        self._resolve(key)
+        return OrderedDict.pop(self, key, *args)
+
+    def items(self):
+        self.resolve()
+        return OrderedDict.items(self)
+
+    def values(self):
+        self.resolve()
+        return OrderedDict.values(self)
+
+    def copy(self):
+        return OrderedDict(self.resolve())
+
+    def __eq__(self, other):
+        self.resolve()
+        return OrderedDict.__eq__(self, other)
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def __reduce__(self):
+        # unpickles as a plain OrderedDict
+        return (OrderedDict, (list(self.items()),))
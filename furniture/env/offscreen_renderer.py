@@ -0,0 +1,75 @@
+""" Multi-camera offscreen renderer for the MuJoCo (non-Unity) rendering path. """
+
+import numpy as np
+import mujoco_py
+
+
+class OffscreenRenderer(object):
+    """
+    Renders a fixed list of MuJoCo cameras with one persistent offscreen context.
+
+    Frames of all cameras are written into preallocated buffers of shape
+    (N_cam, H, W, 3) for RGB and (N_cam, H, W) for depth. RGB and depth of a
+    camera are read back in a single pass. On CPU-only machines, build mujoco-py
+    with OSMesa (e.g. MUJOCO_PY_FORCE_CPU=1) and the context runs headless.
+    """
+
+    def __init__(self, sim, camera_ids, width, height, depth=False, device_id=-1):
+        """
+        Args:
+            sim: MjSim to render.
+            camera_ids: list of MuJoCo camera ids to render.
+            width: width of rendered images.
+            height: height of rendered images.
+            depth: whether to allocate a depth buffer.
+            device_id: GPU id for the offscreen context (-1 for the default one).
+        """
+        self._camera_ids = list(camera_ids)
+        self._width = width
+        self._height = height
+
+        self._context = mujoco_py.MjRenderContextOffscreen(sim, device_id=device_id)
+
+        num_cam = len(self._camera_ids)
+        self._rgb = np.empty((num_cam, height, width, 3), dtype=np.uint8)
+        self._depth = None
+        if depth:
+            self._depth = np.empty((num_cam, height, width), dtype=np.float32)
+
+    @property
+    def camera_ids(self):
+        return self._camera_ids
+
+    def render(self, depth=False, copy=False):
+        """
+        Renders all cameras and returns (rgb, depth). @depth is None if it is not
+        requested or no depth buffer is allocated. Images are flipped to the
+        top-down row order.
+
+        By default, the returned arrays are views of the internal buffers and
+        are overwritten by the next call, so copy frames that outlive it.
+
+        Args:
+            depth: whether to read the depth map as well.
+            copy: if True, frames are written into new arrays owned by the caller.
+        """
+        depth = depth and self._depth is not None
+        rgb_out = np.empty_like(self._rgb) if copy else self._rgb
+        depth_out = None
+        if depth:
+            depth_out = np.empty_like(self._depth) if copy else self._depth
+
+        for i, cam_id in enumerate(self._camera_ids):
+            self._context.render(self._width, self._height, cam_id)
+            # read_pixels of mujoco-py always returns new arrays, which are
+            # flipped straight into the output
+            if depth:
+                rgb, d = self._context.read_pixels(
+                    self._width, self._height, depth=True
+                )
+                depth_out[i] = d[::-1]
+            else:
+                rgb = self._context.read_pixels(self._width, self._height, depth=False)
+            rgb_out[i] = rgb[::-1]
+
+        return rgb_out, depth_out
@@ -0,0 +1,160 @@
+"""
+Re-renders recorded demonstrations from their stored states.
+
+Physics is not stepped: every stored state is set with forward() only and the
+cameras in --camera_ids are rendered with MuJoCo. Demos are distributed over a
+process pool and each demo is written to a chunked HDF5 file, so new vision
+datasets (other cameras, resolutions or depth) can be generated from existing
+demos without re-collecting them.
+
+python -m furniture.env.render_demos --env FurnitureSawyerEnv \
+    --furniture_name table_lack_0825 --demo_path demos/Sawyer_table_lack_0825 \
+    --out_dir demos/Sawyer_table_lack_0825_128 --camera_ids 0,1 \
+    --screen_width 128 --screen_height 128 --num_workers 8
+"""
+
+import glob
+import multiprocessing
+import os
+import pickle
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from ..util.logger import logger
+
+
+_env = None
+
+
+def _init_worker(config):
+    """ Creates one environment per worker process. """
+    global _env
+    from .base import make_env
+
+    _env = make_env(config.env, config)
+    _env.reset(config.furniture_id, config.background)
+
+
+def _render_demo(args):
+    """
+    Renders all states of the demo at @demo_path to @out_path and returns the
+    number of rendered frames.
+    """
+    demo_path, out_path = args
+    env = _env
+
+    with open(demo_path, "rb") as f:
+        demo = pickle.load(f)
+    # older recordings store states under "state"
+    states = demo["states"] if "states" in demo else demo["state"]
+    if len(states) == 0:
+        logger.warn("Skip %s without stored states", demo_path)
+        return 0
+
+    num_cam = len(env._camera_ids)
+    shape = (env._screen_height, env._screen_width)
+    with h5py.File(out_path, "w") as hf:
+        hf.attrs["demo_path"] = os.path.abspath(demo_path)
+        hf.attrs["camera_ids"] = np.array(env._camera_ids)
+        camera_ob = hf.create_dataset(
+            "camera_ob",
+            shape=(len(states), num_cam) + shape + (3,),
+            dtype=np.uint8,
+            chunks=(1, num_cam) + shape + (3,),
+            compression="lzf",
+        )
+        depth_ob = None
+        if env._depth_ob:
+            depth_ob = hf.create_dataset(
+                "depth_ob",
+                shape=(len(states), num_cam) + shape,
+                dtype=np.float32,
+                chunks=(1, num_cam) + shape,
+                compression="lzf",
+            )
+        hf.create_dataset("qpos", data=np.stack([s["qpos"] for s in states]))
+
+        for i, state in enumerate(states):
+            env.set_env_state(state)
+            env.sim.forward()
+            img, depth = env.render("rgbd_array")
+            camera_ob[i] = img
+            if depth_ob is not None:
+                depth_ob[i] = depth
+
+    return len(states)
+
+
+def render_demos(config):
+    """
+    Renders every demo matched by @config.demo_path into @config.out_dir.
+    """
+    if os.path.isdir(config.demo_path):
+        demo_paths = sorted(glob.glob(os.path.join(config.demo_path, "*.pkl")))
+    else:
+        demo_paths = sorted(glob.glob(config.demo_path))
+    assert len(demo_paths) > 0, "No demo is found in %s" % config.demo_path
+    os.makedirs(config.out_dir, exist_ok=True)
+
+    jobs = []
+    for demo_path in demo_paths:
+        name = os.path.splitext(os.path.basename(demo_path))[0]
+        jobs.append((demo_path, os.path.join(config.out_dir, name + ".hdf5")))
+
+    # states are rendered with MuJoCo in the workers
+    config.unity = False
+    config.visual_ob = True
+    config.render = False
+    config.render_workers = 0
+    config.record_demo = False
+    config.record_vid = False
+
+    # fork is unsafe with OpenGL contexts
+    ctx = multiprocessing.get_context("spawn")
+    num_frames = 0
+    with ctx.Pool(config.num_workers, _init_worker, (config,)) as pool:
+        for n in tqdm(
+            pool.imap_unordered(_render_demo, jobs), total=len(jobs), desc="demos"
+        ):
+            num_frames += n
+    logger.info(
+        "Rendered %d frames of %d demos to %s", num_frames, len(jobs), config.out_dir
+    )
+
+
+def main():
+    from ..config import create_parser
+
+    parser = create_parser(env="FurnitureSawyerEnv")
+    parser.add_argument(
+        "--demo_path",
+        type=str,
+        required=True,
+        help="demo pickle file, glob pattern or directory of demos",
+    )
+    parser.add_argument(
+        "--out_dir", type=str, required=True, help="directory for rendered demos"
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="number of render processes",
+    )
+    config, unparsed = parser.parse_known_args()
+    if len(unparsed):
+        logger.error("Unparsed argument is detected:\n%s", unparsed)
+        return
+
+    if config.furniture_name is not None:
+        from .models import furniture_name2id
+
+        config.furniture_id = furniture_name2id[config.furniture_name]
+
+    render_demos(config)
+
+
+if __name__ == "__main__":
+    main()
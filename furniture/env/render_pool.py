@@ -0,0 +1,204 @@
+"""
+Pool of render processes that rasterize MuJoCo states in parallel with physics.
+"""
+
+import multiprocessing
+import weakref
+
+import numpy as np
+
+from ..util.logger import logger
+
+
+def get_render_state(sim):
+    """ Returns a snapshot of everything that affects rendering of @sim. """
+    snapshot = {
+        "qpos": sim.data.qpos.copy(),
+        "body_pos": sim.model.body_pos.copy(),
+    }
+    if sim.model.nmocap > 0:
+        snapshot["mocap_pos"] = sim.data.mocap_pos.copy()
+        snapshot["mocap_quat"] = sim.data.mocap_quat.copy()
+    return snapshot
+
+
+def set_render_state(sim, snapshot):
+    """ Applies @snapshot from get_render_state to @sim. Call forward() after this. """
+    sim.data.qpos[:] = snapshot["qpos"]
+    sim.model.body_pos[:] = snapshot["body_pos"]
+    if sim.model.nmocap > 0:
+        sim.data.mocap_pos[:] = snapshot["mocap_pos"]
+        sim.data.mocap_quat[:] = snapshot["mocap_quat"]
+
+
+def is_render_state(sim, snapshot):
+    """ Returns True if @sim is currently in the state of @snapshot. """
+    current = get_render_state(sim)
+    return all(np.array_equal(v, current[k]) for k, v in snapshot.items())
+
+
+def _render_worker(conn, camera_ids, width, height, depth):
+    """
+    Holds a copy of the MuJoCo model and renders state snapshots sent through @conn.
+    """
+    import mujoco_py
+    from .offscreen_renderer import OffscreenRenderer
+
+    sim = None
+    renderer = None
+    try:
+        while True:
+            cmd, data = conn.recv()
+            if cmd == "model":
+                xml, cam_pos, cam_quat = data
+                sim = mujoco_py.MjSim(mujoco_py.load_model_from_xml(xml))
+                sim.model.cam_pos[:] = cam_pos
+                sim.model.cam_quat[:] = cam_quat
+                renderer = OffscreenRenderer(sim, camera_ids, width, height, depth)
+            elif cmd == "render":
+                job_id, snapshot = data
+                set_render_state(sim, snapshot)
+                sim.forward()
+                img, depth_img = renderer.render(depth=depth, copy=False)
+                conn.send((job_id, img, depth_img))
+            elif cmd == "close":
+                break
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        conn.close()
+
+
+class RenderFuture(object):
+    """
+    Handle to a frame requested from RenderPool. @result blocks until it is rendered.
+    """
+
+    def __init__(self, pool, worker_idx, job_id):
+        self._pool = pool
+        self._worker_idx = worker_idx
+        self._job_id = job_id
+        self._result = None
+
+    def done(self):
+        return self._result is not None
+
+    def result(self):
+        """ Returns (rgb, depth) of shape (N_cam, H, W, 3) and (N_cam, H, W). """
+        if self._result is None:
+            self._pool._wait(self._worker_idx, self._job_id)
+        return self._result
+
+
+class RenderPool(object):
+    """
+    Renders compact state snapshots (qpos, mocap and body poses) of a MuJoCo
+    simulation on @num_workers processes. Each worker owns a copy of the model
+    and an offscreen context, so rasterization of consecutive steps overlaps
+    with physics and with each other.
+    """
+
+    def __init__(
+        self, num_workers, camera_ids, width, height, depth=False, max_pending=2
+    ):
+        """
+        Args:
+            num_workers: number of render processes.
+            camera_ids: list of MuJoCo camera ids to render.
+            width: width of rendered images.
+            height: height of rendered images.
+            depth: whether to render depth maps as well.
+            max_pending: number of unread frames per worker, after which
+                submit() blocks until the oldest one is received.
+        """
+        # fork is unsafe with OpenGL contexts created in the parent process
+        ctx = multiprocessing.get_context("spawn")
+
+        self._conns = []
+        self._procs = []
+        for _ in range(num_workers):
+            conn, worker_conn = ctx.Pipe()
+            proc = ctx.Process(
+                target=_render_worker,
+                args=(worker_conn, camera_ids, width, height, depth),
+            )
+            proc.daemon = True
+            proc.start()
+            worker_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+
+        self._next_worker = 0
+        self._next_job_id = 0
+        # futures waiting for results; frames of dropped futures are discarded
+        self._pending = [{} for _ in range(num_workers)]
+        self._max_pending = max(1, max_pending)
+        self._closed = False
+        logger.info("Launch %d render workers", num_workers)
+
+    def set_model(self, xml, cam_pos, cam_quat):
+        """
+        Sends a new model to all workers. Call this whenever the MjSim is rebuilt
+        or the cameras are moved.
+        """
+        for conn in self._conns:
+            conn.send(("model", (xml, np.array(cam_pos), np.array(cam_quat))))
+
+    def submit(self, sim):
+        """ Snapshots the state of @sim and returns a RenderFuture for its frames. """
+        snapshot = get_render_state(sim)
+
+        worker_idx = self._next_worker
+        job_id = self._next_job_id
+        self._next_worker = (self._next_worker + 1) % len(self._conns)
+        self._next_job_id += 1
+
+        # frames nobody asked for yet would fill up the pipe and block the
+        # worker, which then stops reading snapshots and blocks this send
+        self._drain(worker_idx, self._max_pending - 1)
+        self._conns[worker_idx].send(("render", (job_id, snapshot)))
+        future = RenderFuture(self, worker_idx, job_id)
+        self._pending[worker_idx][job_id] = weakref.ref(future)
+        return future
+
+    def _receive(self, worker_idx):
+        """ Receives the next frame of @worker_idx and hands it to its future. """
+        recv_id, img, depth = self._conns[worker_idx].recv()
+        future = self._pending[worker_idx].pop(recv_id)()
+        if future is not None:
+            future._result = (img, depth)
+
+    def _drain(self, worker_idx, max_pending=None):
+        """
+        Receives finished frames of @worker_idx and, if @max_pending is given,
+        blocks until at most @max_pending jobs are left.
+        """
+        pending = self._pending[worker_idx]
+        conn = self._conns[worker_idx]
+        while pending and (
+            (max_pending is not None and len(pending) > max_pending) or conn.poll()
+        ):
+            self._receive(worker_idx)
+
+    def _wait(self, worker_idx, job_id):
+        # each worker answers in submission order
+        while job_id in self._pending[worker_idx]:
+            self._receive(worker_idx)
+        self._drain(worker_idx)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for conn in self._conns:
+            try:
+                conn.send(("close", None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.terminate()
+
+    def __del__(self):
+        self.close()
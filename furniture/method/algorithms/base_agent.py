@@ -1,21 +1,38 @@
+import os
 from collections import OrderedDict
 
 import torch
 import numpy as np
 
+from .dataset import FrameReplayBuffer, MemmapReplayBuffer, ReplayBuffer
+from .inference import ActorInference
+from .prioritized_replay import PrioritizedReplayBuffer
+from .shared_replay import SharedReplayBuffer
 from ..utils.normalizer import Normalizer
-from ..utils.pytorch import to_tensor, center_crop
+from ..utils.pytorch import PolyakAverager, sync_grads
 
 class BaseAgent(object):
     """ Base class for agents. """
 
     def __init__(self, config, ob_space):
         self._config = config
+        self._ob_space = ob_space
 
         self._ob_norm = Normalizer(
-            ob_space, default_clip_range=config.clip_range, clip_obs=config.clip_obs
+            ob_space,
+            default_clip_range=config.clip_range,
+            clip_obs=config.clip_obs,
+            mode=config.ob_norm_mode,
+            sync_interval=config.ob_norm_sync_interval,
         )
         self._buffer = None
+        self._inference = None
+
+        # mixed precision of network updates
+        self._amp_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(
+            config.precision
+        )
+        self._grad_scalers = {}
 
     def normalize(self, ob):
         """ Normalizes observations. """
@@ -28,31 +45,55 @@ class BaseAgent(object):
         if hasattr(self, "_rl_agent"):
             return self._rl_agent.act(ob, is_train)
 
-        ob = self.normalize(ob)
-
-        ob = ob.copy()
-        for k, v in ob.items():
-            if self._config.encoder_type == "cnn" and len(v.shape) == 3:
-                    ob[k] = center_crop(v, self._config.encoder_image_size)
-            else:
-                ob[k] = np.expand_dims(ob[k], axis=0)
-
-        with torch.no_grad():
-            ob = to_tensor(ob, self._config.device)
-            ac, activation, _, _ = self._actor.act(ob, deterministic=not is_train)
+        ob = OrderedDict([(k, np.expand_dims(v, axis=0)) for k, v in ob.items()])
+        ac, activation = self._get_inference().act(ob, deterministic=not is_train)
 
         for k in ac.keys():
-            ac[k] = ac[k].cpu().numpy().squeeze(0)
-            activation[k] = activation[k].cpu().numpy().squeeze(0)
+            ac[k] = ac[k].squeeze(0)
+            activation[k] = activation[k].squeeze(0)
 
         return ac, activation
 
+    def batch_act(self, obs, is_train=True):
+        """
+        Returns actions and the actor's activations for a batch of observations
+        @obs (e.g. from a vectorized environment), a dict of arrays whose first
+        axis is the batch.
+        """
+        if hasattr(self, "_rl_agent"):
+            return self._rl_agent.batch_act(obs, is_train)
+
+        return self._get_inference().act(obs, deterministic=not is_train)
+
+    def _get_inference(self):
+        """ Lazily builds the inference path once the actor is created. """
+        if self._inference is None:
+            self._inference = ActorInference(
+                self._config,
+                self._actor,
+                self._ob_space,
+                self._ob_norm if self._config.ob_norm else None,
+                compile=self._config.compile_actor,
+            )
+        return self._inference
+
+    def policy_state_dict(self):
+        """ Returns a CPU copy of the actor and normalizer for rollout processes. """
+        if hasattr(self, "_rl_agent"):
+            return self._rl_agent.policy_state_dict()
+
+        return {
+            "actor": OrderedDict(
+                [(k, v.detach().cpu().clone()) for k, v in self._actor.state_dict().items()]
+            ),
+            "ob_norm": self._ob_norm.state_dict(),
+        }
+
     def update_normalizer(self, obs=None):
         """ Updates normalizers. """
         if self._config.ob_norm:
             if obs is None:
-                for i in range(len(self._dataset)):
-                    self._ob_norm.update(self._dataset[i]["ob"])
+                self._ob_norm.update(self._dataset.buffer["ob"])
                 self._ob_norm.recompute_stats()
             else:
                 self._ob_norm.update(obs)
@@ -65,6 +106,40 @@ class BaseAgent(object):
     def is_off_policy(self):
         return self._buffer is not None
 
+    def _create_replay_buffer(self, keys, sample_func):
+        """ Creates the replay buffer chosen by --replay_buffer. """
+        if self._config.replay_buffer == "shared":
+            return SharedReplayBuffer(
+                keys,
+                self._config.buffer_size,
+                self._config.shared_replay_dir,
+                self._config.encoder_image_size,
+            )
+        if self._config.replay_buffer == "frame":
+            return FrameReplayBuffer(
+                keys,
+                self._config.buffer_size,
+                self._config.frame_stack,
+                self._config.encoder_image_size,
+            )
+        if self._config.replay_buffer == "prioritized":
+            return PrioritizedReplayBuffer(
+                keys,
+                self._config.buffer_size,
+                self._config.encoder_image_size,
+                alpha=self._config.per_alpha,
+                beta=self._config.per_beta,
+                eps=self._config.per_eps,
+            )
+        if self._config.replay_buffer == "memmap":
+            return MemmapReplayBuffer(
+                keys,
+                self._config.buffer_size,
+                os.path.join(self._config.log_dir, "replay"),
+                self._config.encoder_image_size,
+            )
+        return ReplayBuffer(keys, self._config.buffer_size, sample_func)
+
     def set_buffer(self, buffer):
         self._buffer = buffer
 
@@ -83,11 +158,53 @@ class BaseAgent(object):
     def train(self):
         raise NotImplementedError()
 
+    def _autocast(self):
+        """ Returns a context that runs forward passes in --precision. """
+        return torch.autocast(
+            device_type=torch.device(self._config.device).type,
+            dtype=self._amp_dtype or torch.float32,
+            enabled=self._amp_dtype is not None,
+        )
+
+    def _optimizer_step(self, loss, optim, network=None, max_grad_norm=None):
+        """
+        Backpropagates @loss, syncs gradients of @network across workers and
+        steps @optim. In fp16, gradients are scaled with a GradScaler per
+        optimizer and clipped after the sync, so that all workers skip the
+        same steps with inf gradients.
+        """
+        scaler = self._grad_scalers.get(optim)
+        if scaler is None:
+            enabled = self._amp_dtype == torch.float16
+            if hasattr(torch.amp, "GradScaler"):
+                scaler = torch.amp.GradScaler(
+                    torch.device(self._config.device).type, enabled=enabled
+                )
+            else:
+                # torch < 2.3 only has the deprecated CUDA scaler
+                scaler = torch.cuda.amp.GradScaler(enabled=enabled)
+            self._grad_scalers[optim] = scaler
+
+        optim.zero_grad()
+        scaler.scale(loss).backward()
+        if max_grad_norm and not scaler.is_enabled():
+            torch.nn.utils.clip_grad_norm_(network.parameters(), max_grad_norm)
+        if network is not None:
+            sync_grads(network)
+        if max_grad_norm and scaler.is_enabled():
+            scaler.unscale_(optim)
+            torch.nn.utils.clip_grad_norm_(network.parameters(), max_grad_norm)
+        scaler.step(optim)
+        scaler.update()
+
     def _soft_update_target_network(self, target, source, tau):
-        for target_param, source_param in zip(target.parameters(), source.parameters()):
-            target_param.data.copy_(
-                (1 - tau) * source_param.data + tau * target_param.data
-            )
+        averager = PolyakAverager()
+        averager.add(target, source, tau)
+        averager.update()
 
     def _copy_target_network(self, target, source):
-        self._soft_update_target_network(target, source, 0)
+        with torch.no_grad():
+            for target_param, source_param in zip(
+                target.parameters(), source.parameters()
+            ):
+                target_param.copy_(source_param)
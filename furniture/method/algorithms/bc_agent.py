@@ -4,15 +4,13 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data.sampler import SubsetRandomSampler
 from torch.optim.lr_scheduler import StepLR
 
 from .base_agent import BaseAgent
-from .expert_dataset import ExpertDataset
+from .expert_dataset import ExpertDataset, ExpertDataLoader
 from ..networks import Actor
-from ..utils.info_dict import Info
+from ..utils.info_dict import DeviceInfo
 from ..utils.logger import logger
-from ..utils.mpi import mpi_average
 from ..utils.pytorch import (
     optimizer_cuda,
     count_parameters,
@@ -50,26 +48,27 @@ class BCAgent(BaseAgent):
                 sample_range_end=config.demo_sample_range_end,
             )
 
+            self._val_loader = None
             if self._config.val_split != 0:
                 dataset_size = len(self._dataset)
-                indices = list(range(dataset_size))
+                indices = np.arange(dataset_size)
                 split = int(np.floor((1 - self._config.val_split) * dataset_size))
                 train_indices, val_indices = indices[split:], indices[:split]
-                train_sampler = SubsetRandomSampler(train_indices)
-                val_sampler = SubsetRandomSampler(val_indices)
-                self._train_loader = torch.utils.data.DataLoader(
+                self._train_loader = ExpertDataLoader(
                     self._dataset,
-                    batch_size=self._config.batch_size,
-                    sampler=train_sampler,
+                    self._config.batch_size,
+                    config.device,
+                    indices=train_indices,
                 )
-                self._val_loader = torch.utils.data.DataLoader(
+                self._val_loader = ExpertDataLoader(
                     self._dataset,
-                    batch_size=self._config.batch_size,
-                    sampler=val_sampler,
+                    self._config.batch_size,
+                    config.device,
+                    indices=val_indices,
                 )
             else:
-                self._train_loader = torch.utils.data.DataLoader(
-                    self._dataset, batch_size=self._config.batch_size, shuffle=True
+                self._train_loader = ExpertDataLoader(
+                    self._dataset, self._config.batch_size, config.device
                 )
 
         self._log_creation()
@@ -101,7 +100,7 @@ class BCAgent(BaseAgent):
         sync_networks(self._actor)
 
     def train(self):
-        train_info = Info()
+        train_info = DeviceInfo()
         for transitions in self._train_loader:
             _train_info = self._update_network(transitions, train=True)
             train_info.add(_train_info)
@@ -114,31 +113,30 @@ class BCAgent(BaseAgent):
                 "actor_weight_norm": compute_weight_norm(self._actor),
             }
         )
-        train_info = train_info.get_dict(only_scalar=True)
+        train_info = train_info.get_dict()
         logger.info("BC loss %f", train_info["actor_loss"])
         return train_info
 
     def evaluate(self):
         if self._val_loader:
-            eval_info = Info()
+            eval_info = DeviceInfo()
             for transitions in self._val_loader:
                 _eval_info = self._update_network(transitions, train=False)
-                eval_info.add(_val_info)
+                eval_info.add(_eval_info)
             self._epoch += 1
-            return eval_info.get_dict(only_scalar=True)
+            return eval_info.get_dict()
         logger.warning("No validation set available, make sure '--val_split' is set")
         return None
 
     def _update_network(self, transitions, train=True):
-        info = Info()
+        info = DeviceInfo()
 
         # pre-process observations
         o = transitions["ob"]
-        o = self.normalize(o)
 
         # convert double tensor to float32 tensor
         _to_tensor = lambda x: to_tensor(x, self._config.device)
-        o = _to_tensor(o)
+        o = self.normalize(_to_tensor(o))
         ac = _to_tensor(transitions["ac"])
         if isinstance(ac, OrderedDict):
             ac = list(ac.values())
@@ -156,12 +154,10 @@ class BCAgent(BaseAgent):
 
         diff = ac - pred_ac
         actor_loss = diff.pow(2).mean()
-        info["actor_loss"] = actor_loss.cpu().item()
-        info["pred_ac"] = pred_ac.cpu().detach()
-        info["GT_ac"] = ac.cpu()
-        diff = torch.sum(torch.abs(diff), axis=0).cpu()
+        info["actor_loss"] = actor_loss.detach()
+        diff = torch.sum(torch.abs(diff.detach()), axis=0)
         for i in range(diff.shape[0]):
-            info["action" + str(i) + "_L1loss"] = diff[i].mean().item()
+            info["action" + str(i) + "_L1loss"] = diff[i]
 
         if train:
             # update the actor
@@ -171,4 +167,4 @@ class BCAgent(BaseAgent):
             sync_grads(self._actor)
             self._actor_optim.step()
 
-        return mpi_average(info.get_dict(only_scalar=True))
+        return info
@@ -1,9 +1,18 @@
+import mmap
+import os
 from collections import defaultdict
 from time import time
 
 import numpy as np
+import torch
 
-from ..utils.pytorch import random_crop
+from ..utils.logger import logger
+from ..utils.pytorch import random_crop, random_crop_tensor
+
+
+def buffer_dtype(shape):
+    """ Returns the dtype items of @shape are stored in: uint8 images, float32 otherwise. """
+    return np.uint8 if len(shape) >= 3 else np.float32
 
 
 def make_buffer(shapes, buffer_size):
@@ -12,14 +21,27 @@ def make_buffer(shapes, buffer_size):
         if isinstance(v, dict):
             buffer[k] = make_buffer(v, buffer_size)
         else:
-            if len(v) >= 3:
-                buffer[k] = np.empty((buffer_size, *v), dtype=np.uint8)
-            else:
-                buffer[k] = np.empty((buffer_size, *v), dtype=np.float32)
+            buffer[k] = np.empty((buffer_size, *v), dtype=buffer_dtype(v))
     return buffer
 
 
-def add_rollout(buffer, rollout, idx: int):
+def make_buffer_like(example, buffer_size):
+    """
+    Allocates arrays for @buffer_size items shaped like the item @example.
+    The dtype only depends on the shape, so that an integer first reward does
+    not truncate later float rewards.
+    """
+    if isinstance(example, dict):
+        return {k: make_buffer_like(v, buffer_size) for k, v in example.items()}
+    shape = np.shape(example)
+    return np.empty((buffer_size, *shape), dtype=buffer_dtype(shape))
+
+
+def add_rollout(buffer, rollout, idx):
+    """
+    Writes @rollout into @buffer at @idx, which can be an index, a slice or an
+    index array for columnar rollouts.
+    """
     if isinstance(rollout, list):
         rollout = rollout[0]
 
@@ -27,7 +49,77 @@ def add_rollout(buffer, rollout, idx: int):
         for k in rollout.keys():
             add_rollout(buffer[k], rollout[k], idx)
     else:
-        np.copyto(buffer[idx], rollout)
+        # scalars such as rew and done may be stored with a trailing dimension
+        lead = () if isinstance(idx, (int, np.integer)) else (-1,)
+        buffer[idx] = np.reshape(rollout, lead + buffer.shape[1:])
+
+
+def slice_buffer(buffer, idx):
+    """ Returns views of (nested dicts of) arrays @buffer at slice @idx. """
+    if isinstance(buffer, dict):
+        return {k: slice_buffer(v, idx) for k, v in buffer.items()}
+    return buffer[idx]
+
+
+def get_item(episode, t):
+    """ Returns transition @t of an episode stored as a list or as columnar arrays. """
+    if isinstance(episode, dict):
+        return {k: get_item(v, t) for k, v in episode.items()}
+    return episode[t]
+
+
+def episode_length(episode):
+    """ Returns the number of transitions of a list or columnar @episode. """
+    while isinstance(episode, dict):
+        episode = next(iter(episode.values()))
+    return len(episode)
+
+
+def concat_episode(episode, rollout):
+    """ Appends @rollout to @episode, both lists or both columnar arrays. """
+    if isinstance(episode, list):
+        episode.extend(rollout)
+        return episode
+    if isinstance(episode, dict):
+        return {k: concat_episode(episode[k], rollout[k]) for k in episode}
+    return np.concatenate([episode, rollout])
+
+
+def get_layout(example, prefix=""):
+    """ Returns {file key: (shape, dtype)} of one transition @example. """
+    layout = {}
+    for k, v in example.items():
+        if isinstance(v, dict):
+            layout.update(get_layout(v, prefix + k + "."))
+        else:
+            shape = np.shape(v)
+            layout[prefix + k] = (shape, np.dtype(buffer_dtype(shape)).str)
+    return layout
+
+
+def nest(flat):
+    """ Converts {"ob.camera_ob": x} to {"ob": {"camera_ob": x}}. """
+    nested = {}
+    for k, v in flat.items():
+        d = nested
+        keys = k.split(".")
+        for key in keys[:-1]:
+            d = d.setdefault(key, {})
+        d[keys[-1]] = v
+    return nested
+
+
+def open_arrays(path, layout, capacity, mode):
+    """ Opens (or creates with @mode="w+") one memory-mapped .npy file per key. """
+    return {
+        k: np.lib.format.open_memmap(
+            os.path.join(path, k + ".npy"),
+            mode=mode,
+            dtype=np.dtype(dtype),
+            shape=(capacity,) + tuple(shape),
+        )
+        for k, (shape, dtype) in layout.items()
+    }
 
 
 def get_batch(buffer: dict, idxs):
@@ -41,6 +133,7 @@ def get_batch(buffer: dict, idxs):
 
 
 def augment_ob(batch, image_crop_size):
+    """ Randomly crops images (B,C,H,W) or (B,N,C,H,W) in @batch in place. """
     for k, v in batch.items():
         if isinstance(batch[k], dict):
             augment_ob(batch[k], image_crop_size)
@@ -71,11 +164,14 @@ class ReplayBufferPerStep(object):
 
     # store the episode
     def store_episode(self, rollout):
+        """ Copies a columnar @rollout of any length into the ring buffer. """
+        n = episode_length(rollout["done"])
+        idxs = (self._idx + np.arange(n)) % self._capacity
         for k in self._keys:
-            add_rollout(self._buffer[k], rollout[k], self._idx)
+            add_rollout(self._buffer[k], rollout[k], idxs)
 
-        self._idx = (self._idx + 1) % self._capacity
-        self._full = self._full or self._idx == 0
+        self._full = self._full or self._idx + n >= self._capacity
+        self._idx = (self._idx + n) % self._capacity
 
     # sample the data from the replay buffer
     def sample(self, batch_size):
@@ -98,6 +194,333 @@ class ReplayBufferPerStep(object):
         self._full = state_dict["full"]
 
 
+def _same_rows(a, b):
+    """ Returns whether each row of @a equals the same row of @b. """
+    # explicit row width as -1 is ambiguous for empty @a (1-step rollouts)
+    return (a == b).reshape(len(a), int(np.prod(a.shape[1:]))).all(axis=1)
+
+
+class FrameReplayBuffer(object):
+    """
+    Per-step ring buffer that stores each image frame once.
+
+    Stacked images of FrameStackWrapper (uint8 arrays of shape
+    (frame_stack * C, H, W)) are split into frames kept in a frame ring, and a
+    transition only keeps the id of the newest frame of ob and ob_next. Each
+    stack is a window of consecutive frame ids, so a new step adds one frame
+    for ob_next and reuses the frames of the previous ob_next for ob. Whether
+    a stack continues the previous one is checked on the pixels, so episode
+    boundaries, absorbing states and interleaved rollouts of several workers
+    only cost extra frames. Stacks are rebuilt by gathering frames on sampling.
+    Other observations are stored per transition.
+    """
+
+    def __init__(self, keys, buffer_size, frame_stack=3, image_crop_size=84,
+                 frame_capacity=None):
+        """
+        Args:
+            keys: keys of transitions to store.
+            buffer_size: number of transitions.
+            frame_stack: number of frames in an image observation.
+            image_crop_size: size of random crops of sampled images.
+            frame_capacity: number of frames, by default a bit more than
+                @buffer_size for the frames of episode starts.
+        """
+        self._keys = keys
+        self._capacity = buffer_size
+        self._frame_stack = frame_stack
+        self._frame_capacity = frame_capacity or buffer_size + buffer_size // 8 + frame_stack
+        self._image_crop_size = image_crop_size
+
+        self._buffer = None
+        self._frames = None
+        self.clear()
+
+    def clear(self):
+        # absolute ids of transitions and frames, slots are ids modulo capacity
+        self._first = 0
+        self._num_transitions = 0
+        self._num_frames = 0
+
+    def __len__(self):
+        return self._num_transitions - self._first
+
+    def _image_keys(self, ob):
+        return [
+            k
+            for k, v in ob.items()
+            if isinstance(v, np.ndarray) and v.dtype == np.uint8 and len(v.shape) == 4
+        ]
+
+    def _unstack(self, ob):
+        """ Returns images of @ob as (T, frame_stack, C, H, W) views. """
+        return {
+            k: ob[k].reshape(len(ob[k]), self._frame_stack, -1, *ob[k].shape[2:])
+            for k in self._image_keys(ob)
+        }
+
+    def _allocate(self, rollout):
+        image_keys = self._image_keys(rollout["ob"])
+        example = slice_buffer(rollout, 0)
+        for k in ["ob", "ob_next"]:
+            example[k] = {
+                key: v for key, v in example[k].items() if key not in image_keys
+            }
+        self._buffer = make_buffer_like(example, self._capacity)
+        self._frames = {
+            k: make_buffer_like(v[0, 0], self._frame_capacity)
+            for k, v in self._unstack(rollout["ob"]).items()
+        }
+        self._ob_end = np.zeros(self._capacity, dtype=np.int64)
+        self._ob_next_end = np.zeros(self._capacity, dtype=np.int64)
+
+    def _frame_window(self, ends):
+        """ Returns frame slots of the stacks ending at frame ids @ends. """
+        offsets = np.arange(1 - self._frame_stack, 1)
+        return (ends[:, None] + offsets) % self._frame_capacity
+
+    # store the episode
+    def store_episode(self, rollout):
+        """ Copies a columnar @rollout of any length into the ring buffer. """
+        rollout = {k: rollout[k] for k in self._keys}
+        if self._buffer is None:
+            self._allocate(rollout)
+
+        n = episode_length(rollout["done"])
+        k = self._frame_stack
+        ob = self._unstack(rollout["ob"])
+        ob_next = self._unstack(rollout["ob_next"])
+
+        # ob continues the previous ob_next and ob_next shifts ob by a frame
+        continues = np.ones(n, dtype=bool)
+        continues[0] = self._num_transitions > 0
+        shifts = np.ones(n, dtype=bool)
+        for key in self._frames.keys():
+            if continues[0]:
+                last = self._frame_window(np.array([self._num_frames - 1]))
+                continues[0] &= np.array_equal(ob[key][0], self._frames[key][last[0]])
+            continues[1:] &= _same_rows(ob[key][1:], ob_next[key][:-1])
+            shifts &= _same_rows(ob_next[key][:, :-1], ob[key][:, 1:])
+
+        # frames are written in order, so every stack has consecutive frame ids
+        num_new = np.where(continues, 0, k) + np.where(shifts, 1, k)
+        start = self._num_frames + np.cumsum(num_new) - num_new
+        ob_end = np.where(continues, start - 1, start + k - 1)
+        ob_next_end = start + num_new - 1
+
+        for key, frames in self._frames.items():
+            new = ~continues
+            frames[self._frame_window(ob_end[new]).ravel()] = ob[key][new].reshape(
+                -1, *frames.shape[1:]
+            )
+            frames[ob_next_end[shifts] % self._frame_capacity] = ob_next[key][shifts, -1]
+            frames[self._frame_window(ob_next_end[~shifts]).ravel()] = ob_next[key][
+                ~shifts
+            ].reshape(-1, *frames.shape[1:])
+        self._num_frames += int(num_new.sum())
+
+        idxs = (self._num_transitions + np.arange(n)) % self._capacity
+        for key in self._keys:
+            value = rollout[key]
+            if key in ["ob", "ob_next"]:
+                value = {k_: v for k_, v in value.items() if k_ not in self._frames}
+            add_rollout(self._buffer[key], value, idxs)
+        self._ob_end[idxs] = ob_end
+        self._ob_next_end[idxs] = ob_next_end
+        self._num_transitions += n
+
+        # drop transitions that are overwritten or whose frames are overwritten
+        self._first = max(self._first, self._num_transitions - self._capacity)
+        oldest_frame = self._num_frames - self._frame_capacity + k - 1
+        while (
+            self._first < self._num_transitions
+            and self._ob_end[self._first % self._capacity] < oldest_frame
+        ):
+            self._first += 1
+
+    # sample the data from the replay buffer
+    def sample(self, batch_size):
+        idxs = np.random.randint(self._first, self._num_transitions, size=batch_size)
+        idxs %= self._capacity
+        batch = get_batch(self._buffer, idxs)
+        for key, ends in [("ob", self._ob_end), ("ob_next", self._ob_next_end)]:
+            window = self._frame_window(ends[idxs])
+            for k, frames in self._frames.items():
+                stack = frames[window]
+                batch[key][k] = stack.reshape(batch_size, -1, *stack.shape[3:])
+
+        # apply random crop to image
+        augment_ob(batch, self._image_crop_size)
+
+        return batch
+
+    def state_dict(self):
+        return {
+            "buffer": self._buffer,
+            "frames": self._frames,
+            "ob_end": self._ob_end if self._buffer is not None else None,
+            "ob_next_end": self._ob_next_end if self._buffer is not None else None,
+            "first": self._first,
+            "num_transitions": self._num_transitions,
+            "num_frames": self._num_frames,
+        }
+
+    def load_state_dict(self, state_dict):
+        self._buffer = state_dict["buffer"]
+        self._frames = state_dict["frames"]
+        self._ob_end = state_dict["ob_end"]
+        self._ob_next_end = state_dict["ob_next_end"]
+        self._first = state_dict["first"]
+        self._num_transitions = state_dict["num_transitions"]
+        self._num_frames = state_dict["num_frames"]
+
+
+def _open_mapped(filename, dtype, shape, mode):
+    """
+    Opens the .npy file @filename (created first with @mode="w+") through an
+    own mmap, whose flush() takes file offsets. Returns the array, the mmap
+    and the offset of the data in the file.
+    """
+    if mode == "w+":
+        # writes the header and sizes the file
+        np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+    with open(filename, "r+b") as f:
+        if np.lib.format.read_magic(f) == (1, 0):
+            np.lib.format.read_array_header_1_0(f)
+        else:
+            np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        mm = mmap.mmap(f.fileno(), 0)
+    return np.ndarray(shape, dtype=dtype, buffer=mm, offset=offset), mm, offset
+
+
+def _flush_rows(mm, offset, row_size, start, stop):
+    """ Writes rows [@start, @stop) of an array at @offset of @mm to disk. """
+    begin = offset + start * row_size
+    end = offset + stop * row_size
+    begin -= begin % mmap.ALLOCATIONGRANULARITY
+    mm.flush(begin, end - begin)
+
+
+class MemmapReplayBuffer(object):
+    """
+    Per-step ring buffer stored in memory-mapped .npy files in @path, one per
+    key, so buffers larger than RAM are paged in and out by the OS.
+
+    state_dict() only flushes chunks written since the last call and returns
+    the ring state, which is small enough to checkpoint often. The files keep
+    the data, and load_state_dict() reopens them lazily.
+    """
+
+    def __init__(self, keys, buffer_size, path, image_crop_size=84, chunk_size=4096):
+        """
+        Args:
+            keys: keys of transitions to store.
+            buffer_size: number of transitions.
+            path: directory of the files.
+            image_crop_size: size of random crops of sampled images.
+            chunk_size: number of transitions tracked as one dirty chunk.
+        """
+        self._keys = keys
+        self._capacity = buffer_size
+        self._path = path
+        self._image_crop_size = image_crop_size
+        self._chunk_size = chunk_size
+
+        self._layout = None
+        self._arrays = None
+        self._mmaps = None
+        self._dirty = set()
+        self.clear()
+
+    def clear(self):
+        self._idx = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _open(self):
+        """ Creates the files for the first transition or reopens existing ones. """
+        exists = all(
+            os.path.exists(os.path.join(self._path, k + ".npy")) for k in self._layout
+        )
+        if self._size > 0 and not exists:
+            logger.warn("Replay buffer files not exist at %s", self._path)
+            self.clear()
+        mode = "r+" if self._size > 0 else "w+"
+        os.makedirs(self._path, exist_ok=True)
+        self._arrays = {}
+        self._mmaps = {}
+        for k, (shape, dtype) in self._layout.items():
+            self._arrays[k], mm, offset = _open_mapped(
+                os.path.join(self._path, k + ".npy"),
+                np.dtype(dtype),
+                (self._capacity,) + tuple(shape),
+                mode,
+            )
+            self._mmaps[k] = (mm, offset)
+        self._buffer = nest(self._arrays)
+
+    # store the episode
+    def store_episode(self, rollout):
+        """ Copies a columnar @rollout of any length into the ring buffer. """
+        rollout = {k: rollout[k] for k in self._keys}
+        if self._layout is None:
+            self._layout = get_layout(slice_buffer(rollout, 0))
+        if self._arrays is None:
+            self._open()
+
+        n = episode_length(rollout["done"])
+        idxs = (self._idx + np.arange(n)) % self._capacity
+        add_rollout(self._buffer, rollout, idxs)
+        self._dirty.update(np.unique(idxs // self._chunk_size).tolist())
+
+        self._idx = (self._idx + n) % self._capacity
+        self._size = min(self._size + n, self._capacity)
+
+    # sample the data from the replay buffer
+    def sample(self, batch_size):
+        if self._arrays is None:
+            self._open()
+        idxs = np.random.randint(0, self._size, size=batch_size)
+        batch = get_batch(self._buffer, idxs)
+
+        # apply random crop to image
+        augment_ob(batch, self._image_crop_size)
+
+        return batch
+
+    def flush(self):
+        """ Writes the chunks changed since the last flush to disk. """
+        for chunk in sorted(self._dirty):
+            start = chunk * self._chunk_size
+            stop = min(start + self._chunk_size, self._capacity)
+            for k, array in self._arrays.items():
+                mm, offset = self._mmaps[k]
+                _flush_rows(mm, offset, array.strides[0], start, stop)
+        self._dirty.clear()
+
+    def state_dict(self):
+        if self._arrays is not None:
+            self.flush()
+        return {
+            "layout": self._layout,
+            "capacity": self._capacity,
+            "idx": self._idx,
+            "size": self._size,
+        }
+
+    def load_state_dict(self, state_dict):
+        assert state_dict["capacity"] == self._capacity, "buffer_size is changed"
+        self._layout = state_dict["layout"]
+        self._idx = state_dict["idx"]
+        self._size = state_dict["size"]
+        self._arrays = None
+        self._mmaps = None
+        self._dirty.clear()
+
+
 class ReplayBuffer(object):
     def __init__(self, keys, buffer_size, sample_func):
         self._capacity = buffer_size
@@ -139,7 +562,189 @@ class ReplayBuffer(object):
         self._current_size = len(self._buffer["ac"])
 
 
+def stack_tensor(values, device):
+    """
+    Stacks a list of arrays (or of dicts of arrays) or columnar arrays into
+    tensors on @device.
+    Images (uint8) stay uint8 and everything else becomes float32.
+    """
+    if isinstance(values, dict):
+        return {k: stack_tensor(v, device) for k, v in values.items()}
+    if isinstance(values[0], dict):
+        return {k: stack_tensor([v[k] for v in values], device) for k in values[0]}
+    values = np.stack(values) if isinstance(values, list) else np.asarray(values)
+    if values.dtype != np.uint8:
+        values = values.astype(np.float32)
+    return torch.as_tensor(values, device=device)
+
+
+def get_tensor_batch(buffer, idxs, image_crop_size=None):
+    """
+    Indexes (nested dicts of) tensors with @idxs. Images are random-cropped to
+    @image_crop_size on the device and converted to float.
+    """
+    if isinstance(buffer, dict):
+        return {
+            k: get_tensor_batch(v, idxs, image_crop_size) for k, v in buffer.items()
+        }
+    batch = buffer[idxs]
+    if batch.dtype == torch.uint8:
+        if image_crop_size is not None and len(batch.shape) == 4:
+            batch = random_crop_tensor(batch, image_crop_size)
+        batch = batch.float()
+    return batch
+
+
+class RolloutTensorBuffer(object):
+    """
+    On-policy rollout stored as contiguous tensors on the training device.
+    Minibatches are taken by indexing the tensors, so training epochs do not
+    go through Python lists or NumPy.
+    """
+
+    def __init__(self, device, image_crop_size=84):
+        self._device = device
+        self._image_crop_size = image_crop_size
+        self.clear()
+
+    def clear(self):
+        self._buffer = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        return self._buffer[key]
+
+    def store(self, data):
+        """ Appends @data, a dict of (dicts of) tensors with the same length. """
+        def cat(old, new):
+            if isinstance(new, dict):
+                return {k: cat(old[k], new[k]) for k in new}
+            return torch.cat([old, new])
+
+        if self._size == 0:
+            self._buffer = data
+        else:
+            self._buffer = {k: cat(self._buffer[k], v) for k, v in data.items()}
+        self._size = len(self._buffer["done"])
+
+    def store_key(self, key, value):
+        """ Adds @value, a tensor covering the whole rollout, as @key. """
+        assert len(value) == self._size
+        self._buffer[key] = value
+
+    def sample_epochs(self, batch_size, num_epochs):
+        """ Yields shuffled minibatches that cover the rollout @num_epochs times. """
+        for _ in range(num_epochs):
+            perm = torch.randperm(self._size, device=self._device)
+            for i in range(self._size // batch_size):
+                idxs = perm[i * batch_size : (i + 1) * batch_size]
+                yield get_tensor_batch(self._buffer, idxs, self._image_crop_size)
+
+
+class EpisodeArrays(object):
+    """
+    Episodes stored back to back in one array per key (nested for dict keys).
+    Rows of episode i of key k are start[k][i] to start[k][i] + size[k][i],
+    and length[i] is its number of transitions (the size of "ac"). Keys may
+    have more rows than transitions, e.g. the final observation for HER.
+
+    Replacing an episode appends its rows, and the arrays are compacted when
+    they are full, so storing takes amortized constant time per transition.
+    """
+
+    def __init__(self, keys, capacity):
+        """
+        Args:
+            keys: keys of episodes to store.
+            capacity: number of episodes.
+        """
+        self._keys = keys
+        self._arrays = None
+        self._used = {k: 0 for k in keys}
+        self.start = {k: np.zeros(capacity, dtype=np.int64) for k in keys}
+        self.size = {k: np.zeros(capacity, dtype=np.int64) for k in keys}
+        self.length = np.zeros(capacity, dtype=np.int64)
+        self.num_episodes = 0
+
+    def keys(self):
+        return self._keys
+
+    def __len__(self):
+        return self.num_episodes
+
+    def get(self, key, episode_idxs, t):
+        """ Returns rows @t of episodes @episode_idxs of @key (broadcasted). """
+        return get_item(self._arrays[key], self.start[key][episode_idxs] + t)
+
+    def set(self, idx, episode):
+        """ Stores a columnar @episode as episode @idx. """
+        if self._arrays is None:
+            self._arrays = {
+                k: make_buffer_like(get_item(episode[k], 0), 1024) for k in self._keys
+            }
+        for k in self._keys:
+            n = episode_length(episode[k])
+            if self._used[k] + n > episode_length(self._arrays[k]):
+                self._compact(k, n)
+            rows = slice(self._used[k], self._used[k] + n)
+            add_rollout(self._arrays[k], episode[k], rows)
+            self.start[k][idx] = self._used[k]
+            self.size[k][idx] = n
+            self._used[k] += n
+        self.length[idx] = episode_length(episode["ac"])
+        self.num_episodes = max(self.num_episodes, idx + 1)
+
+    def _compact(self, key, extra=0):
+        """ Moves live rows of @key to the front, growing arrays to fit @extra rows. """
+        starts = self.start[key][: self.num_episodes]
+        sizes = self.size[key][: self.num_episodes]
+        offsets = np.cumsum(sizes) - sizes
+        live = int(sizes.sum())
+        rows = np.repeat(starts - offsets, sizes) + np.arange(live)
+
+        old = self._arrays[key]
+        capacity = max(episode_length(old), 2 * (live + extra))
+        self._arrays[key] = make_buffer_like(get_item(old, 0), capacity)
+        add_rollout(self._arrays[key], get_item(old, rows), slice(0, live))
+        self.start[key][: self.num_episodes] = offsets
+        self._used[key] = live
+
+    def state_dict(self):
+        if self._arrays is None:
+            return {"arrays": None}
+        for k in self._keys:
+            self._compact(k)
+        return {
+            "arrays": {
+                k: slice_buffer(v, slice(0, self._used[k]))
+                for k, v in self._arrays.items()
+            },
+            "start": self.start,
+            "size": self.size,
+            "length": self.length,
+            "num_episodes": self.num_episodes,
+        }
+
+    def load_state_dict(self, state_dict):
+        self._arrays = state_dict["arrays"]
+        if self._arrays is None:
+            return
+        self.start = state_dict["start"]
+        self.size = state_dict["size"]
+        self.length = state_dict["length"]
+        self.num_episodes = state_dict["num_episodes"]
+        self._used = {k: episode_length(v) for k, v in self._arrays.items()}
+
+
 class ReplayBufferEpisode(object):
+    """
+    Replay buffer of complete episodes in EpisodeArrays, which are passed to
+    @sample_func (e.g. SeqSampler or HERSampler).
+    """
+
     def __init__(self, keys, buffer_size, sample_func):
         self._capacity = buffer_size
         self._sample_func = sample_func
@@ -151,27 +756,26 @@ class ReplayBufferEpisode(object):
     def clear(self):
         self._idx = 0
         self._current_size = 0
-        self._new_episode = True
-        self._buffer = defaultdict(list)
+        self._episode = None
+        self._buffer = EpisodeArrays(self._keys, self._capacity)
 
     # store the episode
     def store_episode(self, rollout):
-        if self._new_episode:
-            self._new_episode = False
-            for k in self._keys:
-                if self._current_size < self._capacity:
-                    self._buffer[k].append(rollout[k])
-                else:
-                    self._buffer[k][self._idx] = rollout[k]
+        """ Collects chunks of an episode and stores it when it is done. """
+        rollout = {k: rollout[k] for k in self._keys}
+        if self._episode is None:
+            self._episode = rollout
         else:
-            for k in self._keys:
-                self._buffer[k][self._idx].extend(rollout[k])
+            self._episode = {
+                k: concat_episode(self._episode[k], rollout[k]) for k in self._keys
+            }
 
         if rollout["done"][-1]:
+            self._buffer.set(self._idx, self._episode)
+            self._episode = None
             self._idx = (self._idx + 1) % self._capacity
             if self._current_size < self._capacity:
                 self._current_size += 1
-            self._new_episode = True
 
     # sample the data from the replay buffer
     def sample(self, batch_size):
@@ -180,11 +784,12 @@ class ReplayBufferEpisode(object):
         return transitions
 
     def state_dict(self):
-        return self._buffer
+        return self._buffer.state_dict()
 
     def load_state_dict(self, state_dict):
-        self._buffer = state_dict
-        self._current_size = len(self._buffer["ac"])
+        self._buffer.load_state_dict(state_dict)
+        self._current_size = len(self._buffer)
+        self._idx = self._current_size % self._capacity
 
 
 class RandomSampler(object):
@@ -197,22 +802,17 @@ class RandomSampler(object):
 
         episode_idxs = np.random.randint(0, rollout_batch_size, batch_size)
         t_samples = [
-            np.random.randint(len(episode_batch["ac"][episode_idx]))
+            np.random.randint(episode_length(episode_batch["ac"][episode_idx]))
             for episode_idx in episode_idxs
         ]
 
         transitions = {}
         for key in episode_batch.keys():
             transitions[key] = [
-                episode_batch[key][episode_idx][t]
+                get_item(episode_batch[key][episode_idx], t)
                 for episode_idx, t in zip(episode_idxs, t_samples)
             ]
 
-        transitions["ob_next"] = [
-            episode_batch["ob_next"][episode_idx][t]
-            for episode_idx, t in zip(episode_idxs, t_samples)
-        ]
-
         new_transitions = {}
         for k, v in transitions.items():
             if isinstance(v[0], dict):
@@ -223,119 +823,68 @@ class RandomSampler(object):
             else:
                 new_transitions[k] = np.stack(v)
 
-        for k, v in new_transitions["ob"].items():
-            if len(v.shape) in [4, 5]:
-                new_transitions["ob"][k] = random_crop(v, self._image_crop_size)
-
-        for k, v in new_transitions["ob_next"].items():
-            if len(v.shape) in [4, 5]:
-                new_transitions["ob_next"][k] = random_crop(v, self._image_crop_size)
+        augment_ob(new_transitions["ob"], self._image_crop_size)
+        augment_ob(new_transitions["ob_next"], self._image_crop_size)
 
         return new_transitions
 
+
+def _sample_steps(episode_batch, batch_size):
+    """ Returns uniformly sampled episodes and time steps of EpisodeArrays. """
+    episode_idxs = np.random.randint(0, len(episode_batch), batch_size)
+    lengths = episode_batch.length[episode_idxs]
+    t_samples = (np.random.uniform(size=batch_size) * lengths).astype(np.int64)
+    return episode_idxs, t_samples
+
+
 class SeqSampler(object):
     def __init__(self, seq_length, image_crop_size=84):
         self._seq_length = seq_length
         self._image_crop_size = image_crop_size
 
     def sample_func(self, episode_batch, batch_size_in_transitions):
-        rollout_batch_size = len(episode_batch["ac"])
+        """
+        Samples transitions from EpisodeArrays @episode_batch with the
+        following @seq_length observations of each, flattened per key in
+        "following_sequences". Sequences past the end of an episode are padded
+        with its last observation and "following_sequences_mask" is 0 there.
+        """
         batch_size = batch_size_in_transitions
+        episode_idxs, t_samples = _sample_steps(episode_batch, batch_size)
+
+        transitions = {
+            key: episode_batch.get(key, episode_idxs, t_samples)
+            for key in episode_batch.keys()
+        }
+
+        # windows of observations, clipped to the last one of each episode
+        window = t_samples[:, None] + np.arange(self._seq_length)
+        num_obs = episode_batch.size["ob"][episode_idxs][:, None]
+        sequences = episode_batch.get(
+            "ob", episode_idxs[:, None], np.minimum(window, num_obs - 1)
+        )
+        if isinstance(sequences, dict):
+            sequences = {k: v.reshape(batch_size, -1) for k, v in sequences.items()}
+        else:
+            sequences = sequences.reshape(batch_size, -1)
+        transitions["following_sequences"] = sequences
+        transitions["following_sequences_mask"] = (window < num_obs).astype(np.float32)
 
-        episode_idxs = np.random.randint(0, rollout_batch_size, batch_size)
-        t_samples = [
-            np.random.randint(len(episode_batch["ac"][episode_idx]))
-            for episode_idx in episode_idxs
-        ]
-
-        transitions = {}
-        for key in episode_batch.keys():
-            transitions[key] = [
-                episode_batch[key][episode_idx][t]
-                for episode_idx, t in zip(episode_idxs, t_samples)
-            ]
-
-        transitions["ob_next"] = [
-            episode_batch["ob_next"][episode_idx][t]
-            for episode_idx, t in zip(episode_idxs, t_samples)
-        ]
-
-        #Create a key that stores the specified future fixed length of sequences, pad last states if necessary
-
-        print(episode_idxs)
-        print(t_samples)
-
-        #List of dictionaries is created here..., flatten it out?
-        transitions["following_sequences"] = [
-            episode_batch["ob"][episode_idx][t:t+ self._seq_length]
-            for episode_idx, t in zip(episode_idxs, t_samples)
-        ]
-
-        #something's wrong here... should use index episode_idx to episode_batch, not transitions
-
-        # # Pad last states
-        # for episode_idx in episode_idxs:
-        #     # curr_ep = episode_batch["ob"][episode_idx]
-        #     # curr_ep.extend(curr_ep[-1:] * (self._seq_length - len(curr_ep)))
-        #
-        #     #all list should have 10 dictionaries now
-        #     if isinstance(transitions["following_sequences"][episode_idx], dict):
-        #         continue
-        #     transitions["following_sequences"][episode_idx].extend(transitions["following_sequences"][episode_idx][-1:] * (self._seq_length - len(transitions["following_sequences"][episode_idx])))
-        #
-        #     #turn transitions["following_sequences"] to a dictionary
-        #     fs_list = transitions["following_sequences"][episode_idx]
-        #     container = {}
-        #     container["ob"] = []
-        #     for i in fs_list:
-        #         container["ob"].extend(i["ob"])
-        #     container["ob"] = np.array(container["ob"])
-        #     transitions["following_sequences"][episode_idx] = container
-
-        # Pad last states
-        for i in range(len(transitions["following_sequences"])):
-            # curr_ep = episode_batch["ob"][episode_idx]
-            # curr_ep.extend(curr_ep[-1:] * (self._seq_length - len(curr_ep)))
-
-            #all list should have 10 dictionaries now
-            if isinstance(transitions["following_sequences"][i], dict):
-                continue
-            transitions["following_sequences"][i].extend(transitions["following_sequences"][i][-1:] * (self._seq_length - len(transitions["following_sequences"][i])))
-
-            #turn transitions["following_sequences"] to a dictionary
-            fs_list = transitions["following_sequences"][i]
-            container = {}
-            container["ob"] = []
-            for j in fs_list:
-                container["ob"].extend(j["ob"])
-            container["ob"] = np.array(container["ob"])
-            transitions["following_sequences"][i] = container
-
-
-
-        new_transitions = {}
-        for k, v in transitions.items():
-            if isinstance(v[0], dict):
-                sub_keys = v[0].keys()
-                new_transitions[k] = {
-                    sub_key: np.stack([v_[sub_key] for v_ in v]) for sub_key in sub_keys
-                }
-            else:
-                new_transitions[k] = np.stack(v)
-
-        for k, v in new_transitions["ob"].items():
-            if len(v.shape) in [4, 5]:
-                new_transitions["ob"][k] = random_crop(v, self._image_crop_size)
-
-        for k, v in new_transitions["ob_next"].items():
-            if len(v.shape) in [4, 5]:
-                new_transitions["ob_next"][k] = random_crop(v, self._image_crop_size)
+        augment_ob(transitions["ob"], self._image_crop_size)
+        augment_ob(transitions["ob_next"], self._image_crop_size)
 
-        return new_transitions
+        return transitions
 
 
 class HERSampler(object):
     def __init__(self, replay_strategy, replace_future, reward_func=None):
+        """
+        Args:
+            replay_strategy: "future" to relabel goals with future achieved goals.
+            replace_future: probability of relabeling a goal.
+            reward_func: reward_func(ag, g, info) computing rewards of batches
+                of achieved goals @ag and goals @g.
+        """
         self.replay_strategy = replay_strategy
         if self.replay_strategy == "future":
             self.future_p = replace_future
@@ -344,57 +893,37 @@ class HERSampler(object):
         self.reward_func = reward_func
 
     def sample_her_transitions(self, episode_batch, batch_size_in_transitions):
-        rollout_batch_size = len(episode_batch["ac"])
+        """
+        Samples transitions from EpisodeArrays @episode_batch whose "ob" and
+        "ag" have one more row than the transitions of an episode.
+        """
         batch_size = batch_size_in_transitions
 
         # select which rollouts and which timesteps to be used
-        episode_idxs = np.random.randint(0, rollout_batch_size, batch_size)
-        t_samples = [
-            np.random.randint(len(episode_batch["ac"][episode_idx]))
-            for episode_idx in episode_idxs
-        ]
-
-        transitions = {}
-        for key in episode_batch.keys():
-            transitions[key] = [
-                episode_batch[key][episode_idx][t]
-                for episode_idx, t in zip(episode_idxs, t_samples)
-            ]
-
-        transitions["ob_next"] = [
-            episode_batch["ob"][episode_idx][t + 1]
-            for episode_idx, t in zip(episode_idxs, t_samples)
-        ]
-        transitions["r"] = np.zeros((batch_size,))
-
-        # hindsight experience replay
-        for i, (episode_idx, t) in enumerate(zip(episode_idxs, t_samples)):
-            replace_goal = np.random.uniform() < self.future_p
-            if replace_goal:
-                future_t = np.random.randint(
-                    t + 1, len(episode_batch["ac"][episode_idx]) + 1
-                )
-                future_ag = episode_batch["ag"][episode_idx][future_t]
-                if (
-                    self.reward_func(
-                        episode_batch["ag"][episode_idx][t], future_ag, None
-                    )
-                    < 0
-                ):
-                    transitions["g"][i] = future_ag
-            transitions["r"][i] = self.reward_func(
-                episode_batch["ag"][episode_idx][t + 1], transitions["g"][i], None
-            )
-
-        new_transitions = {}
-        for k, v in transitions.items():
-            if isinstance(v[0], dict):
-                sub_keys = v[0].keys()
-                new_transitions[k] = {
-                    sub_key: np.stack([v_[sub_key] for v_ in v]) for sub_key in sub_keys
-                }
-            else:
-                new_transitions[k] = np.stack(v)
-
-        return new_transitions
+        episode_idxs, t_samples = _sample_steps(episode_batch, batch_size)
+        lengths = episode_batch.length[episode_idxs]
+
+        transitions = {
+            key: episode_batch.get(key, episode_idxs, t_samples)
+            for key in episode_batch.keys()
+        }
+        transitions["ob_next"] = episode_batch.get("ob", episode_idxs, t_samples + 1)
+
+        # hindsight experience replay with goals achieved in [t + 1, T]
+        future_t = t_samples + 1
+        future_t += (np.random.uniform(size=batch_size) * (lengths - t_samples)).astype(
+            np.int64
+        )
+        future_ag = episode_batch.get("ag", episode_idxs, future_t)
+        replace_goal = np.random.uniform(size=batch_size) < self.future_p
+        # do not relabel goals that are already achieved
+        rew = self.reward_func(transitions["ag"], future_ag, None)
+        replace_goal &= np.reshape(rew, batch_size) < 0
+        transitions["g"][replace_goal] = future_ag[replace_goal]
+
+        ag_next = episode_batch.get("ag", episode_idxs, t_samples + 1)
+        transitions["r"] = np.asarray(
+            self.reward_func(ag_next, transitions["g"], None), dtype=np.float32
+        ).reshape(batch_size)
 
+        return transitions
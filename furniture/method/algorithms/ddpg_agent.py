@@ -1,29 +1,50 @@
 import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 import torch.optim as optim
 import gym.spaces
 from torch.optim.lr_scheduler import StepLR
 
 from .base_agent import BaseAgent
-from .dataset import ReplayBuffer, RandomSampler
+from .dataset import RandomSampler
 from ..networks import Actor, Critic
-from ..utils.info_dict import Info
+from ..utils.info_dict import DeviceInfo
 from ..utils.logger import logger
-from ..utils.mpi import mpi_average
 from ..utils.pytorch import (
     optimizer_cuda,
     count_parameters,
     compute_gradient_norm,
     compute_weight_norm,
     sync_networks,
-    sync_grads,
     to_tensor,
+    weighted_mse_loss,
+    PolyakAverager,
     scale_dict_tensor,
 )
 
 
+def add_exploration_noise(config, ac_space, ac):
+    """
+    Adds Gaussian exploration noise and epsilon-greedy random actions to a
+    batch of actions @ac in place and returns @ac.
+    """
+    for k, v in ac_space.spaces.items():
+        if isinstance(v, gym.spaces.Box):
+            ac[k] += config.policy_exploration_noise * np.random.randn(*ac[k].shape)
+            ac[k] = np.clip(ac[k], v.low, v.high)
+
+    if config.epsilon_greedy:
+        batch_size = len(next(iter(ac.values())))
+        random_idx = np.where(
+            np.random.uniform(size=batch_size) < config.epsilon_greedy_eps
+        )[0]
+        for k, v in ac_space.spaces.items():
+            for i in random_idx:
+                ac[k][i] = v.sample()
+
+    return ac
+
+
 class DDPGAgent(BaseAgent):
     def __init__(self, config, ob_space, ac_space, env_ob_space):
         super().__init__(config, ob_space)
@@ -44,6 +65,29 @@ class DDPGAgent(BaseAgent):
         self._actor.encoder.copy_conv_weights_from(self._critic.encoder)
         self._actor_target.encoder.copy_conv_weights_from(self._critic_target.encoder)
 
+        # polyak averaging of target networks
+        self._critic_target_averager = PolyakAverager()
+        self._critic_target_averager.add(
+            self._critic_target.fcs, self._critic.fcs, config.critic_soft_update_weight
+        )
+        self._critic_target_averager.add(
+            self._critic_target.encoder,
+            self._critic.encoder,
+            config.encoder_soft_update_weight,
+        )
+        self._actor_target_averager = PolyakAverager()
+        self._actor_target_averager.add(
+            self._actor_target.fc, self._actor.fc, config.actor_soft_update_weight
+        )
+        self._actor_target_averager.add(
+            self._actor_target.fcs, self._actor.fcs, config.actor_soft_update_weight
+        )
+        self._actor_target_averager.add(
+            self._actor_target.encoder,
+            self._actor.encoder,
+            config.encoder_soft_update_weight,
+        )
+
         # build optimizers
         self._actor_optim = optim.Adam(self._actor.parameters(), lr=config.actor_lr)
         self._critic_optim = optim.Adam(self._critic.parameters(), lr=config.critic_lr)
@@ -56,9 +100,7 @@ class DDPGAgent(BaseAgent):
         # per-episode replay buffer
         sampler = RandomSampler(image_crop_size=config.encoder_image_size)
         buffer_keys = ["ob", "ob_next", "ac", "done", "done_mask", "rew"]
-        self._buffer = ReplayBuffer(
-            buffer_keys, config.buffer_size, sampler.sample_func
-        )
+        self._buffer = self._create_replay_buffer(buffer_keys, sampler.sample_func)
 
         self._update_iter = 0
         self._predict_reward = None
@@ -93,6 +135,15 @@ class DDPGAgent(BaseAgent):
 
         return ac, activation
 
+    def batch_act(self, obs, is_train=True):
+        """ Returns actions and activations for a batch of observations @obs. """
+        ac, activation = super().batch_act(obs, is_train=is_train)
+
+        if not is_train:
+            return ac, activation
+
+        return add_exploration_noise(self._config, self._ac_space, ac), activation
+
     def store_episode(self, rollouts):
         self._buffer.store_episode(rollouts)
 
@@ -141,7 +192,7 @@ class DDPGAgent(BaseAgent):
         sync_networks(self._critic_target)
 
     def train(self):
-        train_info = Info()
+        train_info = DeviceInfo()
 
         self._num_updates = 1
         for _ in range(self._num_updates):
@@ -149,141 +200,154 @@ class DDPGAgent(BaseAgent):
             transitions = self._buffer.sample(self._config.batch_size)
             train_info.add(self._update_network(transitions))
 
-        return train_info.get_dict()
+        return train_info
 
     def _update_actor(self, o, mask):
-        info = Info()
+        info = DeviceInfo()
 
-        # the actor loss
-        actions_real, _, _, _ = self._actor.act(
-            o, return_log_prob=False, detach_conv=True
-        )
+        with self._autocast():
+            # the actor loss
+            actions_real, _, _, _ = self._actor.act(
+                o, return_log_prob=False, detach_conv=True
+            )
 
-        q_pred = self._critic(o, actions_real, detach_conv=True)
-        if self._config.critic_ensemble > 1:
-            q_pred = q_pred[0]
+            q_pred = self._critic(o, actions_real, detach_conv=True)
+            if self._config.critic_ensemble > 1:
+                q_pred = q_pred[0]
+            q_pred = q_pred.float()
 
         if self._config.absorbing_state:
             # do not update the actor for absorbing states
             a_mask = 1.0 - torch.clamp(-mask, min=0)  # 0 absorbing, 1 done/not done
-            actor_loss = -(q_pred * a_mask).sum()
-            if a_mask.sum() > 1e-8:
-                actor_loss /= a_mask.sum()
+            actor_loss = -(q_pred * a_mask).sum() / a_mask.sum().clamp(min=1.0)
         else:
             actor_loss = -q_pred.mean()
-        info["actor_loss"] = actor_loss.cpu().item()
+        info["actor_loss"] = actor_loss.detach()
 
         # update the actor
-        self._actor_optim.zero_grad()
-        actor_loss.backward()
-        if self._config.max_grad_norm:
-            torch.nn.utils.clip_grad_norm_(
-                self._actor.parameters(), self._config.max_grad_norm
-            )
-        sync_grads(self._actor)
-        self._actor_optim.step()
+        self._optimizer_step(
+            actor_loss, self._actor_optim, self._actor, self._config.max_grad_norm
+        )
 
         return info
 
-    def _update_critic(self, o, ac, rew, o_next, mask):
-        info = Info()
+    def _update_critic(self, o, ac, rew, o_next, mask, weights=None, idxs=None):
+        """
+        Updates the critics. With prioritized replay, @weights are the
+        importance-sampling weights of the batch and the priorities of
+        transitions @idxs are set to their TD errors.
+        """
+        info = DeviceInfo()
+
+        with self._autocast():
+            # calculate the target Q value function
+            with torch.no_grad():
+                actions_next, _, _, _ = self._actor_target.act(
+                    o_next, return_log_prob=False
+                )
+
+                # TD3 adds noise to action
+                if self._config.critic_ensemble > 1:
+                    for k in self._ac_space.spaces.keys():
+                        noise = (
+                            torch.randn_like(actions_next[k])
+                            * self._config.policy_noise
+                        ).clamp(
+                            -self._config.policy_noise_clip,
+                            self._config.policy_noise_clip,
+                        )
+                        actions_next[k] = (actions_next[k] + noise).clamp(-1, 1)
+
+                    if self._config.absorbing_state:
+                        # 0 absorbing/done, 1 not done
+                        a_mask = torch.clamp(mask, min=0)
+                        masked_actions_next = scale_dict_tensor(actions_next, a_mask)
+                        q_next_values = self._critic_target(o_next, masked_actions_next)
+                    else:
+                        q_next_values = self._critic_target(o_next, actions_next)
+
+                    q_next_value = torch.min(*q_next_values)
 
-        # calculate the target Q value function
-        with torch.no_grad():
-            actions_next, _, _, _ = self._actor_target.act(
-                o_next, return_log_prob=False
-            )
+                else:
+                    q_next_value = self._critic_target(o_next, actions_next)
 
-            # TD3 adds noise to action
-            if self._config.critic_ensemble > 1:
-                for k in self._ac_space.spaces.keys():
-                    noise = (
-                        torch.randn_like(actions_next[k]) * self._config.policy_noise
-                    ).clamp(
-                        -self._config.policy_noise_clip, self._config.policy_noise_clip
-                    )
-                    actions_next[k] = (actions_next[k] + noise).clamp(-1, 1)
+                # For IL, use IL reward
+                if self._predict_reward is not None:
+                    rew_il = self._predict_reward(o, ac)
+                    rew = (
+                        1 - self._config.gail_env_reward
+                    ) * rew_il + self._config.gail_env_reward * rew
 
                 if self._config.absorbing_state:
-                    a_mask = torch.clamp(mask, min=0)  # 0 absorbing/done, 1 not done
-                    masked_actions_next = scale_dict_tensor(actions_next, a_mask)
-                    q_next_values = self._critic_target(o_next, masked_actions_next)
+                    target_q_value = (
+                        rew + self._config.rl_discount_factor * q_next_value
+                    )
                 else:
-                    q_next_values = self._critic_target(o_next, actions_next)
-
-                q_next_value = torch.min(*q_next_values)
+                    target_q_value = (
+                        rew + mask * self._config.rl_discount_factor * q_next_value
+                    )
 
+            # the q loss
+            if self._config.critic_ensemble == 1:
+                real_q_value = self._critic(o, ac)
+                critic_loss = weighted_mse_loss(real_q_value, target_q_value, weights)
+                td_error = (target_q_value - real_q_value).abs()
             else:
-                q_next_value = self._critic_target(o_next, actions_next)
-
-            # For IL, use IL reward
-            if self._predict_reward is not None:
-                rew_il = self._predict_reward(o, ac)
-                rew = (
-                    1 - self._config.gail_env_reward
-                ) * rew_il + self._config.gail_env_reward * rew
-
-            if self._config.absorbing_state:
-                target_q_value = (
-                    rew + self._config.rl_discount_factor * q_next_value
-                )
-            else:
-                target_q_value = (
-                    rew + mask * self._config.rl_discount_factor * q_next_value
-                )
-
-        # the q loss
-        if self._config.critic_ensemble == 1:
-            real_q_value = self._critic(o, ac)
-            critic_loss = F.mse_loss(target_q_value, real_q_value)
-        else:
-            real_q_value1, real_q_value2 = self._critic(o, ac)
-            critic1_loss = F.mse_loss(target_q_value, real_q_value1)
-            critic2_loss = F.mse_loss(target_q_value, real_q_value2)
-            critic_loss = critic1_loss + critic2_loss
+                real_q_value1, real_q_value2 = self._critic(o, ac)
+                critic1_loss = weighted_mse_loss(real_q_value1, target_q_value, weights)
+                critic2_loss = weighted_mse_loss(real_q_value2, target_q_value, weights)
+                critic_loss = critic1_loss + critic2_loss
+                td_error = (
+                    (target_q_value - real_q_value1).abs()
+                    + (target_q_value - real_q_value2).abs()
+                ) / 2
 
         # update the critic
-        self._critic_optim.zero_grad()
-        critic_loss.backward()
-        sync_grads(self._critic)
-        self._critic_optim.step()
+        self._optimizer_step(critic_loss, self._critic_optim, self._critic)
 
-        info["min_target_q"] = target_q_value.min().cpu().item()
-        info["target_q"] = target_q_value.mean().cpu().item()
+        if idxs is not None:
+            self._buffer.update_priorities(idxs, td_error.detach().cpu().numpy())
+
+        info["min_target_q"] = target_q_value.min().detach()
+        info["target_q"] = target_q_value.mean().detach()
 
         if self._config.critic_ensemble == 1:
-            info["min_real1_q"] = real_q_value.min().cpu().item()
-            info["real1_q"] = real_q_value.mean().cpu().item()
-            info["critic1_loss"] = critic_loss.cpu().item()
+            info["min_real1_q"] = real_q_value.min().detach()
+            info["real1_q"] = real_q_value.mean().detach()
+            info["critic1_loss"] = critic_loss.detach()
         else:
-            info["min_real1_q"] = real_q_value1.min().cpu().item()
-            info["min_real2_q"] = real_q_value2.min().cpu().item()
-            info["real1_q"] = real_q_value1.mean().cpu().item()
-            info["real2_q"] = real_q_value2.mean().cpu().item()
-            info["critic1_loss"] = critic1_loss.cpu().item()
-            info["critic2_loss"] = critic2_loss.cpu().item()
+            info["min_real1_q"] = real_q_value1.min().detach()
+            info["min_real2_q"] = real_q_value2.min().detach()
+            info["real1_q"] = real_q_value1.mean().detach()
+            info["real2_q"] = real_q_value2.mean().detach()
+            info["critic1_loss"] = critic1_loss.detach()
+            info["critic2_loss"] = critic2_loss.detach()
 
         return info
 
     def _update_network(self, transitions):
-        info = Info()
+        info = DeviceInfo()
 
         # pre-process the observation
         o, o_next = transitions["ob"], transitions["ob_next"]
-        o = self.normalize(o)
-        o_next = self.normalize(o_next)
         bs = len(transitions["done"])
 
         _to_tensor = lambda x: to_tensor(x, self._config.device)
-        o = _to_tensor(o)
-        o_next = _to_tensor(o_next)
+        o = self.normalize(_to_tensor(o))
+        o_next = self.normalize(_to_tensor(o_next))
         ac = _to_tensor(transitions["ac"])
         mask = _to_tensor(transitions["done_mask"]).reshape(bs, 1)
         rew = _to_tensor(transitions["rew"]).reshape(bs, 1)
+        weights = idxs = None
+        if "weights" in transitions:
+            weights = _to_tensor(transitions["weights"]).reshape(bs, 1)
+            idxs = transitions["idxs"]
 
         self._update_iter += 1
 
-        critic_train_info = self._update_critic(o, ac, rew, o_next, mask)
+        critic_train_info = self._update_critic(
+            o, ac, rew, o_next, mask, weights, idxs
+        )
         info.add(critic_train_info)
 
         if (
@@ -294,37 +358,12 @@ class DDPGAgent(BaseAgent):
             info.add(actor_train_info)
 
         if self._update_iter % self._config.critic_target_update_freq == 0:
-            for i, fc in enumerate(self._critic.fcs):
-                self._soft_update_target_network(
-                    self._critic_target.fcs[i],
-                    fc,
-                    self._config.critic_soft_update_weight,
-                )
-            self._soft_update_target_network(
-                self._critic_target.encoder,
-                self._critic.encoder,
-                self._config.encoder_soft_update_weight,
-            )
+            self._critic_target_averager.update()
 
         if (
             self._update_iter % self._config.actor_target_update_freq == 0
             and self._update_iter > self._config.actor_update_delay
         ):
-            self._soft_update_target_network(
-                self._actor_target.fc,
-                self._actor.fc,
-                self._config.actor_soft_update_weight,
-            )
-            for k, fc in self._actor.fcs.items():
-                self._soft_update_target_network(
-                    self._actor_target.fcs[k],
-                    fc,
-                    self._config.actor_soft_update_weight,
-                )
-            self._soft_update_target_network(
-                self._actor_target.encoder,
-                self._actor.encoder,
-                self._config.encoder_soft_update_weight,
-            )
+            self._actor_target_averager.update()
 
-        return info.get_dict(only_scalar=True)
+        return info
@@ -1,18 +1,75 @@
 import os
 import pickle
 import glob
+from collections import OrderedDict
 
 import torch
 from torch.utils.data import Dataset
 import numpy as np
 import gym.spaces
 
+from .dataset import episode_length, get_item, get_tensor_batch, slice_buffer, stack_tensor
 from ..utils.logger import logger
-from ..utils.gym_env import get_non_absorbing_state, get_absorbing_state, zero_value
+from ..utils.gym_env import get_absorbing_state, zero_value
+
+
+def _map(func, x):
+    """ Applies @func to the arrays or tensors of (nested dicts) @x. """
+    if isinstance(x, dict):
+        return OrderedDict([(k, _map(func, v)) for k, v in x.items()])
+    return func(x)
+
+
+def _leaves(x):
+    if isinstance(x, dict):
+        return [leaf for v in x.values() for leaf in _leaves(v)]
+    return [x]
+
+
+def _stack(values):
+    """ Stacks a list of arrays (or of dicts of arrays) into columnar arrays. """
+    if isinstance(values[0], dict):
+        return OrderedDict([(k, _stack([v[k] for v in values])) for k in values[0]])
+    return np.stack(values)
+
+
+def _concat(buffers):
+    """ Concatenates a list of columnar (nested dicts of) arrays. """
+    if isinstance(buffers[0], dict):
+        return OrderedDict([(k, _concat([b[k] for b in buffers])) for k in buffers[0]])
+    return np.concatenate(buffers)
+
+
+def _insert(buffer, idxs, value):
+    """ Inserts the item @value before each of the rows @idxs of @buffer. """
+    if isinstance(buffer, dict):
+        return OrderedDict([(k, _insert(v, idxs, value[k])) for k, v in buffer.items()])
+    value = np.asarray(value, dtype=buffer.dtype)
+    value = np.broadcast_to(value, (len(idxs),) + buffer.shape[1:])
+    return np.insert(buffer, idxs, value, axis=0)
+
+
+def _unflatten_actions(space, actions):
+    """ Splits flat @actions of shape (N, flatdim) into the structure of @space. """
+    if isinstance(space, gym.spaces.Dict):
+        ret = OrderedDict()
+        i = 0
+        for k, s in space.spaces.items():
+            n = gym.spaces.flatdim(s)
+            ret[k] = _unflatten_actions(s, actions[:, i : i + n])
+            i += n
+        return ret
+    if isinstance(space, gym.spaces.Box):
+        return actions.astype(space.dtype).reshape((len(actions),) + space.shape)
+    return np.stack([gym.spaces.unflatten(space, ac) for ac in actions])
 
 
 class ExpertDataset(Dataset):
-    """ Dataset class for Imitation Learning. """
+    """
+    Dataset class for Imitation Learning. Transitions are stored as columnar
+    (nested dicts of) arrays, and to_tensors() turns them into tensors once
+    for ExpertDataLoader.
+    """
 
     def __init__(
         self,
@@ -29,7 +86,8 @@ class ExpertDataset(Dataset):
     ):
         self.train = train  # training set or test set
 
-        self._data = []
+        self._buffer = {}
+        self._tensors = None
         self._ac_space = ac_space
 
         assert (
@@ -37,6 +95,12 @@ class ExpertDataset(Dataset):
         ), "--demo_path should be set (e.g. demos/Sawyer_toy_table)"
         demo_files = self._get_demo_files(path)
         num_demos = 0
+        buffers = []
+
+        if use_low_level:
+            ob_key, ac_key = "low_level_obs", "low_level_actions"
+        else:
+            ob_key, ac_key = "obs", "actions"
 
         # now load the picked numpy arrays
         for file_path in demo_files:
@@ -58,88 +122,115 @@ class ExpertDataset(Dataset):
                     offset = np.random.randint(0, subsample_interval)
                     num_demos += 1
 
-                    if use_low_level:
-                        length = len(demo["low_level_actions"])
-                        start = int(length * sample_range_start)
-                        end = int(length * sample_range_end)
-                        for i in range(start + offset, end, subsample_interval):
-                            transition = {
-                                "ob": demo["low_level_obs"][i],
-                                "ob_next": demo["low_level_obs"][i + 1],
-                            }
-                            if isinstance(demo["low_level_actions"][i], dict):
-                                transition["ac"] = demo["low_level_actions"][i]
-                            else:
-                                transition["ac"] = gym.spaces.unflatten(
-                                    ac_space, demo["low_level_actions"][i]
-                                )
-
-                            transition["done"] = 1 if i + 1 == length else 0
-
-                            self._data.append(transition)
-
-                        continue
-
-                    length = len(demo["actions"])
+                    length = len(demo[ac_key])
                     start = int(length * sample_range_start)
                     end = int(length * sample_range_end)
-                    for i in range(start + offset, end, subsample_interval):
-                        transition = {
-                            "ob": demo["obs"][i],
-                            "ob_next": demo["obs"][i + 1],
-                        }
-                        if isinstance(demo["actions"][i], dict):
-                            transition["ac"] = demo["actions"][i]
-                        else:
-                            transition["ac"] = gym.spaces.unflatten(
-                                ac_space, demo["actions"][i]
-                            )
-                        if "rewards" in demo:
-                            transition["rew"] = demo["rewards"][i]
-                        if "dones" in demo:
-                            transition["done"] = int(demo["dones"][i])
-                        else:
-                            transition["done"] = 1 if i + 1 == length else 0
-
-                        self._data.append(transition)
+                    idxs = np.arange(start + offset, end, subsample_interval)
+                    if len(idxs) == 0:
+                        continue
+
+                    obs = _stack(demo[ob_key])
+                    transitions = OrderedDict(
+                        [
+                            ("ob", slice_buffer(obs, idxs)),
+                            ("ob_next", slice_buffer(obs, idxs + 1)),
+                        ]
+                    )
+                    if isinstance(demo[ac_key][0], dict):
+                        transitions["ac"] = slice_buffer(_stack(demo[ac_key]), idxs)
+                    else:
+                        transitions["ac"] = _unflatten_actions(
+                            ac_space, np.asarray(demo[ac_key])[idxs]
+                        )
+                    if not use_low_level and "rewards" in demo:
+                        transitions["rew"] = np.asarray(demo["rewards"])[idxs]
+                    if not use_low_level and "dones" in demo:
+                        transitions["done"] = np.asarray(demo["dones"])[idxs].astype(
+                            np.int64
+                        )
+                    else:
+                        transitions["done"] = (idxs + 1 == length).astype(np.int64)
+
+                    buffers.append(transitions)
+
+        if buffers:
+            self._buffer = _concat(buffers)
 
         logger.warn(
             "Load %d demonstrations with %d states from %d files",
             num_demos,
-            len(self._data),
+            len(self),
             len(demo_files),
         )
 
+    @property
+    def buffer(self):
+        """ Columnar (nested dicts of) arrays of all transitions. """
+        return self._buffer
+
     def add_absorbing_states(self, ob_space, ac_space):
-        new_data = []
         absorbing_state = get_absorbing_state(ob_space)
         absorbing_action = zero_value(ac_space, dtype=np.float32)
-        for i in range(len(self._data)):
-            transition = self._data[i].copy()
-            transition["ob"] = get_non_absorbing_state(self._data[i]["ob"])
-            # learn reward for the last transition regardless of timeout (different from paper)
-            if self._data[i]["done"]:
-                transition["ob_next"] = absorbing_state
-                transition["done_mask"] = 0  # -1 absorbing, 0 done, 1 not done
-            else:
-                transition["ob_next"] = get_non_absorbing_state(
-                    self._data[i]["ob_next"]
-                )
-                transition["done_mask"] = 1  # -1 absorbing, 0 done, 1 not done
-            new_data.append(transition)
-
-            if self._data[i]["done"]:
-                transition = {
-                    "ob": absorbing_state,
-                    "ob_next": absorbing_state,
-                    "ac": absorbing_action,
-                    # "rew": np.float64(0.0),
-                    "done": 0,
-                    "done_mask": -1,  # -1 absorbing, 0 done, 1 not done
-                }
-                new_data.append(transition)
-
-        self._data = new_data
+        done = self._buffer["done"].astype(bool)
+        done_idxs = np.flatnonzero(done)
+
+        def non_absorbing(ob):
+            ob = OrderedDict(ob)
+            ob["absorbing_state"] = np.zeros((len(done), 1), dtype=np.float32)
+            return ob
+
+        transitions = OrderedDict(
+            [
+                ("ob", non_absorbing(self._buffer["ob"])),
+                ("ob_next", non_absorbing(self._buffer["ob_next"])),
+                ("ac", self._buffer["ac"]),
+                ("done", self._buffer["done"]),
+                # -1 absorbing, 0 done, 1 not done
+                ("done_mask", (~done).astype(np.int64)),
+            ]
+        )
+        # learn reward for the last transition regardless of timeout (different from paper)
+        for k, v in transitions["ob_next"].items():
+            v[done_idxs] = absorbing_state[k]
+
+        absorbing_transition = {
+            "ob": absorbing_state,
+            "ob_next": absorbing_state,
+            "ac": absorbing_action,
+            "done": 0,
+            "done_mask": -1,  # -1 absorbing, 0 done, 1 not done
+        }
+        if "rew" in self._buffer:
+            transitions["rew"] = self._buffer["rew"]
+            absorbing_transition["rew"] = 0
+
+        # an absorbing transition follows every last transition
+        self._buffer = _insert(transitions, done_idxs + 1, absorbing_transition)
+        self._tensors = None
+
+    def to_tensors(self, device, max_device_memory=0.5):
+        """
+        Returns the transitions as contiguous tensors, created on the first
+        call. They are kept on @device if they take at most
+        @max_device_memory of its free memory, and in pinned host memory
+        otherwise.
+        """
+        if self._tensors is None:
+            device = torch.device(device)
+            tensors = stack_tensor(self._buffer, "cpu")
+            if device.type == "cuda":
+                size = sum(t.numel() * t.element_size() for t in _leaves(tensors))
+                free, _ = torch.cuda.mem_get_info(device)
+                if size <= max_device_memory * free:
+                    tensors = _map(lambda t: t.to(device), tensors)
+                else:
+                    logger.warn(
+                        "Keep expert dataset (%.1f GB) in pinned host memory",
+                        size / 1e9,
+                    )
+                    tensors = _map(lambda t: t.pin_memory(), tensors)
+            self._tensors = tensors
+        return self._tensors
 
     def _get_demo_files(self, demo_file_path):
         demos = []
@@ -155,9 +246,94 @@ class ExpertDataset(Dataset):
         Args:
             index (int): Index
         Returns:
-            tuple: (ob, ac) where target is index of the target class.
+            dict: transition with ob, ob_next, ac and done.
         """
-        return self._data[index]
+        return get_item(self._buffer, index)
 
     def __len__(self):
-        return len(self._data)
+        if not self._buffer:
+            return 0
+        return episode_length(self._buffer)
+
+
+class ExpertDataLoader(object):
+    """
+    Batches of an ExpertDataset gathered by indexing its tensors (see
+    ExpertDataset.to_tensors) instead of collating transitions in Python.
+    Iterating goes over one epoch, and sample() continues an endless sequence
+    of epochs.
+    """
+
+    def __init__(
+        self, dataset, batch_size, device, shuffle=True, drop_last=False, indices=None
+    ):
+        """
+        Args:
+            dataset: ExpertDataset.
+            batch_size: number of transitions in a batch.
+            device: device of batches.
+            shuffle: whether to visit transitions in random order.
+            drop_last: whether to skip the last incomplete batch of an epoch.
+            indices: transitions to sample from (all by default).
+        """
+        self._batch_size = batch_size
+        self._device = torch.device(device)
+        self._shuffle = shuffle
+        self._drop_last = drop_last
+
+        self._tensors = dataset.to_tensors(device)
+        example = _leaves(self._tensors)[0]
+        # batches of pinned tensors are gathered on the host and copied
+        self._pinned = example.is_pinned()
+        if indices is None:
+            indices = np.arange(len(dataset))
+        self._indices = torch.as_tensor(
+            np.asarray(indices), dtype=torch.long, device=example.device
+        )
+        self._order = None
+        self._pos = 0
+
+    def __len__(self):
+        """ Returns the number of batches of an epoch. """
+        if self._drop_last:
+            return len(self._indices) // self._batch_size
+        return -(-len(self._indices) // self._batch_size)
+
+    def _epoch_order(self):
+        if self._shuffle:
+            perm = torch.randperm(len(self._indices), device=self._indices.device)
+            return self._indices[perm]
+        return self._indices
+
+    def _get_batch(self, idxs):
+        if not self._pinned:
+            return get_tensor_batch(self._tensors, idxs)
+
+        def gather(t):
+            batch = torch.empty(
+                (len(idxs),) + t.shape[1:], dtype=t.dtype, pin_memory=True
+            )
+            torch.index_select(t, 0, idxs, out=batch)
+            batch = batch.to(self._device, non_blocking=True)
+            return batch.float() if batch.dtype == torch.uint8 else batch
+
+        return _map(gather, self._tensors)
+
+    def __iter__(self):
+        order = self._epoch_order()
+        for i in range(len(self)):
+            yield self._get_batch(order[i * self._batch_size : (i + 1) * self._batch_size])
+
+    def sample(self, batch_size=None):
+        """
+        Returns the next @batch_size transitions of the current epoch and
+        starts a new epoch when it has fewer left.
+        """
+        batch_size = batch_size or self._batch_size
+        assert batch_size <= len(self._indices)
+        if self._order is None or self._pos + batch_size > len(self._order):
+            self._order = self._epoch_order()
+            self._pos = 0
+        idxs = self._order[self._pos : self._pos + batch_size]
+        self._pos += batch_size
+        return self._get_batch(idxs)
@@ -11,16 +11,14 @@ from torch.optim.lr_scheduler import StepLR
 from .base_agent import BaseAgent
 from .ppo_agent import PPOAgent
 from .dataset import ReplayBuffer, RandomSampler
-from .expert_dataset import ExpertDataset
+from .expert_dataset import ExpertDataset, ExpertDataLoader
 from ..networks.discriminator import Discriminator
-from ..utils.info_dict import Info
+from ..utils.info_dict import DeviceInfo
 from ..utils.logger import logger
-from ..utils.mpi import mpi_average
 from ..utils.pytorch import (
     optimizer_cuda,
     count_parameters,
     sync_networks,
-    sync_grads,
     to_tensor,
 )
 
@@ -65,13 +63,13 @@ class GAILAgent(BaseAgent):
                 sample_range_start=config.demo_sample_range_start,
                 sample_range_end=config.demo_sample_range_end,
             )
-            self._data_loader = torch.utils.data.DataLoader(
+            self._data_loader = ExpertDataLoader(
                 self._dataset,
-                batch_size=self._config.batch_size,
+                self._config.batch_size,
+                config.device,
                 shuffle=True,
                 drop_last=True,
             )
-            self._data_iter = iter(self._data_loader)
 
         # policy dataset
         sampler = RandomSampler()
@@ -113,15 +111,18 @@ class GAILAgent(BaseAgent):
         return reward
 
     def predict_reward(self, ob, ac=None):
-        ob = self.normalize(ob)
-        ob = to_tensor(ob, self._config.device)
+        return self.predict_rewards(ob, ac).item()
+
+    def predict_rewards(self, obs, acs=None):
+        """ Returns an array of rewards of batches of observations and actions. """
+        obs = self.normalize(to_tensor(obs, self._config.device))
         if self._config.gail_no_action:
-            ac = None
-        if ac is not None:
-            ac = to_tensor(ac, self._config.device)
+            acs = None
+        if acs is not None:
+            acs = to_tensor(acs, self._config.device)
 
-        reward = self._predict_reward(ob, ac)
-        return reward.cpu().item()
+        reward = self._predict_reward(obs, acs)
+        return reward.cpu().numpy().reshape(-1)
 
     def _log_creation(self):
         if self._config.is_chef:
@@ -170,21 +171,12 @@ class GAILAgent(BaseAgent):
         """ Updates normalizers for discriminator and PPO agent. """
         if self._config.ob_norm:
             if obs is None:
-                data_loader = torch.utils.data.DataLoader(
-                    self._dataset,
-                    batch_size=self._config.batch_size,
-                    shuffle=False,
-                    drop_last=False,
-                )
-                for obs in data_loader:
-                    super().update_normalizer(obs)
-                    self._rl_agent.update_normalizer(obs)
-            else:
-                super().update_normalizer(obs)
-                self._rl_agent.update_normalizer(obs)
+                obs = self._dataset.buffer["ob"]
+            super().update_normalizer(obs)
+            self._rl_agent.update_normalizer(obs)
 
     def train(self):
-        train_info = Info()
+        train_info = DeviceInfo()
 
         self._discriminator_lr_scheduler.step()
 
@@ -196,11 +188,7 @@ class GAILAgent(BaseAgent):
         assert num_batches > 0
         for _ in range(num_batches):
             policy_data = self._buffer.sample(self._config.batch_size)
-            try:
-                expert_data = next(self._data_iter)
-            except StopIteration:
-                self._data_iter = iter(self._data_loader)
-                expert_data = next(self._data_iter)
+            expert_data = self._data_loader.sample()
 
             _train_info = self._update_discriminator(policy_data, expert_data)
             train_info.add(_train_info)
@@ -208,28 +196,22 @@ class GAILAgent(BaseAgent):
         _train_info = self._rl_agent.train()
         train_info.add(_train_info)
 
-        for _ in range(num_batches):
-            try:
-                expert_data = next(self._data_iter)
-            except StopIteration:
-                self._data_iter = iter(self._data_loader)
-                expert_data = next(self._data_iter)
-            self.update_normalizer(expert_data["ob"])
+        # one normalizer update with as many expert transitions as batches
+        expert_data = self._data_loader.sample(num_batches * self._config.batch_size)
+        self.update_normalizer(expert_data["ob"])
 
-        return train_info.get_dict(only_scalar=True)
+        return train_info
 
     def _update_discriminator(self, policy_data, expert_data):
-        info = Info()
+        info = DeviceInfo()
 
         _to_tensor = lambda x: to_tensor(x, self._config.device)
         # pre-process observations
         p_o = policy_data["ob"]
-        p_o = self.normalize(p_o)
-        p_o = _to_tensor(p_o)
+        p_o = self.normalize(_to_tensor(p_o))
 
         e_o = expert_data["ob"]
-        e_o = self.normalize(e_o)
-        e_o = _to_tensor(e_o)
+        e_o = self.normalize(_to_tensor(e_o))
 
         if self._config.gail_no_action:
             p_ac = None
@@ -238,8 +220,9 @@ class GAILAgent(BaseAgent):
             p_ac = _to_tensor(policy_data["ac"])
             e_ac = _to_tensor(expert_data["ac"])
 
-        p_logit = self._discriminator(p_o, p_ac)
-        e_logit = self._discriminator(e_o, e_ac)
+        with self._autocast():
+            p_logit = self._discriminator(p_o, p_ac).float()
+            e_logit = self._discriminator(e_o, e_ac).float()
 
         p_output = torch.sigmoid(p_logit)
         e_output = torch.sigmoid(e_logit)
@@ -261,22 +244,19 @@ class GAILAgent(BaseAgent):
         gail_loss = p_loss + e_loss + entropy_loss + grad_pen_loss
 
         # update the discriminator
-        self._discriminator.zero_grad()
-        gail_loss.backward()
-        sync_grads(self._discriminator)
-        self._discriminator_optim.step()
-
-        info["gail_policy_output"] = p_output.mean().detach().cpu().item()
-        info["gail_expert_output"] = e_output.mean().detach().cpu().item()
-        info["gail_entropy"] = entropy.detach().cpu().item()
-        info["gail_policy_loss"] = p_loss.detach().cpu().item()
-        info["gail_expert_loss"] = e_loss.detach().cpu().item()
-        info["gail_entropy_loss"] = entropy_loss.detach().cpu().item()
-        info["gail_grad_pen"] = grad_pen.detach().cpu().item()
-        info["gail_grad_loss"] = grad_pen_loss.detach().cpu().item()
-        info["gail_loss"] = gail_loss.detach().cpu().item()
-
-        return mpi_average(info.get_dict(only_scalar=True))
+        self._optimizer_step(gail_loss, self._discriminator_optim, self._discriminator)
+
+        info["gail_policy_output"] = p_output.mean().detach()
+        info["gail_expert_output"] = e_output.mean().detach()
+        info["gail_entropy"] = entropy.detach()
+        info["gail_policy_loss"] = p_loss.detach()
+        info["gail_expert_loss"] = e_loss.detach()
+        info["gail_entropy_loss"] = entropy_loss.detach()
+        info["gail_grad_pen"] = grad_pen.detach()
+        info["gail_grad_loss"] = grad_pen_loss.detach()
+        info["gail_loss"] = gail_loss.detach()
+
+        return info
 
     def _compute_grad_pen(self, policy_ob, policy_ac, expert_ob, expert_ac):
         batch_size = self._config.batch_size
@@ -0,0 +1,197 @@
+""" Low-overhead actor inference for environment rollouts. """
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from ..utils.logger import logger
+
+
+# inference_mode is available from torch 1.9
+_inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
+class _NormalizedActor(nn.Module):
+    """
+    Applies observation normalization on the device and samples actions from
+    @actor. Statistics are buffers that are updated in place, so a compiled
+    copy of this module follows normalizer updates.
+    """
+
+    def __init__(self, actor, keys, clip_obs, clip_range):
+        super().__init__()
+        self._actor = actor
+        self._keys = keys
+        self._clip_obs = float(clip_obs)
+        self._clip_range = float(clip_range)
+        for k in keys:
+            self.register_buffer("mean_" + k, None)
+            self.register_buffer("std_" + k, None)
+
+    def forward(self, ob, deterministic=False):
+        normalized = OrderedDict()
+        for k, v in ob.items():
+            if k in self._keys:
+                v = v.clamp(-self._clip_obs, self._clip_obs)
+                v = (v - getattr(self, "mean_" + k)) / getattr(self, "std_" + k)
+                v = v.clamp(-self._clip_range, self._clip_range)
+            normalized[k] = v
+        ac, activation, _, _ = self._actor.act(normalized, deterministic=deterministic)
+        return ac, activation
+
+
+class ActorInference(object):
+    """
+    Runs @actor on numpy observations with as little per-step work as possible.
+
+    Observations are copied into preallocated (pinned, if on GPU) staging
+    tensors and transferred in their original dtype, normalization runs on the
+    device, and outputs are read back through preallocated pinned buffers with
+    a single synchronization. The actor runs under torch.inference_mode and can
+    optionally be compiled with torch.compile.
+    """
+
+    def __init__(self, config, actor, ob_space, ob_norm=None, compile=False):
+        """
+        Args:
+            config: configurations.
+            actor: Actor network.
+            ob_space: observation space of @actor.
+            ob_norm: Normalizer applied to observations, or None.
+            compile: whether to compile the actor with torch.compile.
+        """
+        self._config = config
+        self._device = torch.device(config.device)
+        self._pin = self._device.type == "cuda"
+        self._ob_space = ob_space
+        self._ob_norm = ob_norm
+
+        norm_keys = ob_norm._keys if ob_norm is not None else []
+        self._policy = _NormalizedActor(
+            actor, norm_keys, config.clip_obs, config.clip_range
+        )
+        self._norm_src = {}
+
+        self._forward = self._policy
+        if compile:
+            if hasattr(torch, "compile"):
+                self._forward = torch.compile(self._policy, dynamic=True)
+            else:
+                logger.warn("torch.compile is not available; run the actor eagerly")
+
+        self._batch_size = 0
+        self._keys = None
+        self._crop = {}
+        # host buffers that observations are written to
+        self._staging = {}
+        self._inputs = {}
+        self._outputs = None
+
+    def _crop_size(self, k, v):
+        # images of a single ob are (C, H, W) and are center-cropped for the CNN
+        if self._config.encoder_type == "cnn" and len(v.shape) == 3:
+            return self._config.encoder_image_size
+        return None
+
+    def _allocate(self, ob, batch_size):
+        """ Allocates input buffers for up to @batch_size observations. """
+        self._keys = [k for k in ob.keys() if k in self._ob_space.spaces]
+        self._batch_size = batch_size
+        for k in self._keys:
+            v = np.asarray(ob[k])
+            shape = v.shape[1:]
+            size = self._crop[k]
+            if size is not None:
+                shape = shape[:-2] + (size, size)
+            self._inputs[k] = torch.empty(
+                (batch_size,) + shape, dtype=torch.float32, device=self._device
+            )
+            if self._pin:
+                # images are transferred as uint8 and converted on the device
+                dtype = torch.uint8 if v.dtype == np.uint8 else torch.float32
+                staging = torch.empty((batch_size,) + shape, dtype=dtype, pin_memory=True)
+            else:
+                staging = self._inputs[k]
+            self._staging[k] = (staging, staging.numpy())
+
+    def _update_stats(self):
+        """ Copies normalizer statistics to the device when they change. """
+        if self._ob_norm is None:
+            return
+        for k in self._policy._keys:
+            sub_norm = self._ob_norm.sub_norm[k]
+            src = self._norm_src.get(k)
+            if src is not None and src[0] is sub_norm.mean and src[1] is sub_norm.std:
+                continue
+            self._norm_src[k] = (sub_norm.mean, sub_norm.std)
+            # device copies are made once per change by the normalizer
+            mean, std = sub_norm.tensors(self._device)
+            for name, value in [("mean_" + k, mean), ("std_" + k, std)]:
+                buf = getattr(self._policy, name)
+                if buf is None or buf.shape != value.shape:
+                    setattr(self._policy, name, value.clone())
+                else:
+                    buf.copy_(value)
+
+    def _read_outputs(self, ac, activation):
+        """ Copies @ac and @activation to the host and returns numpy arrays. """
+        tensors = list(ac.values()) + list(activation.values())
+        if not self._pin:
+            arrays = [t.numpy() for t in tensors]
+        else:
+            if self._outputs is None or any(
+                o.shape[0] < t.shape[0] for o, t in zip(self._outputs, tensors)
+            ):
+                self._outputs = [
+                    torch.empty(
+                        (self._batch_size,) + t.shape[1:], dtype=t.dtype, pin_memory=True
+                    )
+                    for t in tensors
+                ]
+            arrays = []
+            for o, t in zip(self._outputs, tensors):
+                o = o[: t.shape[0]]
+                o.copy_(t, non_blocking=True)
+                arrays.append(o.numpy())
+            torch.cuda.current_stream(self._device).synchronize()
+            # output buffers are reused in the next call
+            arrays = [a.copy() for a in arrays]
+
+        n = len(ac)
+        ac = OrderedDict(zip(ac.keys(), arrays[:n]))
+        activation = OrderedDict(zip(activation.keys(), arrays[n:]))
+        return ac, activation
+
+    def act(self, ob, deterministic=False):
+        """
+        Returns actions and activations for a batch of observations @ob, a dict
+        of arrays with the batch along the first axis.
+        """
+        batch_size = len(next(iter(ob.values())))
+        with _inference_mode():
+            if self._keys is None:
+                self._crop = {
+                    k: self._crop_size(k, np.asarray(v)[0]) for k, v in ob.items()
+                }
+            if self._keys is None or batch_size > self._batch_size:
+                self._allocate(ob, batch_size)
+            self._update_stats()
+
+            inputs = OrderedDict()
+            for k in self._keys:
+                v = ob[k]
+                size = self._crop[k]
+                if size is not None:
+                    h, w = v.shape[-2:]
+                    top, left = (h - size) // 2, (w - size) // 2
+                    v = v[..., top : top + size, left : left + size]
+                staging, staging_np = self._staging[k]
+                staging_np[:batch_size] = v
+                inputs[k] = self._inputs[k][:batch_size]
+                if self._pin:
+                    inputs[k].copy_(staging[:batch_size], non_blocking=True)
+
+            ac, activation = self._forward(inputs, deterministic=deterministic)
+            return self._read_outputs(ac, activation)
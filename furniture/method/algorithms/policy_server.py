@@ -0,0 +1,285 @@
+"""
+Policy server that batches action requests of many rollout processes.
+"""
+
+import ctypes
+import queue
+from collections import OrderedDict
+from time import time
+
+import numpy as np
+import gym.spaces
+import torch.multiprocessing as mp
+
+from ..utils.logger import logger
+
+
+# tokens on the request queue besides client ids
+_WEIGHTS = -1
+_CLOSE = -2
+
+
+def _action_spec(ac_space):
+    """ Returns (shape, dtype) of every action key as returned by the actor. """
+    spec = OrderedDict()
+    for k, v in ac_space.spaces.items():
+        if isinstance(v, gym.spaces.Box):
+            spec[k] = (v.shape, np.float32)
+        else:
+            spec[k] = ((1,), np.int64)
+    return spec
+
+
+def _shared_array(ctx, shape, dtype):
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return ctx.RawArray(ctypes.c_uint8, max(size, 1)), shape, np.dtype(dtype).str
+
+
+def _as_numpy(shared):
+    buf, shape, dtype = shared
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+class _SharedSlots(object):
+    """ Observation and action slots of all clients in shared memory. """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.arrays = {
+            name: OrderedDict([(k, _as_numpy(v)) for k, v in group.items()])
+            for name, group in shared.items()
+        }
+
+    def __getstate__(self):
+        return self.shared
+
+    def __setstate__(self, shared):
+        self.__init__(shared)
+
+
+def _serve(config, ob_space, ac_space, slots, requests, weights, weights_ack,
+           ready, max_batch_size, max_latency, exploration_noise):
+    """
+    Server loop: collects client requests until @max_batch_size requests are
+    pending or @max_latency seconds passed since the first one, runs one
+    batched forward pass and writes actions back to the clients' slots.
+    """
+    from ..networks import Actor
+    from ..utils.normalizer import Normalizer
+    from .inference import ActorInference
+    from .ddpg_agent import add_exploration_noise
+
+    actor = Actor(config, ob_space, ac_space, config.tanh_policy)
+    actor.to(config.device)
+    ob_norm = None
+    if config.ob_norm:
+        ob_norm = Normalizer(
+            ob_space, default_clip_range=config.clip_range, clip_obs=config.clip_obs
+        )
+    inference = ActorInference(
+        config, actor, ob_space, ob_norm, compile=config.compile_actor
+    )
+
+    ob_slots = slots.arrays["ob"]
+    ac_slots = slots.arrays["ac"]
+    activation_slots = slots.arrays["activation"]
+    deterministic = slots.arrays["info"]["deterministic"]
+    version_slots = slots.arrays["info"]["version"]
+    version = 0
+
+    def load_weights():
+        nonlocal version
+        # every token follows one state on @weights, which may still be in the
+        # feeder thread of the sender, so wait for it
+        state = weights.get()
+        version = state["version"]
+        actor.load_state_dict(state["actor"])
+        if ob_norm is not None:
+            ob_norm.load_state_dict(state["ob_norm"])
+        weights_ack.release()
+
+    try:
+        while True:
+            idx = requests.get()
+            batch = []
+            deadline = None
+            while True:
+                if idx == _CLOSE:
+                    return
+                elif idx == _WEIGHTS:
+                    load_weights()
+                else:
+                    batch.append(idx)
+                    if deadline is None:
+                        deadline = time() + max_latency
+                if len(batch) >= max_batch_size:
+                    break
+                try:
+                    if deadline is None:
+                        idx = requests.get()
+                    elif deadline <= time():
+                        # take requests that are already waiting
+                        idx = requests.get_nowait()
+                    else:
+                        idx = requests.get(timeout=deadline - time())
+                except queue.Empty:
+                    break
+
+            batch = np.array(batch)
+            for is_deterministic in [False, True]:
+                idxs = batch[deterministic[batch, 0] == is_deterministic]
+                if len(idxs) == 0:
+                    continue
+                ob = OrderedDict([(k, v[idxs]) for k, v in ob_slots.items()])
+                ac, activation = inference.act(ob, deterministic=is_deterministic)
+                if exploration_noise and not is_deterministic:
+                    ac = add_exploration_noise(config, ac_space, ac)
+                for k in ac_slots.keys():
+                    ac_slots[k][idxs] = ac[k]
+                    activation_slots[k][idxs] = activation[k]
+                version_slots[idxs] = version
+            for i in batch:
+                ready[i].release()
+    except KeyboardInterrupt:
+        pass
+
+
+class PolicyClient(object):
+    """
+    Handle of one rollout process to a PolicyServer. It has the same act()
+    interface as agents and can be passed to RolloutRunner as the policy.
+    """
+
+    def __init__(self, idx, slots, requests, ready):
+        self._idx = idx
+        self._slots = slots
+        self._requests = requests
+        self._ready = ready
+
+    @property
+    def policy_version(self):
+        """ Version of the weights that computed the last action. """
+        return int(self._slots.arrays["info"]["version"][self._idx, 0])
+
+    def act(self, ob, is_train=True):
+        """ Returns action and the actor's activation given an observation @ob. """
+        arrays = self._slots.arrays
+        for k, v in arrays["ob"].items():
+            v[self._idx] = ob[k]
+        arrays["info"]["deterministic"][self._idx] = not is_train
+        self._requests.put(self._idx)
+        self._ready.acquire()
+
+        ac = OrderedDict([(k, v[self._idx].copy()) for k, v in arrays["ac"].items()])
+        activation = OrderedDict(
+            [(k, v[self._idx].copy()) for k, v in arrays["activation"].items()]
+        )
+        return ac, activation
+
+
+class PolicyServer(object):
+    """
+    Process that owns a copy of the actor and serves actions to @num_clients
+    rollout processes. Clients write observations into shared memory slots and
+    the server answers pending requests with one batched forward pass, waiting
+    at most @max_latency seconds for a batch to fill. Weights pushed with
+    @update_weights are versioned and swapped in between batches.
+    """
+
+    def __init__(self, config, ob_space, env_ob_space, ac_space, num_clients,
+                 max_batch_size=None, max_latency=1e-3, exploration_noise=False):
+        """
+        Args:
+            config: configurations.
+            ob_space: observation space of the actor.
+            env_ob_space: observation space of the environments (before cropping).
+            ac_space: action space.
+            num_clients: number of PolicyClients.
+            max_batch_size: maximum number of observations in a forward pass.
+            max_latency: maximum time in seconds to wait for a batch to fill.
+            exploration_noise: whether to add DDPG exploration noise to actions.
+        """
+        ctx = mp.get_context("spawn")
+        self._num_clients = num_clients
+
+        ob_keys = [k for k in env_ob_space.spaces.keys() if k in ob_space.spaces]
+        shared = {"ob": OrderedDict(), "ac": OrderedDict(), "activation": OrderedDict()}
+        for k in ob_keys:
+            v = env_ob_space.spaces[k]
+            dtype = np.uint8 if v.dtype == np.uint8 else np.float32
+            shared["ob"][k] = _shared_array(ctx, (num_clients,) + v.shape, dtype)
+        for k, (shape, dtype) in _action_spec(ac_space).items():
+            shared["ac"][k] = _shared_array(ctx, (num_clients,) + shape, dtype)
+            shared["activation"][k] = _shared_array(ctx, (num_clients,) + shape, dtype)
+        shared["info"] = OrderedDict(
+            [
+                ("deterministic", _shared_array(ctx, (num_clients, 1), np.bool_)),
+                ("version", _shared_array(ctx, (num_clients, 1), np.int64)),
+            ]
+        )
+        self._slots = _SharedSlots(shared)
+
+        self._requests = ctx.Queue()
+        self._weights = ctx.Queue()
+        self._weights_ack = ctx.Semaphore(0)
+        self._ready = [ctx.Semaphore(0) for _ in range(num_clients)]
+        self._version = 0
+        self._pending_acks = 0
+
+        self._proc = ctx.Process(
+            target=_serve,
+            args=(
+                config,
+                ob_space,
+                ac_space,
+                self._slots,
+                self._requests,
+                self._weights,
+                self._weights_ack,
+                self._ready,
+                max_batch_size or num_clients,
+                max_latency,
+                exploration_noise,
+            ),
+        )
+        self._proc.daemon = True
+        self._proc.start()
+        self._closed = False
+        logger.info("Launch a policy server for %d clients", num_clients)
+
+    @property
+    def version(self):
+        return self._version
+
+    def client(self, idx):
+        """ Returns the PolicyClient for slot @idx. Pass it to the client process. """
+        assert 0 <= idx < self._num_clients
+        return PolicyClient(idx, self._slots, self._requests, self._ready[idx])
+
+    def update_weights(self, state_dict, wait=True):
+        """
+        Sends new weights from BaseAgent.policy_state_dict to the server and
+        returns their version. If @wait, blocks until the server uses them.
+        """
+        self._version += 1
+        state_dict = dict(state_dict, version=self._version)
+        self._weights.put(state_dict)
+        self._requests.put(_WEIGHTS)
+        self._pending_acks += 1
+        if wait:
+            while self._pending_acks > 0:
+                self._weights_ack.acquire()
+                self._pending_acks -= 1
+        return self._version
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._requests.put(_CLOSE)
+        self._proc.join(timeout=1)
+        if self._proc.is_alive():
+            self._proc.terminate()
+
+    def __del__(self):
+        self.close()
@@ -1,26 +1,28 @@
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import StepLR
 
 from ..networks import Actor, Critic
-from ..utils.info_dict import Info
+from ..utils.info_dict import DeviceInfo
 from ..utils.logger import logger
-from ..utils.mpi import mpi_average
 from ..utils.pytorch import (
     compute_gradient_norm,
     compute_weight_norm,
     count_parameters,
-    obs2tensor,
     optimizer_cuda,
-    sync_grads,
     sync_networks,
-    to_tensor,
-    center_crop_images
+    center_crop_images,
+    compute_gae,
 )
 from .base_agent import BaseAgent
-from .dataset import RandomSampler, ReplayBuffer
+from .dataset import (
+    RandomSampler,
+    ReplayBuffer,
+    RolloutTensorBuffer,
+    slice_buffer,
+    stack_tensor,
+)
 
 
 class PPOAgent(BaseAgent):
@@ -64,6 +66,10 @@ class PPOAgent(BaseAgent):
             config.rollout_length,
             sampler.sample_func,
         )
+        # rollout tensors on the training device for PPO updates
+        self._rollout = RolloutTensorBuffer(
+            config.device, image_crop_size=self._config.encoder_image_size
+        )
 
         self._update_iter = 0
 
@@ -79,70 +85,96 @@ class PPOAgent(BaseAgent):
         self._compute_gae(rollouts)
         self._buffer.store_episode(rollouts)
 
-    def _compute_gae(self, rollouts):
-        T = len(rollouts["done"])
-        ob = rollouts["ob"]
-        ob = self.normalize(ob)
-        ob = obs2tensor(ob, self._config.device)
+    def _chunked(self, fn, *inputs):
+        """
+        Applies @fn to chunks of @inputs (dicts of tensors with the same length)
+        of at most --rollout_chunk_size transitions to bound memory.
+        """
+        T = len(next(iter(inputs[0].values())))
+        chunk_size = self._config.rollout_chunk_size
+        outputs = []
+        for i in range(0, T, chunk_size):
+            chunk = [
+                {k: v[i : i + chunk_size] for k, v in x.items()} for x in inputs
+            ]
+            outputs.append(fn(*chunk))
+        return torch.cat(outputs)
+
+    def _crop_ob(self, ob):
+        """ Center-crops image observations and converts them to float. """
+        ob = ob.copy()
         for k, v in ob.items():
             if self._config.encoder_type == "cnn" and len(v.shape) == 4:
-                ob[k] = center_crop_images(v, self._config.encoder_image_size)
+                v = center_crop_images(v, self._config.encoder_image_size)
+            ob[k] = v.float()
+        return ob
 
-        ob_last = rollouts["ob_next"][-1:]
-        ob_last = self.normalize(ob_last)
-        ob_last = obs2tensor(ob_last, self._config.device)
-        for k, v in ob_last.items():
-            if self._config.encoder_type == "cnn" and len(v.shape) == 4:
-                ob_last[k] = center_crop_images(v, self._config.encoder_image_size)
-
-        done = rollouts["done"]
-        rew = rollouts["rew"]
-
-        vpred = self._critic(ob).detach().cpu().numpy()[:, 0]
-        vpred_last = self._critic(ob_last).detach().cpu().numpy()[:, 0]
-        vpred = np.append(vpred, vpred_last)
-        assert len(vpred) == T + 1
-
-        if hasattr(self, "_predict_reward"):
-            ob = rollouts["ob"]
-            ob = self.normalize(ob)
-            ob = obs2tensor(ob, self._config.device)
-            ac = obs2tensor(rollouts["ac"], self._config.device)
-            rew_il = self._predict_reward(ob, ac).cpu().numpy().squeeze()
-            rew = (1 - self._config.gail_env_reward) * rew_il[
-                :T
-            ] + self._config.gail_env_reward * np.array(rew)
-            assert rew.shape == (T,)
-
-        adv = np.empty((T,), "float32")
-        lastgaelam = 0
-        for t in reversed(range(T)):
-            nonterminal = 1 - done[t]
-            delta = (
-                rew[t]
-                + self._config.rl_discount_factor * vpred[t + 1] * nonterminal
-                - vpred[t]
-            )
-            adv[t] = lastgaelam = (
-                delta
-                + self._config.rl_discount_factor
-                * self._config.gae_lambda
-                * nonterminal
-                * lastgaelam
+    def _compute_gae(self, rollouts):
+        """
+        Computes advantages and returns of @rollouts with a parallel scan and
+        stores the rollout as tensors on the training device. Observations are
+        stored unnormalized and normalized in train().
+        """
+        device = self._config.device
+        T = len(rollouts["done"])
+        raw_ob = stack_tensor(rollouts["ob"], device)
+        ob = self.normalize(raw_ob)
+        ob_last = self.normalize(
+            stack_tensor(slice_buffer(rollouts["ob_next"], slice(-1, None)), device)
+        )
+        ac = stack_tensor(rollouts["ac"], device)
+        a_z = stack_tensor(rollouts["ac_before_activation"], device)
+        done = torch.as_tensor(rollouts["done"], dtype=torch.float32, device=device)
+        rew = torch.as_tensor(rollouts["rew"], dtype=torch.float32, device=device)
+
+        with torch.no_grad():
+            critic = lambda o: self._critic(self._crop_ob(o))
+            vpred = self._chunked(critic, ob)[:, 0]
+            vpred_last = critic(ob_last)[:, 0]
+            assert len(vpred) == T
+
+            if hasattr(self, "_predict_reward"):
+                rew_il = self._chunked(
+                    lambda o, a: self._predict_reward(
+                        {k: v.float() for k, v in o.items()}, a
+                    ),
+                    ob,
+                    ac,
+                ).view(-1)
+                rew = (
+                    1 - self._config.gail_env_reward
+                ) * rew_il + self._config.gail_env_reward * rew
+                assert rew.shape == (T,)
+
+            adv, ret = compute_gae(
+                rew,
+                vpred,
+                vpred_last,
+                done,
+                self._config.rl_discount_factor,
+                self._config.gae_lambda,
             )
 
-        ret = adv + vpred[:-1]
+            assert torch.isfinite(adv).all()
+            assert torch.isfinite(ret).all()
 
-        assert np.isfinite(adv).all()
-        assert np.isfinite(ret).all()
+            if self._config.advantage_norm:
+                adv = (adv - adv.mean()) / (adv.std(unbiased=False) + 1e-5)
 
         # update rollouts
-        if self._config.advantage_norm:
-            rollouts["adv"] = ((adv - adv.mean()) / (adv.std() + 1e-5)).tolist()
-        else:
-            rollouts["adv"] = adv.tolist()
-
-        rollouts["ret"] = ret.tolist()
+        self._rollout.store(
+            {
+                "ob": raw_ob,
+                "ac": ac,
+                "ac_before_activation": a_z,
+                "done": done,
+                "vpred": vpred.view(T, 1),
+                "ret": ret.view(T, 1),
+                "adv": adv.view(T, 1),
+            }
+        )
+        rollouts["adv"] = adv.cpu().numpy()
+        rollouts["ret"] = ret.cpu().numpy()
 
     def state_dict(self):
         return {
@@ -182,32 +214,45 @@ class PPOAgent(BaseAgent):
         sync_networks(self._critic)
 
     def train(self):
-        train_info = Info()
+        train_info = DeviceInfo()
 
         self._copy_target_network(self._old_actor, self._actor)
 
-        num_batches = (
-            self._config.ppo_epoch
-            * self._config.rollout_length
-            // self._config.batch_size
-        )
-        assert num_batches > 0
-
-        for _ in range(num_batches):
-            transitions = self._buffer.sample(self._config.batch_size)
+        # sample_epochs drops incomplete minibatches
+        assert len(self._rollout) >= self._config.batch_size
+
+        # normalize with the current statistics, which may have been updated
+        # since the rollout was stored, as when sampling from a replay buffer
+        self._rollout.store_key("ob", self.normalize(self._rollout["ob"]))
+
+        # log-probs of the old policy do not depend on augmentation without images
+        if not any(len(v.shape) == 4 for v in self._rollout["ob"].values()):
+            with torch.no_grad():
+                log_pi = self._chunked(
+                    lambda o, a_z: self._actor.act(
+                        o, activations=a_z, return_log_prob=True
+                    )[2],
+                    self._rollout["ob"],
+                    self._rollout["ac_before_activation"],
+                )
+            self._rollout.store_key("old_log_pi", log_pi)
+
+        for transitions in self._rollout.sample_epochs(
+            self._config.batch_size, self._config.ppo_epoch
+        ):
             _train_info = self._update_network(transitions)
             train_info.add(_train_info)
 
         self._buffer.clear()
+        self._rollout.clear()
 
         self._actor_lr_scheduler.step()
         self._critic_lr_scheduler.step()
 
         logger.info(
-            "Actor lr %f, Critic lr %f, PPO Clip Frac %f",
+            "Actor lr %f, Critic lr %f",
             self._actor_lr_scheduler.get_lr()[0],
             self._critic_lr_scheduler.get_lr()[0],
-            np.mean(train_info["ppo_clip_frac"])
         )
 
         # slow!
@@ -219,25 +264,24 @@ class PPOAgent(BaseAgent):
         #         "critic_weight_norm": compute_weight_norm(self._critic),
         #     }
         # )
-        return mpi_average(train_info.get_dict(only_scalar=True))
+        return train_info
 
-    def _update_actor(self, o, a_z, adv):
-        info = Info()
+    def _update_actor(self, o, a_z, adv, old_log_pi=None):
+        info = DeviceInfo()
 
-        _, _, log_pi, ent = self._actor.act(
-            o, activations=a_z, return_log_prob=True
-        )
-        _, _, old_log_pi, _ = self._old_actor.act(
-            o, activations=a_z, return_log_prob=True
-        )
-        if old_log_pi.min() < -100:
-            logger.error("sampling an action with a probability of 1e-100")
-            import ipdb
-            ipdb.set_trace()
+        with self._autocast():
+            _, _, log_pi, ent = self._actor.act(
+                o, activations=a_z, return_log_prob=True
+            )
+            if old_log_pi is None:
+                with torch.no_grad():
+                    _, _, old_log_pi, _ = self._old_actor.act(
+                        o, activations=a_z, return_log_prob=True
+                    )
 
         # the actor loss
-        entropy_loss = -self._config.entropy_loss_coeff * ent.mean()
-        ratio = torch.exp(log_pi - old_log_pi)
+        entropy_loss = -self._config.entropy_loss_coeff * ent.float().mean()
+        ratio = torch.exp(log_pi.float() - old_log_pi.float())
         surr1 = ratio * adv
         surr2 = (
             torch.clamp(ratio, 1.0 - self._config.ppo_clip, 1.0 + self._config.ppo_clip)
@@ -247,27 +291,15 @@ class PPOAgent(BaseAgent):
 
         ppo_clip_frac = torch.gt(torch.abs(ratio - 1.0), self._config.ppo_clip).float().mean()
 
-        if (
-            not np.isfinite(ratio.cpu().detach()).all()
-            or not np.isfinite(adv.cpu().detach()).all()
-        ):
-            import ipdb
-
-            ipdb.set_trace()
-        info["ppo_clip_frac"] = ppo_clip_frac.cpu().item()
-        info["entropy_loss"] = entropy_loss.cpu().item()
-        info["actor_loss"] = actor_loss.cpu().item()
+        info["ppo_clip_frac"] = ppo_clip_frac.detach()
+        info["entropy_loss"] = entropy_loss.detach()
+        info["actor_loss"] = actor_loss.detach()
         actor_loss += entropy_loss
 
         # update the actor
-        self._actor_optim.zero_grad()
-        actor_loss.backward()
-        if self._config.max_grad_norm:
-            torch.nn.utils.clip_grad_norm_(
-                self._actor.parameters(), self._config.max_grad_norm
-            )
-        sync_grads(self._actor)
-        self._actor_optim.step()
+        self._optimizer_step(
+            actor_loss, self._actor_optim, self._actor, self._config.max_grad_norm
+        )
 
         # include info from policy
         info.add(self._actor.info)
@@ -275,42 +307,33 @@ class PPOAgent(BaseAgent):
         return info
 
     def _update_critic(self, o, ret):
-        info = Info()
+        info = DeviceInfo()
 
         # the q loss
-        value_pred = self._critic(o)
+        with self._autocast():
+            value_pred = self._critic(o).float()
         value_loss = self._config.value_loss_coeff * (ret - value_pred).pow(2).mean()
 
         # update the critic
-        self._critic_optim.zero_grad()
-        value_loss.backward()
-        if self._config.max_grad_norm:
-            torch.nn.utils.clip_grad_norm_(
-                self._critic.parameters(), self._config.max_grad_norm
-            )
-        sync_grads(self._critic)
-        self._critic_optim.step()
+        self._optimizer_step(
+            value_loss, self._critic_optim, self._critic, self._config.max_grad_norm
+        )
 
-        info["value_target"] = ret.mean().cpu().item()
-        info["value_predicted"] = value_pred.mean().cpu().item()
-        info["value_loss"] = value_loss.cpu().item()
+        info["value_target"] = ret.mean().detach()
+        info["value_predicted"] = value_pred.mean().detach()
+        info["value_loss"] = value_loss.detach()
 
         return info
 
     def _update_network(self, transitions):
-        info = Info()
+        """ Updates networks with @transitions, a minibatch of normalized tensors. """
+        info = DeviceInfo()
 
-        # pre-process observations
         o = transitions["ob"]
-        o = self.normalize(o)
-
-        bs = len(transitions["done"])
-        _to_tensor = lambda x: to_tensor(x, self._config.device)
-        o = _to_tensor(o)
-        ac = _to_tensor(transitions["ac"])
-        a_z = _to_tensor(transitions["ac_before_activation"])
-        ret = _to_tensor(transitions["ret"]).reshape(bs, 1)
-        adv = _to_tensor(transitions["adv"]).reshape(bs, 1)
+        a_z = transitions["ac_before_activation"]
+        ret = transitions["ret"]
+        adv = transitions["adv"]
+        old_log_pi = transitions.get("old_log_pi")
 
         self._update_iter += 1
 
@@ -318,7 +341,7 @@ class PPOAgent(BaseAgent):
         info.add(critic_train_info)
 
         if self._update_iter % self._config.actor_update_freq == 0:
-            actor_train_info = self._update_actor(o, a_z, adv)
+            actor_train_info = self._update_actor(o, a_z, adv, old_log_pi)
             info.add(actor_train_info)
 
         return info
@@ -0,0 +1,159 @@
+"""
+Prioritized experience replay (Schaul et al. 2016) backed by an array-based
+sum-tree.
+"""
+
+import numpy as np
+
+from .dataset import (
+    add_rollout,
+    augment_ob,
+    episode_length,
+    get_batch,
+    make_buffer_like,
+    slice_buffer,
+)
+
+
+class SumTree(object):
+    """
+    Binary tree in a flat array where every node is the sum of its children and
+    the leaves are priorities. Batches of updates and samples are vectorized
+    over the items of a batch and take O(log n) steps.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._num_leaves = 1
+        while self._num_leaves < capacity:
+            self._num_leaves *= 2
+        # node i has children 2i and 2i+1, leaves start at _num_leaves
+        self._tree = np.zeros(2 * self._num_leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def clear(self):
+        self._tree[:] = 0
+
+    def get(self, idxs):
+        return self._tree[idxs + self._num_leaves]
+
+    def update(self, idxs, priorities):
+        """ Sets leaves @idxs to @priorities and updates their ancestors. """
+        nodes = np.asarray(idxs) + self._num_leaves
+        self._tree[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[0] > 0:
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """ Returns the leaves where the prefix sums of priorities reach @values. """
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self._num_leaves:
+            left = self._tree[2 * nodes]
+            go_right = values > left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self._num_leaves
+
+
+class PrioritizedReplayBuffer(object):
+    """
+    Per-step ring buffer that samples transitions with probability proportional
+    to priority ** @alpha. New transitions get the largest priority so far and
+    update_priorities() sets |TD error| + @eps of sampled transitions. Batches
+    carry "idxs" and importance-sampling "weights" (N * P(i)) ** -@beta,
+    normalized by their maximum.
+    """
+
+    def __init__(self, keys, buffer_size, image_crop_size=84, alpha=0.6, beta=0.4,
+                 eps=1e-6):
+        """
+        Args:
+            keys: keys of transitions to store.
+            buffer_size: number of transitions.
+            image_crop_size: size of random crops of sampled images.
+            alpha: how much prioritization is used (0 for uniform sampling).
+            beta: strength of the importance-sampling correction.
+            eps: offset of priorities so that every transition can be sampled.
+        """
+        self._keys = keys
+        self._capacity = buffer_size
+        self._image_crop_size = image_crop_size
+        self._alpha = alpha
+        self._beta = beta
+        self._eps = eps
+
+        self._buffer = None
+        self._tree = SumTree(buffer_size)
+        self.clear()
+
+    def clear(self):
+        self._idx = 0
+        self._size = 0
+        self._max_priority = 1.0
+        self._tree.clear()
+
+    def __len__(self):
+        return self._size
+
+    # store the episode
+    def store_episode(self, rollout):
+        """ Copies a columnar @rollout of any length into the ring buffer. """
+        rollout = {k: rollout[k] for k in self._keys}
+        if self._buffer is None:
+            self._buffer = make_buffer_like(slice_buffer(rollout, 0), self._capacity)
+
+        n = episode_length(rollout["done"])
+        idxs = (self._idx + np.arange(n)) % self._capacity
+        add_rollout(self._buffer, rollout, idxs)
+        self._tree.update(idxs, self._max_priority ** self._alpha)
+
+        self._idx = (self._idx + n) % self._capacity
+        self._size = min(self._size + n, self._capacity)
+
+    # sample the data from the replay buffer
+    def sample(self, batch_size):
+        # one value from each of @batch_size equal segments of the total priority
+        total = self._tree.total
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * (
+            total / batch_size
+        )
+        idxs = np.minimum(self._tree.find(values), self._size - 1)
+        batch = get_batch(self._buffer, idxs)
+
+        probs = self._tree.get(idxs) / total
+        weights = (self._size * probs) ** -self._beta
+        batch["weights"] = (weights / weights.max()).astype(np.float32)
+        batch["idxs"] = idxs
+
+        # apply random crop to image
+        augment_ob(batch, self._image_crop_size)
+
+        return batch
+
+    def update_priorities(self, idxs, td_errors):
+        """ Sets priorities of transitions @idxs from their @td_errors. """
+        priorities = np.abs(td_errors).reshape(-1) + self._eps
+        self._max_priority = max(self._max_priority, priorities.max())
+        self._tree.update(idxs, priorities ** self._alpha)
+
+    def state_dict(self):
+        return {
+            "buffer": self._buffer,
+            "priorities": self._tree.get(np.arange(self._capacity)),
+            "idx": self._idx,
+            "size": self._size,
+            "max_priority": self._max_priority,
+        }
+
+    def load_state_dict(self, state_dict):
+        self._buffer = state_dict["buffer"]
+        self._tree.update(np.arange(self._capacity), state_dict["priorities"])
+        self._idx = state_dict["idx"]
+        self._size = state_dict["size"]
+        self._max_priority = state_dict["max_priority"]
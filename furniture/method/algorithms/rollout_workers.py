@@ -0,0 +1,195 @@
+"""
+Rollout processes that step their own environments and get actions from a
+shared PolicyServer.
+"""
+
+import copy
+import queue
+from time import time
+
+import torch.multiprocessing as mp
+
+from .policy_server import PolicyServer
+from ..utils.info_dict import Info
+from ..utils.logger import logger
+
+
+def _rollout_worker(config, client, conn, stream_queue, stop):
+    """
+    Runs a RolloutRunner with @client as the policy on request of @conn. In
+    streaming mode, rollouts are put to @stream_queue until @stop is set.
+    """
+    from ..environments import make_env
+    from .rollouts import RolloutRunner
+
+    env = make_env(config.env, config)
+    runner = RolloutRunner(config, env, None, client)
+    generator = None
+    try:
+        while True:
+            cmd, data = conn.recv()
+            if cmd == "run":
+                every_steps, step = data
+                generator = runner.run(every_steps=every_steps, step=step)
+            elif cmd == "collect":
+                conn.send(next(generator))
+            elif cmd == "stream":
+                every_steps, step = data
+                generator = runner.run(every_steps=every_steps, step=step)
+                while not stop.is_set():
+                    rollout, ep_info = next(generator)
+                    stream_queue.put((rollout, ep_info, client.policy_version))
+            elif cmd == "close":
+                break
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        env.close()
+        conn.close()
+
+
+class RolloutWorkers(object):
+    """
+    @num_workers processes that each run a RolloutRunner on their own
+    environment. Instead of holding a copy of the actor, all workers send
+    observations to one PolicyServer, which answers them with batched forward
+    passes.
+    """
+
+    def __init__(self, config, ob_space, env_ob_space, ac_space, num_workers,
+                 exploration_noise=False):
+        """
+        Args:
+            config: configurations.
+            ob_space: observation space of the actor.
+            env_ob_space: observation space of the environments.
+            ac_space: action space.
+            num_workers: number of rollout processes.
+            exploration_noise: whether to add DDPG exploration noise to actions.
+        """
+        self._num_workers = num_workers
+        self._server = PolicyServer(
+            config,
+            ob_space,
+            env_ob_space,
+            ac_space,
+            num_workers,
+            max_batch_size=config.policy_server_batch_size or None,
+            max_latency=config.policy_server_latency / 1000.0,
+            exploration_noise=exploration_noise,
+        )
+
+        ctx = mp.get_context("spawn")
+        self._stream_queue = ctx.Queue(config.async_queue_size)
+        self._stop = ctx.Event()
+        self._conns = []
+        self._procs = []
+        for i in range(num_workers):
+            # seeds and ports do not overlap with other workers and MPI ranks
+            worker_config = copy.copy(config)
+            worker_config.seed = config.seed + config.num_workers * (i + 1)
+            if hasattr(config, "port"):
+                worker_config.port = config.port + 2 * config.num_workers * (i + 1)
+            worker_config.warm_up_steps = -(-config.warm_up_steps // num_workers)
+
+            conn, worker_conn = ctx.Pipe()
+            proc = ctx.Process(
+                target=_rollout_worker,
+                args=(
+                    worker_config,
+                    self._server.client(i),
+                    worker_conn,
+                    self._stream_queue,
+                    self._stop,
+                ),
+            )
+            proc.daemon = True
+            proc.start()
+            worker_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+
+        self._closed = False
+        logger.info("Launch %d rollout workers", num_workers)
+
+    @property
+    def num_workers(self):
+        return self._num_workers
+
+    @property
+    def version(self):
+        """ Version of the latest weights sent to the server. """
+        return self._server.version
+
+    def update_weights(self, agent, wait=True):
+        """
+        Pushes the current policy of @agent to the server and returns its
+        version. If @wait, blocks until the server uses it.
+        """
+        return self._server.update_weights(agent.policy_state_dict(), wait=wait)
+
+    def run(self, every_steps, step=0):
+        """
+        Collects at least @every_steps transitions in total from all workers
+        and yields a list of per-worker rollouts and their episode info.
+        """
+        every_steps = -(-every_steps // self._num_workers)
+        for conn in self._conns:
+            conn.send(("run", (every_steps, step // self._num_workers)))
+
+        while True:
+            for conn in self._conns:
+                conn.send(("collect", None))
+            rollouts = []
+            info = Info()
+            for conn in self._conns:
+                rollout, ep_info = conn.recv()
+                rollouts.append(rollout)
+                info.add(ep_info)
+            yield rollouts, info.get_dict(only_scalar=True)
+
+    def start_stream(self, every_steps, step=0):
+        """
+        Lets the workers collect rollouts continuously and put chunks of
+        @every_steps transitions to a queue, which are read with @get.
+        """
+        for conn in self._conns:
+            conn.send(("stream", (every_steps, step // self._num_workers)))
+
+    def get(self, block=False, timeout=1.0):
+        """
+        Returns the list of (rollout, ep_info, policy_version) streamed since
+        the last call. If @block, waits up to @timeout seconds for one chunk.
+        """
+        chunks = []
+        try:
+            if block:
+                chunks.append(self._stream_queue.get(timeout=timeout))
+            while True:
+                chunks.append(self._stream_queue.get_nowait())
+        except queue.Empty:
+            pass
+        return chunks
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        for conn in self._conns:
+            try:
+                conn.send(("close", None))
+            except (BrokenPipeError, EOFError):
+                pass
+        deadline = time() + 5
+        for proc in self._procs:
+            while proc.is_alive() and time() < deadline:
+                # unblock workers waiting on a full queue
+                self.get()
+                proc.join(timeout=0.1)
+            if proc.is_alive():
+                proc.terminate()
+        self._server.close()
+
+    def __del__(self):
+        self.close()
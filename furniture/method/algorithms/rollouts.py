@@ -4,7 +4,7 @@ Runs rollouts (RolloutRunner class) and collects transitions using Rollout class
 
 import random
 import pickle
-from collections import defaultdict
+from collections import OrderedDict
 
 import numpy as np
 import cv2
@@ -12,53 +12,101 @@ import cv2
 from ..utils.logger import logger
 from ..utils.info_dict import Info
 from ..utils.gym_env import get_non_absorbing_state, zero_value
+from .dataset import make_buffer_like, add_rollout, slice_buffer
 
 
 class Rollout(object):
     """
-    Rollout storing an episode.
+    Rollout storing transitions in preallocated columnar arrays.
+
+    Every transition is written in place into arrays preallocated with the
+    shapes and dtypes of the first transition (observations and actions of
+    the environment spaces). @get hands the filled slices over without
+    copying and continues on freshly allocated arrays.
     """
 
-    def __init__(self):
+    def __init__(self, capacity=1000):
         """ Initialize buffer. """
-        self._history = defaultdict(list)
+        self._capacity = max(1, capacity)
+        self._example = None
+        self._buffer = None
+        self._idx = 0
+
+    def __len__(self):
+        return self._idx
 
     def add(self, data):
-        """ Add a transition @data to rollout buffer. """
-        for key, value in data.items():
-            self._history[key].append(value)
+        """ Writes a transition @data with all keys to the rollout buffer. """
+        if self._buffer is None:
+            self._example = data
+            self._buffer = make_buffer_like(data, self._capacity)
+        elif self._idx == self._capacity:
+            self._grow()
+        add_rollout(self._buffer, data, self._idx)
+        self._idx += 1
+
+    def set_last(self, key, value):
+        """ Overwrites @key of the last transition with @value. """
+        add_rollout(self._buffer[key], value, self._idx - 1)
+
+    def _grow(self):
+        buffer = make_buffer_like(self._example, self._capacity * 2)
+        idx = slice(0, self._idx)
+        add_rollout(buffer, slice_buffer(self._buffer, idx), idx)
+        self._buffer = buffer
+        self._capacity *= 2
 
     def get(self):
-        """ Returns rollout buffer and clears buffer. """
-        batch = {}
-        batch["ob"] = self._history["ob"]
-        batch["ob_next"] = self._history["ob_next"]
-        batch["ac"] = self._history["ac"]
-        batch["ac_before_activation"] = self._history["ac_before_activation"]
-        batch["done"] = self._history["done"]
-        batch["done_mask"] = self._history["done_mask"]
-        batch["rew"] = self._history["rew"]
-        self._history = defaultdict(list)
+        """
+        Returns the rollout as columnar arrays and clears buffer. The returned
+        arrays are owned by the caller.
+        """
+        if self._buffer is None:
+            return {}
+        batch = slice_buffer(self._buffer, slice(0, self._idx))
+        self._buffer = make_buffer_like(self._example, self._capacity)
+        self._idx = 0
         return batch
 
 
+def stack_obs(obs):
+    """ Stacks a list of observations (or actions) into a batch. """
+    if isinstance(obs[0], dict):
+        return OrderedDict([(k, np.stack([ob[k] for ob in obs])) for k in obs[0]])
+    return np.stack(obs)
+
+
+def unstack_rollout(batch):
+    """ Converts columnar arrays of @batch to per-transition lists. """
+    def unstack(x):
+        if isinstance(x, dict):
+            values = {k: unstack(v) for k, v in x.items()}
+            return [dict(zip(values.keys(), v)) for v in zip(*values.values())]
+        return list(x)
+
+    return {k: unstack(v) for k, v in batch.items()}
+
+
 class RolloutRunner(object):
     """
     Run rollout given environment and policy.
     """
 
-    def __init__(self, config, env, env_eval, pi):
+    def __init__(self, config, env, env_eval, pi, video_stream=None):
         """
         Args:
             config: configurations for the environment.
             env: environment.
             pi: policy.
+            video_stream: if given, recorded frames are streamed to this
+                VideoStream instead of being kept in memory.
         """
 
         self._config = config
         self._env = env
         self._env_eval = env_eval
         self._pi = pi
+        self._video_stream = video_stream
 
     def run(
         self,
@@ -84,10 +132,14 @@ class RolloutRunner(object):
         device = config.device
         env = self._env if is_train else self._env_eval
         pi = self._pi
-        il = hasattr(pi, "predict_reward")
+        # discriminator rewards are only logged and are predicted per episode
+        il = hasattr(pi, "predict_rewards")
+        log_il = il and config.gail_log_reward
 
         # initialize rollout buffer
-        rollout = Rollout()
+        rollout = Rollout(
+            every_steps if every_steps is not None else env.max_episode_steps
+        )
         reward_info = Info()
         ep_info = Info()
         episode = 0
@@ -96,61 +148,50 @@ class RolloutRunner(object):
             done = False
             ep_len = 0
             ep_rew = 0
-            ep_rew_rl = 0
-            if il:
-                ep_rew_il = 0
+            ep_obs = []
+            ep_acs = []
             ob = env.reset()
 
             # run rollout
             while not done:
                 # sample action from policy
                 if step < config.warm_up_steps:
-                    ac, ac_before_activation = env.action_space.sample(), 0
+                    ac = env.action_space.sample()
+                    ac_before_activation = zero_value(env.action_space)
                 else:
                     ac, ac_before_activation = pi.act(ob, is_train=is_train)
-
-                rollout.add(
-                    {"ob": ob, "ac": ac, "ac_before_activation": ac_before_activation}
-                )
-
-                if il:
-                    reward_il = pi.predict_reward(ob, ac)
+                transition = {
+                    "ob": ob,
+                    "ac": ac,
+                    "ac_before_activation": ac_before_activation,
+                }
+                if log_il:
+                    ep_obs.append(ob)
+                    ep_acs.append(ac)
 
                 # take a step
                 ob, reward, done, info = env.step(ac)
-                rollout.add({"ob_next": ob})
-
-                # replace reward
-                if il:
-                    reward_rl = (
-                        1 - config.gail_env_reward
-                    ) * reward_il + config.gail_env_reward * reward
-                else:
-                    reward_rl = reward
+                transition["ob_next"] = ob
 
-                rollout.add({"done": done, "rew": reward})
+                transition.update({"done": done, "rew": reward})
                 step += 1
                 ep_len += 1
                 ep_rew += reward
-                ep_rew_rl += reward_rl
-                if il:
-                    ep_rew_il += reward_il
 
                 if done and ep_len < env.max_episode_steps:
                     done_mask = 0  # -1 absorbing, 0 done, 1 not done
                 else:
                     done_mask = 1
 
-                rollout.add(
-                    {"done_mask": done_mask}
-                )  # -1 absorbing, 0 done, 1 not done
+                transition["done_mask"] = done_mask  # -1 absorbing, 0 done, 1 not done
+                rollout.add(transition)
 
                 reward_info.add(info)
 
                 if config.absorbing_state and done_mask == 0:
                     absorbing_state = env.get_absorbing_state()
                     absorbing_action = zero_value(env.action_space)
-                    rollout._history["ob_next"][-1] = absorbing_state
+                    rollout.set_last("ob_next", absorbing_state)
                     rollout.add(
                         {
                             "ob": absorbing_state,
@@ -167,14 +208,21 @@ class RolloutRunner(object):
                     yield rollout.get(), ep_info.get_dict(only_scalar=True)
 
             # compute average/sum of information
-            ep_info.add({"len": ep_len, "rew": ep_rew, "rew_rl": ep_rew_rl})
-            if il:
-                ep_info.add({"rew_il": ep_rew_il})
+            ep_rew_info = {"len": ep_len, "rew": ep_rew}
+            if log_il:
+                ep_rew_il = float(
+                    np.sum(pi.predict_rewards(stack_obs(ep_obs), stack_obs(ep_acs)))
+                )
+                ep_rew_info["rew_il"] = ep_rew_il
+                ep_rew_info["rew_rl"] = (
+                    1 - config.gail_env_reward
+                ) * ep_rew_il + config.gail_env_reward * ep_rew
+            elif not il:
+                ep_rew_info["rew_rl"] = ep_rew
+            ep_info.add(ep_rew_info)
             reward_info_dict = reward_info.get_dict(reduction="sum", only_scalar=True)
             ep_info.add(reward_info_dict)
-            reward_info_dict.update({"len": ep_len, "rew": ep_rew, "rew_rl": ep_rew_rl})
-            if il:
-                reward_info_dict.update({"rew_il": ep_rew_il})
+            reward_info_dict.update(ep_rew_info)
 
             logger.info(
                 log_prefix + " rollout: %s",
@@ -205,7 +253,7 @@ class RolloutRunner(object):
         il = hasattr(pi, "predict_reward")
 
         # initialize rollout buffer
-        rollout = Rollout()
+        rollout = Rollout(min(max_step, env.max_episode_steps))
         reward_info = Info()
 
         done = False
@@ -225,15 +273,18 @@ class RolloutRunner(object):
         while not done and ep_len < max_step:
             # sample action from policy
             ac, ac_before_activation = pi.act(ob, is_train=is_train)
-            rollout.add(
-                {"ob": ob, "ac": ac, "ac_before_activation": ac_before_activation}
-            )
+            transition = {
+                "ob": ob,
+                "ac": ac,
+                "ac_before_activation": ac_before_activation,
+            }
 
             if il:
                 reward_il = pi.predict_reward(ob, ac)
 
             # take a step
             ob, reward, done, info = env.step(ac)
+            transition["ob_next"] = ob
 
             # replace reward
             if il:
@@ -243,8 +294,10 @@ class RolloutRunner(object):
             else:
                 reward_rl = reward
 
-            rollout.add({"done": done, "rew": reward})
             ep_len += 1
+            done_mask = 0 if done and ep_len < env.max_episode_steps else 1
+            transition.update({"done": done, "rew": reward, "done_mask": done_mask})
+            rollout.add(transition)
             ep_rew += reward
             ep_rew_rl += reward_rl
             if il:
@@ -263,9 +316,6 @@ class RolloutRunner(object):
                     )
                 self._store_frame(env, ep_len, ep_rew, frame_info)
 
-        # add last observation
-        rollout.add({"ob": ob})
-
         # compute average/sum of information
         ep_info = {"len": ep_len, "rew": ep_rew, "rew_rl": ep_rew_rl}
         if il:
@@ -275,7 +325,10 @@ class RolloutRunner(object):
         return rollout.get(), ep_info, self._record_frames
 
     def _store_frame(self, env, ep_len, ep_rew, info={}):
-        """ Renders a frame and stores in @self._record_frames. """
+        """
+        Renders a frame and stores in @self._record_frames, or writes it to
+        @self._video_stream if it is set.
+        """
         color = (200, 200, 200)
 
         # render video frame
@@ -338,4 +391,8 @@ class RolloutRunner(object):
                     cv2.LINE_AA,
                 )
 
-        self._record_frames.append(frame)
+        frame = frame.astype(np.uint8)
+        if self._video_stream is not None:
+            self._video_stream.write(frame)
+        else:
+            self._record_frames.append(frame)
@@ -4,16 +4,14 @@
 import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 import torch.optim as optim
 import gym.spaces
 
 from .base_agent import BaseAgent
-from .dataset import ReplayBuffer, RandomSampler, ReplayBufferPerStep
+from .dataset import RandomSampler, ReplayBufferPerStep, slice_buffer
 from ..networks import Actor, Critic
-from ..utils.info_dict import Info
+from ..utils.info_dict import DeviceInfo
 from ..utils.logger import logger
-from ..utils.mpi import mpi_average, mpi_sum
 from ..utils.gym_env import spaces_to_shapes
 from ..utils.pytorch import (
     optimizer_cuda,
@@ -21,8 +19,9 @@ from ..utils.pytorch import (
     compute_gradient_norm,
     compute_weight_norm,
     sync_networks,
-    sync_grads,
     to_tensor,
+    weighted_mse_loss,
+    PolyakAverager,
 )
 
 
@@ -53,6 +52,17 @@ class SACAgent(BaseAgent):
         self._copy_target_network(self._critic_target, self._critic)
         self._actor.encoder.copy_conv_weights_from(self._critic.encoder)
 
+        # polyak averaging of the target critic
+        self._critic_target_averager = PolyakAverager()
+        self._critic_target_averager.add(
+            self._critic_target.fcs, self._critic.fcs, config.critic_soft_update_weight
+        )
+        self._critic_target_averager.add(
+            self._critic_target.encoder,
+            self._critic.encoder,
+            config.encoder_soft_update_weight,
+        )
+
         # optimizers
         self._alpha_optim = optim.Adam(
             [self._log_alpha], lr=config.alpha_lr, betas=(0.5, 0.999)
@@ -67,9 +77,7 @@ class SACAgent(BaseAgent):
         # per-episode replay buffer
         sampler = RandomSampler(image_crop_size=config.encoder_image_size)
         buffer_keys = ["ob", "ob_next", "ac", "done", "rew"]
-        self._buffer = ReplayBuffer(
-            buffer_keys, config.buffer_size, sampler.sample_func
-        )
+        self._buffer = self._create_replay_buffer(buffer_keys, sampler.sample_func)
 
         # per-step replay buffer
         # shapes = {
@@ -94,11 +102,6 @@ class SACAgent(BaseAgent):
             logger.info("The critic has %d parameters", count_parameters(self._critic))
 
     def store_episode(self, rollouts):
-        self._num_updates = (
-            mpi_sum(len(rollouts["ac"]))
-            // self._config.num_workers
-            // self._config.actor_update_freq
-        )
         self._buffer.store_episode(rollouts)
 
     def state_dict(self):
@@ -151,12 +154,17 @@ class SACAgent(BaseAgent):
         sync_networks(self._critic)
 
     def train(self):
-        train_info = Info()
-
-        self._num_updates = 1
-        for _ in range(self._num_updates):
-            transitions = self._buffer.sample(self._config.batch_size)
-            _train_info = self._update_network(transitions)
+        train_info = DeviceInfo()
+
+        # sample the minibatches of all updates at once
+        num_updates = self._config.utd_ratio
+        transitions = self._buffer.sample(self._config.batch_size * num_updates)
+        transitions = self._to_device(transitions)
+        for i in range(num_updates):
+            # strided minibatches span the whole sample (e.g. all strata of
+            # prioritized replay)
+            minibatch = slice_buffer(transitions, slice(i, None, num_updates))
+            _train_info = self._update_network(minibatch)
             train_info.add(_train_info)
 
         # slow!
@@ -168,96 +176,119 @@ class SACAgent(BaseAgent):
         #        "critic_weight_norm": compute_weight_norm(self._critic),
         #    }
         # )
-        return mpi_average(train_info.get_dict(only_scalar=True))
+        return train_info
 
     def _update_actor_and_alpha(self, o):
-        info = Info()
+        info = DeviceInfo()
 
-        actions_real, _, log_pi, _ = self._actor.act(
-            o, return_log_prob=True, detach_conv=True
-        )
-        alpha = self._log_alpha.exp()
-
-        # the actor loss
-        entropy_loss = (alpha.detach() * log_pi).mean()
-        actor_loss = -torch.min(*self._critic(o, actions_real, detach_conv=True)).mean()
-        info["entropy_alpha"] = alpha.cpu().item()
-        info["entropy_loss"] = entropy_loss.cpu().item()
-        info["actor_loss"] = actor_loss.cpu().item()
+        with self._autocast():
+            actions_real, _, log_pi, _ = self._actor.act(
+                o, return_log_prob=True, detach_conv=True
+            )
+            alpha = self._log_alpha.exp()
+
+            # the actor loss
+            entropy_loss = (alpha.detach() * log_pi).mean()
+            actor_loss = -torch.min(
+                *self._critic(o, actions_real, detach_conv=True)
+            ).mean()
+        info["entropy_alpha"] = alpha.detach()
+        info["entropy_loss"] = entropy_loss.detach()
+        info["actor_loss"] = actor_loss.detach()
         actor_loss += entropy_loss
 
         # update the actor
-        self._actor_optim.zero_grad()
-        actor_loss.backward()
-        sync_grads(self._actor)
-        self._actor_optim.step()
+        self._optimizer_step(actor_loss, self._actor_optim, self._actor)
 
         # update alpha
-        alpha_loss = -(alpha * (log_pi + self._target_entropy).detach()).mean()
-        self._alpha_optim.zero_grad()
-        alpha_loss.backward()
-        self._alpha_optim.step()
+        alpha_loss = -(alpha * (log_pi.float() + self._target_entropy).detach()).mean()
+        self._optimizer_step(alpha_loss, self._alpha_optim)
 
         return info
 
-    def _update_critic(self, o, ac, rew, o_next, done):
-        info = Info()
-
-        # calculate the target Q value function
-        with torch.no_grad():
-            alpha = self._log_alpha.exp().detach()
-            actions_next, _, log_pi_next, _ = self._actor.act(
-                o_next, return_log_prob=True
-            )
-            q_next_value1, q_next_value2 = self._critic_target(o_next, actions_next)
-            q_next_value = torch.min(q_next_value1, q_next_value2) - alpha * log_pi_next
-            target_q_value = (
-                rew * self._config.reward_scale
-                + (1 - done) * self._config.rl_discount_factor * q_next_value
-            )
+    def _update_critic(self, o, ac, rew, o_next, done, weights=None, idxs=None):
+        """
+        Updates the critics. With prioritized replay, @weights are the
+        importance-sampling weights of the batch and the priorities of
+        transitions @idxs are set to their TD errors.
+        """
+        info = DeviceInfo()
+
+        with self._autocast():
+            # calculate the target Q value function
+            with torch.no_grad():
+                alpha = self._log_alpha.exp().detach()
+                actions_next, _, log_pi_next, _ = self._actor.act(
+                    o_next, return_log_prob=True
+                )
+                q_next_value1, q_next_value2 = self._critic_target(
+                    o_next, actions_next
+                )
+                q_next_value = (
+                    torch.min(q_next_value1, q_next_value2) - alpha * log_pi_next
+                )
+                target_q_value = (
+                    rew * self._config.reward_scale
+                    + (1 - done) * self._config.rl_discount_factor * q_next_value
+                ).float()
 
-        # the q loss
-        real_q_value1, real_q_value2 = self._critic(o, ac)
-        critic1_loss = F.mse_loss(target_q_value, real_q_value1)
-        critic2_loss = F.mse_loss(target_q_value, real_q_value2)
-        critic_loss = critic1_loss + critic2_loss
+            # the q loss
+            real_q_value1, real_q_value2 = self._critic(o, ac)
+            critic1_loss = weighted_mse_loss(real_q_value1, target_q_value, weights)
+            critic2_loss = weighted_mse_loss(real_q_value2, target_q_value, weights)
+            critic_loss = critic1_loss + critic2_loss
 
         # update the critic
-        self._critic_optim.zero_grad()
-        critic_loss.backward()
-        sync_grads(self._critic)
-        self._critic_optim.step()
-
-        info["min_target_q"] = target_q_value.min().cpu().item()
-        info["target_q"] = target_q_value.mean().cpu().item()
-        info["min_real1_q"] = real_q_value1.min().cpu().item()
-        info["min_real2_q"] = real_q_value2.min().cpu().item()
-        info["real1_q"] = real_q_value1.mean().cpu().item()
-        info["real2_q"] = real_q_value2.mean().cpu().item()
-        info["critic1_loss"] = critic1_loss.cpu().item()
-        info["critic2_loss"] = critic2_loss.cpu().item()
+        self._optimizer_step(critic_loss, self._critic_optim, self._critic)
+
+        if idxs is not None:
+            td_error = (
+                (target_q_value - real_q_value1).abs()
+                + (target_q_value - real_q_value2).abs()
+            ) / 2
+            self._buffer.update_priorities(idxs, td_error.detach().cpu().numpy())
+
+        info["min_target_q"] = target_q_value.min().detach()
+        info["target_q"] = target_q_value.mean().detach()
+        info["min_real1_q"] = real_q_value1.min().detach()
+        info["min_real2_q"] = real_q_value2.min().detach()
+        info["real1_q"] = real_q_value1.mean().detach()
+        info["real2_q"] = real_q_value2.mean().detach()
+        info["critic1_loss"] = critic1_loss.detach()
+        info["critic2_loss"] = critic2_loss.detach()
 
         return info
 
+    def _to_device(self, transitions):
+        """ Copies @transitions to the device and normalizes observations there. """
+        bs = len(transitions["done"])
+        _to_tensor = lambda x: to_tensor(x, self._config.device)
+        batch = {
+            "ob": self.normalize(_to_tensor(transitions["ob"])),
+            "ob_next": self.normalize(_to_tensor(transitions["ob_next"])),
+            "ac": _to_tensor(transitions["ac"]),
+            "done": _to_tensor(transitions["done"]).reshape(bs, 1),
+            "rew": _to_tensor(transitions["rew"]).reshape(bs, 1),
+        }
+        if "weights" in transitions:
+            batch["weights"] = _to_tensor(transitions["weights"]).reshape(bs, 1)
+            batch["idxs"] = transitions["idxs"]
+        return batch
+
     def _update_network(self, transitions):
-        info = Info()
+        """ Updates networks with @transitions, a minibatch from _to_device. """
+        info = DeviceInfo()
 
-        # pre-process observations
         o, o_next = transitions["ob"], transitions["ob_next"]
-        o = self.normalize(o)
-        o_next = self.normalize(o_next)
-
-        bs = len(transitions["done"])
-        _to_tensor = lambda x: to_tensor(x, self._config.device)
-        o = _to_tensor(o)
-        o_next = _to_tensor(o_next)
-        ac = _to_tensor(transitions["ac"])
-        done = _to_tensor(transitions["done"]).reshape(bs, 1).float()
-        rew = _to_tensor(transitions["rew"]).reshape(bs, 1)
+        ac, done, rew = transitions["ac"], transitions["done"], transitions["rew"]
+        weights = transitions.get("weights")
+        idxs = transitions.get("idxs")
 
         self._update_iter += 1
 
-        critic_train_info = self._update_critic(o, ac, rew, o_next, done)
+        critic_train_info = self._update_critic(
+            o, ac, rew, o_next, done, weights, idxs
+        )
         info.add(critic_train_info)
 
         if self._update_iter % self._config.actor_update_freq == 0:
@@ -265,16 +296,6 @@ class SACAgent(BaseAgent):
             info.add(actor_train_info)
 
         if self._update_iter % self._config.critic_target_update_freq == 0:
-            for i, fc in enumerate(self._critic.fcs):
-                self._soft_update_target_network(
-                    self._critic_target.fcs[i],
-                    fc,
-                    self._config.critic_soft_update_weight,
-                )
-            self._soft_update_target_network(
-                self._critic_target.encoder,
-                self._critic.encoder,
-                self._config.encoder_soft_update_weight,
-            )
+            self._critic_target_averager.update()
 
-        return info.get_dict(only_scalar=True)
+        return info
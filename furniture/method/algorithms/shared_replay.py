@@ -0,0 +1,183 @@
+"""
+Replay buffer in shared memory that all MPI ranks of a node write into and
+sample from.
+"""
+
+import os
+import uuid
+
+import numpy as np
+from mpi4py import MPI
+
+from .dataset import (
+    add_rollout,
+    augment_ob,
+    episode_length,
+    get_batch,
+    get_layout,
+    nest,
+    open_arrays,
+    slice_buffer,
+)
+from ..utils.logger import logger
+
+
+class SharedReplayBuffer(object):
+    """
+    Per-step ring buffer whose arrays are memory-mapped files in @shm_dir
+    (/dev/shm by default) shared by all MPI ranks on a node, so images are
+    stored once per node and every learner samples from the data of all local
+    ranks.
+
+    The capacity is split into one shard per local rank. A rank only writes
+    its own shard and publishes the shard's write index and size in a small
+    shared table, so no locks are needed. Sampling is uniform over the filled
+    part of all shards.
+
+    Arrays are created from the first stored transition. The first call of
+    store_episode (and load_state_dict) is collective over the ranks of a node.
+    """
+
+    def __init__(self, keys, buffer_size, shm_dir="/dev/shm", image_crop_size=84):
+        """
+        Args:
+            keys: keys of transitions to store.
+            buffer_size: number of transitions stored on a node.
+            shm_dir: directory for the shared files (ideally a tmpfs).
+            image_crop_size: size of random crops of sampled images.
+        """
+        self._keys = keys
+        self._image_crop_size = image_crop_size
+
+        self._comm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+        self._shard = self._comm.Get_rank()
+        self._num_shards = self._comm.Get_size()
+        self._shard_size = buffer_size // self._num_shards
+        self._capacity = self._shard_size * self._num_shards
+
+        path = None
+        if self._shard == 0:
+            path = os.path.join(shm_dir, "replay_%s" % uuid.uuid4().hex)
+            os.makedirs(path)
+        self._path = self._comm.bcast(path, root=0)
+
+        # write index and size of each shard (new files are zero-filled)
+        self._meta = self._open(
+            {"meta": ((2,), np.dtype(np.int64).str)}, self._num_shards
+        )["meta"]
+        self._buffer = None
+
+    def _open(self, layout, capacity, init=None):
+        """
+        Creates arrays on the first local rank, which fills them with
+        @init(arrays), and opens them on the others.
+        """
+        if self._shard == 0:
+            arrays = nest(open_arrays(self._path, layout, capacity, "w+"))
+            if init is not None:
+                init(arrays)
+        self._comm.Barrier()
+        if self._shard != 0:
+            arrays = nest(open_arrays(self._path, layout, capacity, "r+"))
+        self._comm.Barrier()
+        if self._shard == 0:
+            # mapped files stay valid until every rank unmaps them
+            for k in layout.keys():
+                os.remove(os.path.join(self._path, k + ".npy"))
+        return arrays
+
+    def _allocate(self, example, init=None):
+        layout = self._comm.bcast(get_layout(example), root=0)
+        self._buffer = self._open(layout, self._capacity, init)
+        if self._shard == 0:
+            os.rmdir(self._path)
+            size = sum(
+                np.prod(shape) * np.dtype(dtype).itemsize
+                for shape, dtype in layout.values()
+            )
+            logger.info(
+                "Shared replay buffer of %d transitions (%.1f GB) for %d ranks",
+                self._capacity,
+                size * self._capacity / 1e9,
+                self._num_shards,
+            )
+
+    def clear(self):
+        self._meta[self._shard] = 0
+
+    def __len__(self):
+        return int(self._meta[:, 1].sum())
+
+    def store_episode(self, rollout):
+        """ Copies a columnar @rollout into this rank's shard. """
+        rollout = {k: rollout[k] for k in self._keys}
+        if self._buffer is None:
+            self._allocate(slice_buffer(rollout, 0))
+
+        n = episode_length(rollout["done"])
+        idx, size = self._meta[self._shard]
+        idxs = self._shard * self._shard_size + (idx + np.arange(n)) % self._shard_size
+        add_rollout(self._buffer, rollout, idxs)
+
+        # publish the new transitions after they are written
+        self._meta[self._shard] = [
+            (idx + n) % self._shard_size,
+            min(size + n, self._shard_size),
+        ]
+
+    def _sample_idxs(self, batch_size):
+        sizes = self._meta[:, 1].copy()
+        ends = np.cumsum(sizes)
+        idxs = np.random.randint(0, ends[-1], size=batch_size)
+        shards = np.searchsorted(ends, idxs, side="right")
+        return shards * self._shard_size + idxs - (ends - sizes)[shards]
+
+    def sample(self, batch_size):
+        batch = get_batch(self._buffer, self._sample_idxs(batch_size))
+
+        # apply random crop to image
+        augment_ob(batch, self._image_crop_size)
+
+        return batch
+
+    def state_dict(self):
+        """ Returns the transitions of all shards in a compact form. """
+        if self._buffer is None:
+            return {"buffer": None}
+
+        def valid(x):
+            if isinstance(x, dict):
+                return {k: valid(v) for k, v in x.items()}
+            return np.concatenate(
+                [
+                    x[i * self._shard_size : i * self._shard_size + size]
+                    for i, size in enumerate(self._meta[:, 1])
+                ]
+            )
+
+        return {"buffer": valid(self._buffer)}
+
+    def load_state_dict(self, state_dict):
+        """
+        Distributes stored transitions over the shards. Only the state of the
+        first local rank is used, and the call pairs with the first
+        store_episode of the other ranks if they have no state to load.
+        """
+        buffer = state_dict["buffer"]
+        if buffer is None:
+            return
+
+        def init(arrays):
+            n = episode_length(buffer["done"])
+            bounds = np.linspace(0, n, self._num_shards + 1).astype(int)
+            for i in range(self._num_shards):
+                m = min(bounds[i + 1] - bounds[i], self._shard_size)
+                start = bounds[i + 1] - m
+                idxs = i * self._shard_size + np.arange(m)
+                add_rollout(arrays, slice_buffer(buffer, slice(start, start + m)), idxs)
+                self._meta[i] = [m % self._shard_size, m]
+
+        if self._buffer is None:
+            self._allocate(slice_buffer(buffer, 0), init)
+        elif self._shard == 0:
+            init(self._buffer)
@@ -0,0 +1,543 @@
+"""
+Micro-benchmarks of per-step overheads in the training loop.
+
+python -m furniture.method.benchmark --bench act --encoder_type cnn --gpu 0
+python -m furniture.method.benchmark --bench replay --bench_buffer_size 1000000
+python -m furniture.method.benchmark --bench sampler
+mpirun -np 4 python -m furniture.method.benchmark --bench sync
+python -m furniture.method.benchmark --bench update --encoder_type cnn --gpu 0
+mpirun -np 4 python -m furniture.method.benchmark --bench normalizer --gpu 0
+"""
+
+import copy
+import logging
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import gym.spaces
+from mpi4py import MPI
+
+from .config import create_parser
+from .algorithms.base_agent import BaseAgent
+from .algorithms.dataset import EpisodeArrays, HERSampler, SeqSampler, get_batch
+from .algorithms.prioritized_replay import PrioritizedReplayBuffer
+from .networks import Actor, Critic
+from .utils.logger import logger
+from .utils.normalizer import Normalizer
+from .utils.pytorch import (
+    to_tensor,
+    center_crop,
+    set_sync_options,
+    _get_network_sync,
+)
+
+
+def _make_spaces(config):
+    """ Returns observation and action spaces resembling the furniture env. """
+    ob_space = OrderedDict(
+        [
+            ("robot_ob", gym.spaces.Box(-1, 1, (38,), np.float32)),
+            ("object_ob", gym.spaces.Box(-1, 1, (14,), np.float32)),
+        ]
+    )
+    if config.encoder_type == "cnn":
+        size = config.screen_height
+        ob_space["camera_ob"] = gym.spaces.Box(0, 255, (3, size, size), np.uint8)
+    ac_space = gym.spaces.Dict(
+        [
+            ("default", gym.spaces.Box(-1, 1, (7,), np.float32)),
+            ("connect", gym.spaces.Box(-1, 1, (1,), np.float32)),
+        ]
+    )
+    return gym.spaces.Dict(ob_space), ac_space
+
+
+def _legacy_act(agent, ob, is_train=True):
+    """ Reference implementation of BaseAgent.act without the inference path. """
+    config = agent._config
+    ob = agent.normalize(ob)
+
+    ob = ob.copy()
+    for k, v in ob.items():
+        if config.encoder_type == "cnn" and len(v.shape) == 3:
+            ob[k] = center_crop(v, config.encoder_image_size)
+        else:
+            ob[k] = np.expand_dims(ob[k], axis=0)
+
+    with torch.no_grad():
+        ob = to_tensor(ob, config.device)
+        ac, activation, _, _ = agent._actor.act(ob, deterministic=not is_train)
+
+    for k in ac.keys():
+        ac[k] = ac[k].cpu().numpy().squeeze(0)
+        activation[k] = activation[k].cpu().numpy().squeeze(0)
+
+    return ac, activation
+
+
+def _time(fn, num_iter, num_warmup=20):
+    """ Returns the mean time of @fn() in seconds. """
+    for _ in range(num_warmup):
+        fn()
+    start = time.time()
+    for _ in range(num_iter):
+        fn()
+    return (time.time() - start) / num_iter
+
+
+def bench_act(config):
+    """ Measures the per-step overhead of BaseAgent.act and batch_act. """
+    ob_space, ac_space = _make_spaces(config)
+    agent = BaseAgent(config, ob_space)
+    agent._actor = Actor(config, ob_space, ac_space, config.tanh_policy)
+    agent._actor.to(config.device)
+    agent.update_normalizer([ob_space.sample() for _ in range(100)])
+
+    obs = [ob_space.sample() for _ in range(config.bench_batch_size)]
+    batch = OrderedDict([(k, np.stack([ob[k] for ob in obs])) for k in ob_space.spaces])
+
+    results = OrderedDict()
+    results["legacy act"] = _time(lambda: _legacy_act(agent, obs[0]), config.bench_iter)
+    results["act"] = _time(lambda: agent.act(obs[0]), config.bench_iter)
+    results["act x %d" % len(obs)] = _time(
+        lambda: [agent.act(ob) for ob in obs], config.bench_iter // len(obs) + 1
+    )
+    results["batch_act (%d)" % len(obs)] = _time(
+        lambda: agent.batch_act(batch), config.bench_iter
+    )
+
+    logger.info("encoder: %s, device: %s", config.encoder_type, config.device)
+    for k, v in results.items():
+        logger.info("%-20s %8.3f ms", k, v * 1000)
+    return results
+
+
+def _make_rollout(ob_space, ac_space, length):
+    """ Returns a columnar rollout of @length random transitions. """
+    def sample(space):
+        return OrderedDict(
+            [
+                (k, np.stack([v.sample() for _ in range(length)]))
+                for k, v in space.spaces.items()
+            ]
+        )
+
+    return {
+        "ob": sample(ob_space),
+        "ob_next": sample(ob_space),
+        "ac": sample(ac_space),
+        "done": np.zeros(length, dtype=np.float32),
+        "rew": np.random.randn(length).astype(np.float32),
+    }
+
+
+def bench_replay(config):
+    """ Measures sampling throughput of uniform and prioritized replay. """
+    ob_space, ac_space = _make_spaces(config)
+    keys = ["ob", "ob_next", "ac", "done", "rew"]
+    batch_size = config.batch_size
+    rollout = _make_rollout(ob_space, ac_space, 1000)
+
+    buffer = PrioritizedReplayBuffer(
+        keys,
+        config.bench_buffer_size,
+        config.encoder_image_size,
+        alpha=config.per_alpha,
+        beta=config.per_beta,
+        eps=config.per_eps,
+    )
+    for _ in range(-(-config.bench_buffer_size // 1000)):
+        buffer.store_episode(rollout)
+    td_errors = np.random.exponential(size=batch_size)
+    batch = buffer.sample(batch_size)
+    buffer.update_priorities(batch["idxs"], td_errors)
+
+    results = OrderedDict()
+    results["uniform sample"] = _time(
+        lambda: get_batch(
+            buffer._buffer, np.random.randint(0, len(buffer), size=batch_size)
+        ),
+        config.bench_iter,
+    )
+    results["prioritized sample"] = _time(
+        lambda: buffer.sample(batch_size), config.bench_iter
+    )
+    results["update_priorities"] = _time(
+        lambda: buffer.update_priorities(batch["idxs"], td_errors), config.bench_iter
+    )
+
+    logger.info("capacity: %d, batch size: %d", len(buffer), batch_size)
+    for k, v in results.items():
+        logger.info(
+            "%-20s %8.3f ms %10.0f transitions/s", k, v * 1000, batch_size / v
+        )
+    return results
+
+
+def _goal_reward(ag, g, info):
+    """ Sparse goal-reaching reward of (batches of) achieved goals @ag. """
+    return -(np.linalg.norm(ag - g, axis=-1) > 0.05).astype(np.float32)
+
+
+def _legacy_seq_sample(seq_length, episode_batch, batch_size):
+    """ Reference implementation of SeqSampler with per-sample loops. """
+    episode_idxs = np.random.randint(0, len(episode_batch["ac"]), batch_size)
+    t_samples = [np.random.randint(len(episode_batch["ac"][i])) for i in episode_idxs]
+    transitions = {
+        key: [episode_batch[key][i][t] for i, t in zip(episode_idxs, t_samples)]
+        for key in episode_batch.keys()
+    }
+    sequences = []
+    for i, t in zip(episode_idxs, t_samples):
+        seq = episode_batch["ob"][i][t : t + seq_length]
+        seq = seq + seq[-1:] * (seq_length - len(seq))
+        sequences.append({"ob": np.array([x for ob in seq for x in ob["ob"]])})
+    transitions["following_sequences"] = sequences
+
+    new_transitions = {}
+    for k, v in transitions.items():
+        if isinstance(v[0], dict):
+            new_transitions[k] = {
+                sub_key: np.stack([v_[sub_key] for v_ in v]) for sub_key in v[0]
+            }
+        else:
+            new_transitions[k] = np.stack(v)
+    return new_transitions
+
+
+def _legacy_her_sample(future_p, reward_func, episode_batch, batch_size):
+    """ Reference implementation of HERSampler with per-sample loops. """
+    episode_idxs = np.random.randint(0, len(episode_batch["ac"]), batch_size)
+    t_samples = [np.random.randint(len(episode_batch["ac"][i])) for i in episode_idxs]
+    transitions = {
+        key: [episode_batch[key][i][t] for i, t in zip(episode_idxs, t_samples)]
+        for key in episode_batch.keys()
+    }
+    transitions["ob_next"] = [
+        episode_batch["ob"][i][t + 1] for i, t in zip(episode_idxs, t_samples)
+    ]
+    transitions["r"] = np.zeros((batch_size,))
+    for j, (i, t) in enumerate(zip(episode_idxs, t_samples)):
+        if np.random.uniform() < future_p:
+            future_t = np.random.randint(t + 1, len(episode_batch["ac"][i]) + 1)
+            future_ag = episode_batch["ag"][i][future_t]
+            if reward_func(episode_batch["ag"][i][t], future_ag, None) < 0:
+                transitions["g"][j] = future_ag
+        transitions["r"][j] = reward_func(
+            episode_batch["ag"][i][t + 1], transitions["g"][j], None
+        )
+
+    new_transitions = {}
+    for k, v in transitions.items():
+        if isinstance(v[0], dict):
+            new_transitions[k] = {
+                sub_key: np.stack([v_[sub_key] for v_ in v]) for sub_key in v[0]
+            }
+        else:
+            new_transitions[k] = np.stack(v)
+    return new_transitions
+
+
+def bench_sampler(config):
+    """ Measures SeqSampler and HERSampler against per-sample loops. """
+    num_episodes, length, seq_length = config.bench_num_episodes, 50, 10
+    batch_size = config.batch_size
+    keys = ["ob", "ob_next", "ag", "g", "ac", "done"]
+    # "ob" and "ag" have the final observation of an episode
+    sizes = {"ob": length + 1, "ob_next": length, "ag": length + 1, "g": length}
+    dims = {"ob": 30, "ob_next": 30, "ag": 3, "g": 3, "ac": 7, "done": None}
+
+    episodes = EpisodeArrays(keys, num_episodes)
+    legacy = {k: [] for k in keys}
+    for i in range(num_episodes):
+        episode = {}
+        for k in keys:
+            shape = (sizes.get(k, length),) + ((dims[k],) if dims[k] else ())
+            episode[k] = np.random.randn(*shape).astype(np.float32)
+        episode["ob"] = {"ob": episode["ob"]}
+        episode["ob_next"] = {"ob": episode["ob_next"]}
+        episodes.set(i, episode)
+        for k in keys:
+            if isinstance(episode[k], dict):
+                legacy[k].append([{"ob": x} for x in episode[k]["ob"]])
+            else:
+                legacy[k].append(list(episode[k]))
+
+    seq_sampler = SeqSampler(seq_length)
+    her_sampler = HERSampler("future", 0.8, _goal_reward)
+
+    results = OrderedDict()
+    results["legacy SeqSampler"] = _time(
+        lambda: _legacy_seq_sample(seq_length, legacy, batch_size), config.bench_iter
+    )
+    results["SeqSampler"] = _time(
+        lambda: seq_sampler.sample_func(episodes, batch_size), config.bench_iter
+    )
+    results["legacy HERSampler"] = _time(
+        lambda: _legacy_her_sample(0.8, _goal_reward, legacy, batch_size),
+        config.bench_iter,
+    )
+    results["HERSampler"] = _time(
+        lambda: her_sampler.sample_her_transitions(episodes, batch_size),
+        config.bench_iter,
+    )
+
+    logger.info("episodes: %d, batch size: %d", num_episodes, batch_size)
+    for k, v in results.items():
+        logger.info(
+            "%-20s %8.3f ms %10.0f transitions/s", k, v * 1000, batch_size / v
+        )
+    return results
+
+
+def _legacy_sync_networks(network):
+    """ Reference implementation of sync_networks with per-call flattening. """
+    flat_params, shapes = None, []
+    for value in network.parameters():
+        shapes.append(value.shape)
+        value = value.cpu().detach().numpy().flatten()
+        flat_params = value if flat_params is None else np.append(flat_params, value)
+    MPI.COMM_WORLD.Bcast(flat_params, root=0)
+    pointer = 0
+    for value, shape in zip(network.parameters(), shapes):
+        size = int(np.prod(shape))
+        param = flat_params[pointer : pointer + size].reshape(shape)
+        value.data.copy_(torch.tensor(param).to(value.device))
+        pointer += size
+
+
+def _legacy_sync_grads(network):
+    """ Reference implementation of sync_grads with per-call flattening. """
+    flat_grads, shapes = None, []
+    for value in network.parameters():
+        shapes.append(value.grad.shape)
+        grad = value.grad.data.cpu().numpy().flatten()
+        flat_grads = grad if flat_grads is None else np.append(flat_grads, grad)
+    global_grads = np.zeros_like(flat_grads)
+    MPI.COMM_WORLD.Allreduce(flat_grads, global_grads, op=MPI.SUM)
+    pointer = 0
+    for value, shape in zip(network.parameters(), shapes):
+        size = int(np.prod(shape))
+        grad = global_grads[pointer : pointer + size].reshape(shape)
+        value.grad.data.copy_(torch.tensor(grad).to(value.device))
+        pointer += size
+
+
+def bench_sync(config):
+    """
+    Measures parameter broadcast and gradient all-reduce of a critic. Run with
+    mpirun -np N for 1 to 16 ranks.
+    """
+    ob_space, ac_space = _make_spaces(config)
+    obs = [ob_space.sample() for _ in range(config.batch_size)]
+    acs = [ac_space.sample() for _ in range(config.batch_size)]
+    ob = to_tensor(
+        OrderedDict([(k, np.stack([o[k] for o in obs])) for k in ob_space.spaces]),
+        config.device,
+    )
+    ac = to_tensor(
+        OrderedDict([(k, np.stack([a[k] for a in acs])) for k in ac_space.spaces]),
+        config.device,
+    )
+
+    def make_critic(overlap):
+        set_sync_options(config.sync_bucket_size, overlap)
+        critic = Critic(config, ob_space, ac_space).to(config.device)
+        critic(ob, ac).mean().backward()
+        return critic
+
+    def backward(critic):
+        critic.zero_grad()
+        critic(ob, ac).mean().backward()
+
+    # call the communication layer directly so that one rank is measured too
+    critic = make_critic(False)
+    sync = _get_network_sync(critic)
+    critic_overlap = make_critic(True)
+    sync_overlap = _get_network_sync(critic_overlap)
+    num_params = sum(p.numel() for p in critic.parameters())
+
+    def timed(fn):
+        MPI.COMM_WORLD.Barrier()
+        return _time(fn, config.bench_iter)
+
+    results = OrderedDict()
+    results["legacy sync_networks"] = timed(lambda: _legacy_sync_networks(critic))
+    results["sync_networks"] = timed(sync.broadcast_params)
+    results["legacy sync_grads"] = timed(
+        lambda: (backward(critic), _legacy_sync_grads(critic))
+    )
+    results["sync_grads"] = timed(lambda: (backward(critic), sync.reduce_grads()))
+    results["sync_grads overlap"] = timed(
+        lambda: (backward(critic_overlap), sync_overlap.reduce_grads())
+    )
+
+    logger.info(
+        "ranks: %d, parameters: %d, device: %s",
+        MPI.COMM_WORLD.Get_size(),
+        num_params,
+        config.device,
+    )
+    for k, v in results.items():
+        logger.info("%-24s %8.3f ms", k, v * 1000)
+    return results
+
+
+def bench_update(config):
+    """
+    Measures critic updates with a CNN encoder in each precision with and
+    without the channels-last layout. The final loss of regressing random
+    targets checks that the modes train alike.
+    """
+    assert config.encoder_type == "cnn", "Set --encoder_type cnn"
+    ob_space, ac_space = _make_spaces(config)
+    size = config.encoder_image_size
+    ob_space.spaces["camera_ob"] = gym.spaces.Box(0, 255, (3, size, size), np.uint8)
+    obs = [ob_space.sample() for _ in range(config.batch_size)]
+    acs = [ac_space.sample() for _ in range(config.batch_size)]
+    ob = to_tensor(
+        OrderedDict([(k, np.stack([o[k] for o in obs])) for k in ob_space.spaces]),
+        config.device,
+    )
+    ac = to_tensor(
+        OrderedDict([(k, np.stack([a[k] for a in acs])) for k in ac_space.spaces]),
+        config.device,
+    )
+    target = torch.randn(config.batch_size, 1, device=config.device)
+
+    precisions = ["fp32", "bf16"]
+    if config.device.type == "cuda":
+        precisions.append("fp16")
+
+    results = OrderedDict()
+    for precision in precisions:
+        for channels_last in [False, True]:
+            mode_config = copy.copy(config)
+            mode_config.precision = precision
+            mode_config.channels_last = channels_last
+            torch.manual_seed(config.seed)
+            agent = BaseAgent(mode_config, ob_space)
+            critic = Critic(mode_config, ob_space, ac_space).to(config.device)
+            optim = torch.optim.Adam(critic.parameters(), lr=config.critic_lr)
+            losses = []
+
+            def update():
+                with agent._autocast():
+                    loss = ((critic(ob, ac).float() - target) ** 2).mean()
+                agent._optimizer_step(loss, optim, critic)
+                losses.append(loss.detach())
+                if config.device.type == "cuda":
+                    torch.cuda.synchronize()
+
+            name = "%s%s" % (precision, " channels_last" if channels_last else "")
+            results[name] = (_time(update, config.bench_iter), losses[-1].item())
+
+    logger.info("batch size: %d, device: %s", config.batch_size, config.device)
+    for k, (t, loss) in results.items():
+        logger.info("%-20s %8.3f ms  final loss %.4f", k, t * 1000, loss)
+    return results
+
+
+def bench_normalizer(config):
+    """
+    Measures per-step normalizer updates in each mode and normalization of a
+    batch on the host and on the device. The error of std on observations
+    with a large offset compares the accuracy of the modes.
+    """
+    ob_space, _ = _make_spaces(config)
+    ob_space.spaces.pop("camera_ob", None)
+    obs = [
+        OrderedDict([(k, v.sample() + 1e3) for k, v in ob_space.spaces.items()])
+        for _ in range(config.bench_iter + 20)
+    ]
+    batch = OrderedDict(
+        [(k, np.stack([ob[k] for ob in obs[: config.batch_size]])) for k in ob_space.spaces]
+    )
+    modes = [
+        ("sum", 1),
+        ("welford", 1),
+        ("welford", config.ob_norm_sync_interval),
+    ]
+
+    results = OrderedDict()
+    for mode, sync_interval in modes:
+        norm = Normalizer(
+            ob_space,
+            default_clip_range=config.clip_range,
+            clip_obs=np.inf,
+            mode=mode,
+            sync_interval=sync_interval,
+        )
+        it = iter(obs)
+
+        def update():
+            norm.update(next(it))
+            norm.recompute_stats()
+
+        MPI.COMM_WORLD.Barrier()
+        t = _time(update, config.bench_iter)
+        norm.sync()
+        norm.recompute_stats()
+        error = max(
+            np.abs(norm.sub_norm[k].std - np.std([ob[k] for ob in obs], axis=0)).max()
+            for k in ob_space.spaces
+        )
+        results["%s update (sync %d)" % (mode, sync_interval)] = (t, error)
+
+    tensor = to_tensor(batch, config.device)
+    results["normalize numpy"] = (_time(lambda: norm.normalize(batch), config.bench_iter), 0)
+    results["normalize tensor"] = (
+        _time(lambda: norm.normalize(tensor), config.bench_iter),
+        0,
+    )
+
+    logger.info("ranks: %d, device: %s", MPI.COMM_WORLD.Get_size(), config.device)
+    for k, (t, error) in results.items():
+        logger.info("%-26s %8.3f ms  std error %.2e", k, t * 1000, error)
+    return results
+
+
+BENCHMARKS = OrderedDict(
+    [
+        ("act", bench_act),
+        ("replay", bench_replay),
+        ("sampler", bench_sampler),
+        ("sync", bench_sync),
+        ("update", bench_update),
+        ("normalizer", bench_normalizer),
+    ]
+)
+
+
+def main():
+    parser = create_parser()
+    parser.add_argument(
+        "--bench", type=str, default="act", choices=list(BENCHMARKS.keys())
+    )
+    parser.add_argument("--bench_iter", type=int, default=1000)
+    parser.add_argument("--bench_batch_size", type=int, default=16)
+    parser.add_argument("--bench_buffer_size", type=int, default=int(1e6))
+    parser.add_argument("--bench_num_episodes", type=int, default=1000)
+    config, unparsed = parser.parse_known_args()
+    if len(unparsed):
+        logger.error("Unparsed argument is detected:\n%s", unparsed)
+        return
+
+    if config.gpu is not None:
+        assert torch.cuda.is_available()
+        config.device = torch.device("cuda", config.gpu)
+    else:
+        config.device = torch.device("cpu")
+    config.is_chef = MPI.COMM_WORLD.Get_rank() == 0
+    if not config.is_chef:
+        logger.setLevel(logging.CRITICAL)
+
+    np.random.seed(config.seed)
+    torch.manual_seed(config.seed)
+    BENCHMARKS[config.bench](config)
+
+
+if __name__ == "__main__":
+    main()
@@ -57,6 +57,71 @@ def add_method_arguments(parser):
     parser.add_argument("--init_ckpt_path", type=str, default=None)
     parser.add_argument("--gpu", type=int, default=None)
 
+    # MPI training
+    parser.add_argument(
+        "--sync_bucket_size",
+        type=int,
+        default=2 ** 20,
+        help="number of parameters in a bucket of gradient all-reduce",
+    )
+    parser.add_argument(
+        "--sync_grads_overlap",
+        type=str2bool,
+        default=False,
+        help="all-reduce gradient buckets during the backward pass "
+        "(gradient clipping before sync_grads is ignored)",
+    )
+
+    # parallel rollouts
+    parser.add_argument(
+        "--num_rollout_workers",
+        type=int,
+        default=0,
+        help="number of rollout processes served by a batched policy server",
+    )
+    parser.add_argument(
+        "--policy_server_batch_size",
+        type=int,
+        default=0,
+        help="maximum batch size of the policy server (0 for all workers)",
+    )
+    parser.add_argument(
+        "--policy_server_latency",
+        type=float,
+        default=2.0,
+        help="maximum time in ms the policy server waits for a batch to fill",
+    )
+    parser.add_argument(
+        "--policy_sync_interval",
+        type=int,
+        default=1,
+        help="number of updates between sending weights to the policy server",
+    )
+    parser.add_argument(
+        "--async_rollout",
+        type=str2bool,
+        default=False,
+        help="train off-policy agents while rollout workers collect transitions",
+    )
+    parser.add_argument(
+        "--async_utd_ratio",
+        type=float,
+        default=1.0,
+        help="number of updates per environment step in asynchronous training",
+    )
+    parser.add_argument(
+        "--async_chunk_steps",
+        type=int,
+        default=50,
+        help="number of transitions a rollout worker sends at once",
+    )
+    parser.add_argument(
+        "--async_queue_size",
+        type=int,
+        default=64,
+        help="maximum number of chunks waiting to be stored to the replay buffer",
+    )
+
     # evaluation
     parser.add_argument("--ckpt_num", type=int, default=None)
     parser.add_argument(
@@ -91,6 +156,18 @@ def add_method_arguments(parser):
     parser.add_argument("--wandb_project", type=str, default="robot-learning")
     parser.add_argument("--record_video", type=str2bool, default=True)
     parser.add_argument("--record_video_caption", type=str2bool, default=True)
+    parser.add_argument(
+        "--record_video_stream",
+        type=str2bool,
+        default=True,
+        help="encode evaluation videos with ffmpeg on a background thread",
+    )
+    parser.add_argument(
+        "--video_queue_size",
+        type=int,
+        default=64,
+        help="maximum number of frames waiting to be encoded",
+    )
     try:
         parser.add_argument("--record_demo", type=str2bool, default=False)
     except:
@@ -99,6 +176,20 @@ def add_method_arguments(parser):
     # observation normalization
     parser.add_argument("--ob_norm", type=str2bool, default=True)
     parser.add_argument("--max_ob_norm_step", type=int, default=int(1e8))
+    parser.add_argument(
+        "--ob_norm_mode",
+        type=str,
+        default="sum",
+        choices=["sum", "welford"],
+        help="sum: sync sums across workers on every update; "
+        "welford: accumulate Welford statistics and sync every --ob_norm_sync_interval updates",
+    )
+    parser.add_argument(
+        "--ob_norm_sync_interval",
+        type=int,
+        default=1,
+        help="number of normalizer updates between syncs in welford mode",
+    )
     parser.add_argument(
         "--clip_obs", type=float, default=200, help="the clip range of observation"
     )
@@ -167,18 +258,41 @@ def add_policy_arguments(parser):
     )
     parser.add_argument("--tanh_policy", type=str2bool, default=True)
     parser.add_argument("--gaussian_policy", type=str2bool, default=True)
+    parser.add_argument(
+        "--compile_actor",
+        type=str2bool,
+        default=False,
+        help="compile the actor used for rollouts with torch.compile",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "fp16", "bf16"],
+        help="precision of network updates; fp16 and bf16 use autocast and fp16 "
+        "scales gradients",
+    )
 
     # encoder
     parser.add_argument(
         "--encoder_type", type=str, default="mlp", choices=["mlp", "cnn"]
     )
     parser.add_argument("--encoder_image_size", type=int, default=84)
+    parser.add_argument(
+        "--frame_stack", type=int, default=3, help="number of stacked image frames"
+    )
     parser.add_argument("--random_crop", type=str2bool, default=False)
     parser.add_argument("--encoder_conv_dim", type=int, default=32)
     parser.add_argument("--encoder_kernel_size", type=str2intlist, default=[3, 3, 3, 3])
     parser.add_argument("--encoder_stride", type=str2intlist, default=[2, 1, 1, 1])
     parser.add_argument("--encoder_conv_output_dim", type=int, default=50)
     parser.add_argument("--encoder_soft_update_weight", type=float, default=0.95)
+    parser.add_argument(
+        "--channels_last",
+        type=str2bool,
+        default=False,
+        help="use the channels-last memory layout in CNN encoders",
+    )
     args, unparsed = parser.parse_known_args()
     if args.encoder_type == "cnn":
         parser.set_defaults(screen_width=100, screen_height=100)
@@ -218,12 +332,47 @@ def add_on_policy_arguments(parser):
     parser.add_argument("--rollout_length", type=int, default=2000)
     parser.add_argument("--gae_lambda", type=float, default=0.95)
     parser.add_argument("--advantage_norm", type=str2bool, default=True)
+    parser.add_argument(
+        "--rollout_chunk_size",
+        type=int,
+        default=1024,
+        help="number of transitions per forward pass when evaluating a rollout",
+    )
 
 
 def add_off_policy_arguments(parser):
     parser.add_argument(
         "--buffer_size", type=int, default=int(1e6), help="the size of the buffer"
     )
+    parser.add_argument(
+        "--replay_buffer",
+        type=str,
+        default="episode",
+        choices=["episode", "shared", "frame", "memmap", "prioritized"],
+        help="episode: per-process buffer of episodes, "
+        "shared: buffer in shared memory for all MPI ranks on a node, "
+        "frame: per-step buffer that stores each image frame once, "
+        "memmap: per-step buffer in memory-mapped files in log_dir, "
+        "prioritized: prioritized experience replay",
+    )
+    parser.add_argument(
+        "--shared_replay_dir",
+        type=str,
+        default="/dev/shm",
+        help="directory of the shared replay buffer files",
+    )
+    parser.add_argument(
+        "--per_alpha", type=float, default=0.6, help="prioritization exponent of PER"
+    )
+    parser.add_argument(
+        "--per_beta",
+        type=float,
+        default=0.4,
+        help="importance-sampling exponent of PER",
+    )
+    parser.add_argument(
+        "--per_eps", type=float, default=1e-6, help="minimum priority of PER"
+    )
     parser.set_defaults(warm_up_steps=1000)
 
 
@@ -234,6 +383,13 @@ def add_sac_arguments(parser):
     parser.add_argument("--reward_scale", type=float, default=1.0, help="reward scale")
     parser.add_argument("--actor_update_freq", type=int, default=2)
     parser.add_argument("--critic_target_update_freq", type=int, default=2)
+    parser.add_argument(
+        "--utd_ratio",
+        type=int,
+        default=1,
+        help="number of updates per training step, whose minibatches are "
+        "sampled and copied to the device at once",
+    )
     parser.add_argument("--target_entropy", type=float, default=None)
     parser.add_argument("--alpha_init_temperature", type=float, default=0.1)
     parser.add_argument(
@@ -356,6 +512,13 @@ def add_gail_arguments(parser):
     parser.add_argument("--discriminator_update_freq", type=int, default=4)
     parser.add_argument("--gail_no_action", type=str2bool, default=False)
     parser.add_argument("--gail_env_reward", type=float, default=0.0)
+    parser.add_argument(
+        "--gail_log_reward",
+        type=str2bool,
+        default=True,
+        help="log discriminator rewards of training episodes, predicted in one "
+        "batch at the end of each episode",
+    )
     parser.add_argument("--gail_grad_penalty_coeff", type=float, default=10.0)
 
     parser.add_argument(
@@ -87,7 +87,7 @@ def get_gym_env(env_id, config):
 
     env = DictWrapper(env, return_state=(config.encoder_type == "cnn" and config.asym_ac))
     if config.encoder_type == "cnn":
-        env = FrameStackWrapper(env, frame_stack=3, return_state=(config.encoder_type == "cnn" and config.asym_ac))
+        env = FrameStackWrapper(env, frame_stack=config.frame_stack, return_state=(config.encoder_type == "cnn" and config.asym_ac))
     if config.absorbing_state:
         env = AbsorbingWrapper(env)
 
@@ -15,6 +15,7 @@ from .config import create_parser
 from .trainer import Trainer
 from .utils.logger import logger
 from .utils.mpi import mpi_sync
+from .utils.pytorch import set_sync_options
 
 
 np.set_printoptions(precision=3)
@@ -71,6 +72,8 @@ def run(parser=None):
     else:
         config.device = torch.device("cpu")
 
+    set_sync_options(config.sync_bucket_size, config.sync_grads_overlap)
+
     # build a trainer
     trainer = Trainer(config)
     if config.is_train:
@@ -44,8 +44,8 @@ class Encoder(nn.Module):
         for k, v in ob.items():
             if self.base[k] is not None:
                 if isinstance(self.base[k], CNN):
-                    if v.max() > 1.0:
-                        v = v.float() / 255.0
+                    # images are in [0, 255]
+                    v = v * (1.0 / 255.0)
                 encoder_outputs.append(
                     self.base[k](v, detach_conv=detach_conv)
                 )
@@ -25,8 +25,13 @@ class CNN(nn.Module):
 
         self.apply(weight_init)
 
+        self._memory_format = torch.contiguous_format
+        if config.channels_last:
+            self._memory_format = torch.channels_last
+            self.to(memory_format=self._memory_format)
+
     def forward(self, ob, detach_conv=False):
-        out = ob
+        out = ob.contiguous(memory_format=self._memory_format)
         for conv in self.convs:
             out = F.relu(conv(out))
         out = out.flatten(start_dim=1)
@@ -19,11 +19,14 @@ import moviepy.editor as mpy
 from tqdm import tqdm, trange
 
 from .algorithms import RL_ALGOS, IL_ALGOS, get_agent_by_name
-from .algorithms.rollouts import RolloutRunner
-from .utils.info_dict import Info
+from .algorithms.rollouts import RolloutRunner, unstack_rollout
+from .algorithms.rollout_workers import RolloutWorkers
+from .algorithms.ddpg_agent import DDPGAgent
+from .utils.info_dict import DeviceInfo, Info
 from .utils.logger import logger
 from .utils.pytorch import get_ckpt_path, count_parameters
-from .utils.mpi import mpi_sum, mpi_average, mpi_gather_average
+from .utils.mpi import MetricReducer
+from ..util.video_recorder import VideoStream, ImageEncoder
 from .environments import make_env
 
 
@@ -75,8 +78,32 @@ class Trainer(object):
             config, ob_space, ac_space, env_ob_space
         )
 
+        # background video encoder for evaluation videos
+        self._video_stream = None
+        if self._is_chef and config.record_video and config.record_video_stream:
+            try:
+                ImageEncoder.find_backend()
+                self._video_stream = VideoStream(config.video_queue_size)
+            except ImportError as e:
+                logger.warn("Fall back to moviepy for videos: %s", e)
+
         # build rollout runner
-        self._runner = RolloutRunner(config, self._env, self._env_eval, self._agent)
+        self._runner = RolloutRunner(
+            config, self._env, self._env_eval, self._agent, self._video_stream
+        )
+
+        # rollout processes served by a batched policy server
+        self._rollout_workers = None
+        if config.is_train and config.num_rollout_workers > 0 and config.algo != "bc":
+            rl_agent = getattr(self._agent, "_rl_agent", self._agent)
+            self._rollout_workers = RolloutWorkers(
+                config,
+                ob_space,
+                env_ob_space,
+                ac_space,
+                config.num_rollout_workers,
+                exploration_noise=isinstance(rl_agent, DDPGAgent),
+            )
 
         # setup log
         if self._is_chef and config.is_train:
@@ -153,13 +180,14 @@ class Trainer(object):
         logger.warn("Randomly initialize models")
         return 0, 0
 
-    def _log_train(self, step, train_info, ep_info):
+    def _log_train(self, step, train_info, ep_info, ep_info_max=None):
         """
         Logs training and episode information to wandb.
         Args:
             step: the number of environment steps.
             train_info: training information to log, such as loss, gradient.
             ep_info: episode information to log, such as reward, episode time.
+            ep_info_max: maximum of episode information if @ep_info holds means.
         """
         for k, v in train_info.items():
             if np.isscalar(v) or (hasattr(v, "shape") and np.prod(v.shape) == 1):
@@ -168,8 +196,9 @@ class Trainer(object):
                 wandb.log({"train_rl/%s" % k: [wandb.Image(v)]}, step=step)
 
         for k, v in ep_info.items():
+            v_max = ep_info_max[k] if ep_info_max is not None else np.max(v)
             wandb.log({"train_ep/%s" % k: np.mean(v)}, step=step)
-            wandb.log({"train_ep_max/%s" % k: np.max(v)}, step=step)
+            wandb.log({"train_ep_max/%s" % k: v_max}, step=step)
 
     def _log_test(self, step, ep_info):
         """
@@ -191,6 +220,8 @@ class Trainer(object):
     def train(self):
         """ Trains an agent. """
         config = self._config
+        if config.async_rollout:
+            return self._train_async()
 
         # load checkpoint
         step, update_iter = self._load_ckpt(config.init_ckpt_path, config.ckpt_num)
@@ -203,39 +234,44 @@ class Trainer(object):
             pbar = tqdm(
                 initial=update_iter, total=config.max_global_step, desc=config.run_name
             )
-            ep_info = Info()
-            train_info = Info()
+
+        # metrics of all ranks are reduced in one collective every log_interval
+        metrics = MetricReducer()
+        # training metrics stay on the device until log_interval
+        train_info = DeviceInfo()
 
         # decide how many episodes or how long rollout to collect
         if self._config.algo == "bc":
             runner = None
         elif self._config.algo == "gail":
-            runner = self._runner.run(
-                every_steps=self._config.rollout_length, step=step
-            )
+            runner = self._run(every_steps=self._config.rollout_length, step=step)
         elif self._config.algo == "ppo":
-            runner = self._runner.run(
-                every_steps=self._config.rollout_length, step=step
-            )
+            runner = self._run(every_steps=self._config.rollout_length, step=step)
         elif self._config.algo in ["sac", "ddpg", "td3"]:
-            runner = self._runner.run(every_steps=1, step=step)
-            # runner = self._runner.run(every_episodes=1)
+            runner = self._run(every_steps=1, step=step)
+            # every_episodes runners are not supported, see _run
         elif self._config.algo == "dac":
-            runner = self._runner.run(every_steps=1, step=step)
+            runner = self._run(every_steps=1, step=step)
+
+        if self._rollout_workers is not None:
+            self._rollout_workers.update_weights(self._agent)
 
         st_time = time()
         st_step = step
 
         while runner and step < config.warm_up_steps:
             rollout, info = next(runner)
-            self._agent.store_episode(rollout)
-            step_per_batch = mpi_sum(len(rollout["ac"]))
+            # every rank runs the same number of environment steps, see _run
+            step_per_batch = self._store_rollout(rollout) * config.num_workers
             step += step_per_batch
             if runner and step < config.max_ob_norm_step:
                 self._update_normalizer(rollout)
             if self._is_chef:
                 pbar.update(step_per_batch)
 
+        if self._rollout_workers is not None and config.warm_up_steps > 0:
+            self._rollout_workers.update_weights(self._agent)
+
         if self._config.algo == "bc" and self._config.ob_norm:
             self._agent.update_normalizer()
 
@@ -243,12 +279,9 @@ class Trainer(object):
             # collect rollouts
             if runner:
                 rollout, info = next(runner)
-                if self._average_info:
-                    info = mpi_gather_average(info)
-                self._agent.store_episode(rollout)
-                step_per_batch = mpi_sum(len(rollout["ac"]))
+                step_per_batch = self._store_rollout(rollout) * config.num_workers
             else:
-                step_per_batch = mpi_sum(1)
+                step_per_batch = config.num_workers
                 info = {}
 
             # train an agent
@@ -260,25 +293,39 @@ class Trainer(object):
             step += step_per_batch
             update_iter += 1
 
-            # log training and episode information or evaluate
-            if self._is_chef:
-                pbar.update(step_per_batch)
-                ep_info.add(info)
-                train_info.add(_train_info)
+            if (
+                self._rollout_workers is not None
+                and update_iter % config.policy_sync_interval == 0
+            ):
+                self._rollout_workers.update_weights(self._agent)
 
-                if update_iter % config.log_interval == 0:
-                    train_info.add(
+            # log training and episode information or evaluate
+            if self._average_info or self._is_chef:
+                metrics.add(info, prefix="ep/")
+            train_info.add(_train_info)
+
+            if update_iter % config.log_interval == 0:
+                metrics.add(train_info.get_dict(), prefix="rl/")
+                mean, maximum, _ = metrics.reduce()
+                if self._is_chef:
+                    rl_info = {k[3:]: v for k, v in mean.items() if k.startswith("rl/")}
+                    rl_info.update(
                         {
                             "sec": (time() - st_time) / config.log_interval,
                             "steps_per_sec": (step - st_step) / (time() - st_time),
                             "update_iter": update_iter,
                         }
                     )
-                    st_time = time()
-                    st_step = step
-                    self._log_train(step, train_info.get_dict(), ep_info.get_dict())
-                    ep_info = Info()
-                    train_info = Info()
+                    ep_info = {k[3:]: v for k, v in mean.items() if k.startswith("ep/")}
+                    ep_info_max = {
+                        k[3:]: v for k, v in maximum.items() if k.startswith("ep/")
+                    }
+                    self._log_train(step, rl_info, ep_info, ep_info_max)
+                st_time = time()
+                st_step = step
+
+            if self._is_chef:
+                pbar.update(step_per_batch)
 
                 if update_iter % config.evaluate_interval == 1:
                     logger.info("Evaluate at %d", update_iter)
@@ -291,12 +338,142 @@ class Trainer(object):
                     self._save_ckpt(step, update_iter)
 
         self._save_ckpt(step, update_iter)
+        if self._rollout_workers is not None:
+            self._rollout_workers.close()
         logger.info("Reached %s steps. worker %d stopped.", step, config.rank)
 
+    def _train_async(self):
+        """
+        Trains an off-policy agent while rollout workers stream transitions.
+        Updates run continuously at --async_utd_ratio updates per environment
+        step after warm-up, and weights are sent to the policy server every
+        --policy_sync_interval updates without waiting for the server.
+        """
+        config = self._config
+        assert self._rollout_workers is not None, "Set --num_rollout_workers"
+        assert config.num_workers == 1, "Asynchronous training runs on one process"
+        assert self._agent.is_off_policy(), "Asynchronous training is off-policy"
+        workers = self._rollout_workers
+
+        step, update_iter = self._load_ckpt(config.init_ckpt_path, config.ckpt_num)
+        logger.info("Start asynchronous training at step=%d", step)
+        pbar = tqdm(initial=step, total=config.max_global_step, desc=config.run_name)
+        ep_info = Info()
+        train_info = DeviceInfo()
+        async_info = Info()
+
+        workers.update_weights(self._agent)
+        workers.start_stream(every_steps=config.async_chunk_steps, step=step)
+
+        st_time = time()
+        st_step = step
+        st_update_iter = update_iter
+        wait_time = 0
+        train_st_step = None
+        train_st_update_iter = update_iter
+
+        while step < config.max_global_step:
+            # wait for new data only if updates are ahead of the ratio
+            ready = (
+                train_st_step is not None
+                and update_iter - train_st_update_iter
+                < config.async_utd_ratio * (step - train_st_step)
+            )
+            wait_st_time = time()
+            chunks = workers.get(block=not ready)
+            if not ready:
+                wait_time += time() - wait_st_time
+
+            for rollout, info, version in chunks:
+                step_per_batch = self._store_rollout(rollout)
+                step += step_per_batch
+                if step < config.max_ob_norm_step:
+                    self._update_normalizer(rollout)
+                pbar.update(step_per_batch)
+                ep_info.add(info)
+                async_info.add({"policy_staleness": workers.version - version})
+            async_info.add({"queue_chunks": len(chunks)})
+
+            if step < config.warm_up_steps:
+                continue
+            if train_st_step is None:
+                train_st_step = step
+            if not ready:
+                continue
+
+            # train an agent
+            _train_info = self._agent.train()
+            train_info.add(_train_info)
+            update_iter += 1
+
+            if update_iter % config.policy_sync_interval == 0:
+                workers.update_weights(self._agent, wait=False)
+
+            # log training and episode information or evaluate
+            if update_iter % config.log_interval == 0:
+                elapsed = time() - st_time
+                train_info.add(
+                    {
+                        "sec": elapsed / config.log_interval,
+                        "steps_per_sec": (step - st_step) / elapsed,
+                        "updates_per_sec": (update_iter - st_update_iter) / elapsed,
+                        "learner_wait_ratio": wait_time / elapsed,
+                        "update_iter": update_iter,
+                    }
+                )
+                train_info.add(async_info.get_dict())
+                st_time = time()
+                st_step = step
+                st_update_iter = update_iter
+                wait_time = 0
+                self._log_train(step, train_info.get_dict(), ep_info.get_dict())
+                ep_info = Info()
+
+            if update_iter % config.evaluate_interval == 1:
+                logger.info("Evaluate at %d", update_iter)
+                rollout, info = self._evaluate(step=step, record_video=config.record_video)
+                self._log_test(step, info)
+
+            if update_iter % config.ckpt_interval == 0:
+                self._save_ckpt(step, update_iter)
+
+        self._save_ckpt(step, update_iter)
+        workers.close()
+        logger.info("Reached %s steps. Asynchronous training stopped.", step)
+
+    def _run(self, every_steps, step):
+        """
+        Returns a generator of rollouts from the rollout workers or the runner.
+        Global steps are counted without a collective, so rollouts need the
+        same number of environment steps on every rank.
+        """
+        assert every_steps is not None, "Rollouts of every_steps are required"
+        if self._rollout_workers is not None:
+            return self._rollout_workers.run(every_steps=every_steps, step=step)
+        return self._runner.run(every_steps=every_steps, step=step)
+
+    def _store_rollout(self, rollout):
+        """
+        Stores @rollout, or a list of rollouts from rollout workers, to the
+        agent and returns the number of environment steps.
+        """
+        rollouts = rollout if isinstance(rollout, list) else [rollout]
+        num_steps = 0
+        for rollout in rollouts:
+            # absorbing transitions are not environment steps
+            num_steps += int(np.sum(np.asarray(rollout["done_mask"]) != -1))
+            self._agent.store_episode(rollout)
+        return num_steps
+
     def _update_normalizer(self, rollout):
         """ Updates normalizer with @rollout. """
         if self._config.ob_norm:
-            self._agent.update_normalizer(rollout["ob"])
+            if isinstance(rollout, list):
+                obs = [r["ob"] for r in rollout]
+                ob = {k: np.concatenate([o[k] for o in obs]) for k in obs[0].keys()}
+            else:
+                ob = rollout["ob"]
+            self._agent.update_normalizer(ob)
 
     def _evaluate(self, step=None, record_video=False):
         """
@@ -312,6 +489,11 @@ class Trainer(object):
         info_history = Info()
         for i in range(self._config.num_eval):
             logger.warn("Evalute run %d", i + 1)
+            if record_video and self._video_stream is not None:
+                # the final file name is known at the end of the episode
+                self._video_stream.open(
+                    os.path.join(self._config.record_dir, "eval_%d.mp4" % i)
+                )
             rollout, info, frames = self._runner.run_episode(
                 is_train=False, record_video=record_video
             )
@@ -367,8 +549,9 @@ class Trainer(object):
         if self._config.record_demo:
             new_rollouts = []
             for rollout in rollouts:
+                rollout = unstack_rollout(rollout)
                 new_rollout = {
-                    "obs": rollout["ob"],
+                    "obs": rollout["ob"] + rollout["ob_next"][-1:],
                     "actions": rollout["ac"],
                     "rewards": rollout["rew"],
                     "dones": rollout["done"],
@@ -384,10 +567,19 @@ class Trainer(object):
                 pickle.dump(new_rollouts, f)
 
     def _save_video(self, fname, frames, fps=15.0):
-        """ Saves @frames into a video with file name @fname. """
+        """
+        Saves @frames into a video with file name @fname. With a video stream,
+        frames are already encoded and the streamed video is finalized.
+        """
         path = os.path.join(self._config.record_dir, fname)
         logger.warn("[*] Generating video: {}".format(path))
 
+        if self._video_stream is not None:
+            self._video_stream.close_video(path)
+            logger.info("Video stream stats: %s", self._video_stream.stats())
+            logger.warn("[*] Video saved: {}".format(path))
+            return path
+
         def f(t):
             frame_length = len(frames)
             new_fps = 1.0 / (1.0 / fps + 1.0 / frame_length)
@@ -78,6 +78,7 @@ class GymWrapper(gym.Wrapper):
         self._frame_skip = frame_skip
         self.max_episode_steps = self.env.env._max_episode_steps // frame_skip
         self._return_state = return_state
+        self._render_initialized = False
 
         if from_pixels:
             shape = [3, height, width] if channels_first else [height, width, 3]
@@ -111,19 +112,22 @@ class GymWrapper(gym.Wrapper):
 
     def _get_obs(self, ob, reset=False):
         if self._from_pixels:
+            if reset and not self._render_initialized:
+                # the first frame of a new render context can be blank
+                self.render(
+                    mode="rgb_array",
+                    height=self._height,
+                    width=self._width,
+                    camera_id=self._camera_id,
+                )
+                self._render_initialized = True
+            # intermediate frames of frame skip are never rendered
             ob = self.render(
                 mode="rgb_array",
                 height=self._height,
                 width=self._width,
                 camera_id=self._camera_id,
             )
-            if reset:
-                ob = self.render(
-                    mode="rgb_array",
-                    height=self._height,
-                    width=self._width,
-                    camera_id=self._camera_id,
-                )
             if self._channels_first:
                 ob = ob.transpose(2, 0, 1).copy()
         return ob
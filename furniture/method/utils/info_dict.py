@@ -1,6 +1,7 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import numpy as np
+import torch
 
 
 class Info(object):
@@ -59,3 +60,65 @@ class Info(object):
 
     def items(self):
         return self._info.items()
+
+
+class DeviceInfo(object):
+    """
+    Averages scalar metrics like Info, but keeps running sums of tensors on
+    their device so that adding a metric does not wait for the device.
+    get_dict() copies all sums to the host at once.
+    """
+
+    def __init__(self, info=None):
+        self.clear()
+        if info:
+            self.add(info)
+
+    def add(self, info):
+        if info is None:
+            return
+        if isinstance(info, DeviceInfo):
+            items = [(k, v, info._count[k]) for k, v in info._sum.items()]
+        elif isinstance(info, dict):
+            items = []
+            for k, v in info.items():
+                if torch.is_tensor(v):
+                    items.append((k, v.detach().float().mean(), 1))
+                elif isinstance(v, (int, float, np.number, np.ndarray)):
+                    items.append((k, float(np.mean(v)), 1))
+        else:
+            raise ValueError("info should be dict or DeviceInfo (%s)" % info)
+
+        for k, v, count in items:
+            if k in self._sum:
+                v = self._sum[k] + v
+            self._sum[k] = v
+            self._count[k] += count
+
+    def clear(self):
+        self._sum = OrderedDict()
+        self._count = defaultdict(int)
+
+    def get_dict(self):
+        """ Returns the means of metrics as floats and clears them. """
+        sums = OrderedDict()
+        tensors = defaultdict(list)
+        for k, v in self._sum.items():
+            if torch.is_tensor(v):
+                tensors[v.device].append(k)
+            else:
+                sums[k] = v
+        # one copy per device
+        for keys in tensors.values():
+            values = torch.stack([self._sum[k] for k in keys]).cpu().tolist()
+            sums.update(zip(keys, values))
+
+        ret = {k: v / self._count[k] for k, v in sums.items()}
+        self.clear()
+        return ret
+
+    def __setitem__(self, key, value):
+        self.add({key: value})
+
+    def __len__(self):
+        return len(self._sum)
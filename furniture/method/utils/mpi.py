@@ -52,3 +52,80 @@ def mpi_sum(x):
 # Syncronize all processes.
 def mpi_sync():
     mpi_sum(0)
+
+
+class MetricReducer(object):
+    """
+    Accumulates scalar metrics on each rank and reduces them across MPI ranks
+    with a single Allgather of a float64 array.
+
+    Keys are packed in a schema shared by all ranks. When a rank adds keys
+    that are not in the schema yet, the reduction tells every rank, and the
+    new keys are exchanged and reduced with two more collectives, so steady
+    state costs one collective per reduce().
+    """
+
+    def __init__(self, comm=None):
+        self._comm = comm or MPI.COMM_WORLD
+        self._schema = []
+        self.clear()
+
+    def clear(self):
+        self._sum = {}
+        self._count = {}
+        self._max = {}
+
+    def add(self, info, prefix=""):
+        """ Adds scalars or lists of scalars in the dict @info. """
+        for k, v in info.items():
+            try:
+                values = np.asarray(v, dtype=np.float64).reshape(-1)
+            except (TypeError, ValueError):
+                continue
+            if values.size == 0:
+                continue
+            k = prefix + k
+            self._sum[k] = self._sum.get(k, 0.0) + values.sum()
+            self._count[k] = self._count.get(k, 0) + values.size
+            self._max[k] = max(self._max.get(k, -np.inf), values.max())
+
+    def _gather(self, keys, num_new_keys=0):
+        """ Returns global sums, counts, maxima of @keys and the number of new keys. """
+        n = len(keys)
+        local = np.empty(3 * n + 1)
+        local[:n] = [self._sum.get(k, 0.0) for k in keys]
+        local[n : 2 * n] = [self._count.get(k, 0) for k in keys]
+        local[2 * n : 3 * n] = [self._max.get(k, -np.inf) for k in keys]
+        local[-1] = num_new_keys
+        gathered = np.empty((self._comm.Get_size(), 3 * n + 1))
+        self._comm.Allgather(local, gathered)
+        total = gathered.sum(axis=0)
+        return total[:n], total[n : 2 * n], gathered[:, 2 * n : 3 * n].max(axis=0), total[-1]
+
+    def reduce(self):
+        """
+        Returns dicts of the mean, maximum and sum over all ranks of each
+        metric added since the last call, and clears the metrics. Must be
+        called by all ranks.
+        """
+        schema = self._schema
+        known = set(schema)
+        new_keys = sorted(k for k in self._sum if k not in known)
+        sums, counts, maxs, num_new_keys = self._gather(schema, len(new_keys))
+
+        if num_new_keys > 0:
+            added = sorted(set().union(*self._comm.allgather(new_keys)))
+            new_sums, new_counts, new_maxs, _ = self._gather(added)
+            self._schema = schema + added
+            sums = np.concatenate([sums, new_sums])
+            counts = np.concatenate([counts, new_counts])
+            maxs = np.concatenate([maxs, new_maxs])
+
+        mean, maximum, total = {}, {}, {}
+        for i, k in enumerate(self._schema):
+            if counts[i] > 0:
+                mean[k] = sums[i] / counts[i]
+                maximum[k] = maxs[i]
+                total[k] = sums[i]
+        self.clear()
+        return mean, maximum, total
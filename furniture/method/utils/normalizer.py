@@ -1,11 +1,29 @@
 from collections import OrderedDict
 
 import numpy as np
+import torch
 import gym.spaces
+from mpi4py import MPI
 
 from .mpi import mpi_average
 
 
+def _merge(a, b):
+    """
+    Merges (count, mean, M2) statistics @a and @b of two sets of samples with
+    the parallel Welford update (Chan et al.).
+    """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n_b == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + np.square(delta) * (n_a * n_b / n)
+    return n, mean, m2
+
+
 class SubNormalizer:
     def __init__(self, size, eps=1e-1, default_clip_range=np.inf, clip_obs=np.inf):
         if isinstance(size, list):
@@ -26,17 +44,19 @@ class SubNormalizer:
         # get the mean and std
         self.mean = np.zeros(self.size, np.float32)
         self.std = np.ones(self.size, np.float32)
+        # mean and std on devices
+        self._tensors = {}
 
     def _clip(self, v):
         return np.clip(v, -self.clip_obs, self.clip_obs)
 
     # update the parameters of the normalizer
     def update(self, v):
+        if torch.is_tensor(v):
+            v = v.detach().cpu().numpy()
         v = self._clip(v)
         v = v.reshape([-1] + self.size)
 
-        if not isinstance(v, np.ndarray):
-            v = v.detach().numpy()
         # do the computing
         self.local_sum += v.sum(axis=0)
         self.local_sumsq += (np.square(v)).sum(axis=0)
@@ -66,20 +86,42 @@ class SubNormalizer:
         self.total_sumsq += sync_sumsq
         self.total_count += sync_count
         # calculate the new mean and std
-        self.mean = self.total_sum / self.total_count
-        self.std = np.sqrt(
-            np.maximum(
-                np.square(self.eps),
-                (self.total_sumsq / self.total_count)
-                - np.square(self.total_sum / self.total_count),
-            )
+        self._set_stats(
+            self.total_sum / self.total_count,
+            np.sqrt(
+                np.maximum(
+                    np.square(self.eps),
+                    (self.total_sumsq / self.total_count)
+                    - np.square(self.total_sum / self.total_count),
+                )
+            ),
         )
 
+    def _set_stats(self, mean, std):
+        self.mean = mean
+        self.std = std
+        self._tensors = {}
+
+    def tensors(self, device):
+        """ Returns mean and std as tensors on @device, copied once per change. """
+        if device not in self._tensors:
+            self._tensors[device] = (
+                torch.as_tensor(self.mean, dtype=torch.float32, device=device),
+                torch.as_tensor(self.std, dtype=torch.float32, device=device),
+            )
+        return self._tensors[device]
+
     # normalize the observation
     def normalize(self, v, clip_range=None):
-        v = self._clip(v)
         if clip_range is None:
             clip_range = self.default_clip_range
+        if torch.is_tensor(v):
+            mean, std = self.tensors(v.device)
+            if not v.is_floating_point():
+                v = v.float()
+            v = v.clamp(-self.clip_obs, self.clip_obs)
+            return ((v - mean) / std).clamp(-clip_range, clip_range)
+        v = self._clip(v)
         return np.clip((v - self.mean) / (self.std), -clip_range, clip_range)
 
     def state_dict(self):
@@ -93,18 +135,115 @@ class SubNormalizer:
         self.total_sum = state_dict["sum"]
         self.total_sumsq = state_dict["sumsq"]
         self.total_count = state_dict["count"]
-        self.mean = self.total_sum / self.total_count
-        self.std = np.sqrt(
-            np.maximum(
-                np.square(self.eps),
-                (self.total_sumsq / self.total_count)
-                - np.square(self.total_sum / self.total_count),
-            )
+        self._set_stats(
+            self.total_sum / self.total_count,
+            np.sqrt(
+                np.maximum(
+                    np.square(self.eps),
+                    (self.total_sumsq / self.total_count)
+                    - np.square(self.total_sum / self.total_count),
+                )
+            ),
         )
 
 
+class WelfordSubNormalizer(SubNormalizer):
+    """
+    Keeps the count, mean and sum of squared deviations (M2) of observations,
+    which are merged with parallel Welford updates and stay accurate where
+    sums of squares lose precision. Statistics of observations since the last
+    sync are kept apart in @local until Normalizer merges those of all ranks
+    into @total, and mean and std use both.
+    """
+
+    def __init__(self, size, eps=1e-1, default_clip_range=np.inf, clip_obs=np.inf):
+        super().__init__(size, eps, default_clip_range, clip_obs)
+        self.local = self._empty()
+        self.total = self._empty()
+
+    def _empty(self):
+        return 0, np.zeros(self.size, np.float64), np.zeros(self.size, np.float64)
+
+    def update(self, v):
+        if torch.is_tensor(v):
+            v = v.detach().cpu().numpy()
+        v = self._clip(v)
+        v = np.asarray(v, dtype=np.float64).reshape([-1] + self.size)
+        if len(v) == 0:
+            return
+        mean = v.mean(axis=0)
+        self.local = _merge(self.local, (len(v), mean, np.square(v - mean).sum(axis=0)))
+
+    def pack(self):
+        """ Returns @local as a flat array for syncing and clears it. """
+        count, mean, m2 = self.local
+        self.local = self._empty()
+        return np.concatenate([[count], mean.ravel(), m2.ravel()])
+
+    def unpack(self, x):
+        """ Returns the statistics packed in the flat array @x. """
+        size = int(np.prod(self.size))
+        return x[0], x[1 : size + 1].reshape(self.size), x[size + 1 :].reshape(self.size)
+
+    def recompute_stats(self):
+        count, mean, m2 = _merge(self.total, self.local)
+        if count == 0:
+            return
+        self._set_stats(
+            mean.astype(np.float32),
+            np.sqrt(np.maximum(np.square(self.eps), m2 / count)).astype(np.float32),
+        )
+
+    def state_dict(self):
+        count, mean, m2 = _merge(self.total, self.local)
+        # sums are loadable by SubNormalizer
+        return {
+            "sum": mean * count,
+            "sumsq": m2 + np.square(mean) * count,
+            "count": np.array([count], np.float64),
+            "mean": mean,
+            "m2": m2,
+        }
+
+    def load_state_dict(self, state_dict):
+        count = float(np.asarray(state_dict["count"]).reshape(-1)[0])
+        if "m2" in state_dict:
+            mean, m2 = state_dict["mean"], state_dict["m2"]
+        else:
+            mean = state_dict["sum"] / count
+            m2 = np.maximum(state_dict["sumsq"] - np.square(mean) * count, 0)
+        self.total = (
+            count,
+            np.asarray(mean, np.float64).reshape(self.size),
+            np.asarray(m2, np.float64).reshape(self.size),
+        )
+        self.local = self._empty()
+        self.recompute_stats()
+
+
 class Normalizer:
-    def __init__(self, shape, eps=1e-1, default_clip_range=np.inf, clip_obs=np.inf):
+    def __init__(
+        self,
+        shape,
+        eps=1e-1,
+        default_clip_range=np.inf,
+        clip_obs=np.inf,
+        mode="sum",
+        sync_interval=1,
+    ):
+        """
+        Args:
+            shape: observation space or dict of shapes of observations.
+            eps: lower bound of std.
+            default_clip_range: clip range of normalized observations.
+            clip_obs: clip range of observations.
+            mode: "sum" accumulates sums and sums of squares that are averaged
+                across ranks on every recompute_stats(). "welford" accumulates
+                Welford statistics, which are synced across ranks in one
+                collective every @sync_interval recompute_stats().
+            sync_interval: number of recompute_stats() between syncs in
+                "welford" mode.
+        """
         if isinstance(shape, gym.spaces.Dict):
             self._shape = {k: list(v.shape) for k, v in shape.spaces.items()}
         elif isinstance(shape, dict):
@@ -114,10 +253,14 @@ class Normalizer:
         print("New ob_norm with shape", self._shape)
 
         self._keys = sorted(self._shape.keys())
+        self._mode = mode
+        self._sync_interval = sync_interval
+        self._num_updates = 0
 
+        sub_normalizer = WelfordSubNormalizer if mode == "welford" else SubNormalizer
         self.sub_norm = {}
         for key in self._keys:
-            self.sub_norm[key] = SubNormalizer(
+            self.sub_norm[key] = sub_normalizer(
                 self._shape[key], eps, default_clip_range, clip_obs
             )
 
@@ -139,9 +282,36 @@ class Normalizer:
             self.sub_norm[""].update(v)
 
     def recompute_stats(self):
+        if self._mode == "welford":
+            self._num_updates += 1
+            if self._num_updates % self._sync_interval == 0:
+                self.sync()
         for k in self._keys:
             self.sub_norm[k].recompute_stats()
 
+    def sync(self):
+        """
+        Merges the Welford statistics of all ranks since the last sync into
+        the total statistics with a single Allgather. Every rank has to call it.
+        """
+        if self._mode != "welford":
+            return
+        local = np.concatenate([self.sub_norm[k].pack() for k in self._keys])
+        if MPI.COMM_WORLD.Get_size() == 1:
+            gathered = local[None]
+        else:
+            gathered = np.empty((MPI.COMM_WORLD.Get_size(), len(local)), np.float64)
+            MPI.COMM_WORLD.Allgather(local, gathered)
+
+        # merge in the same order on every rank so that totals stay identical
+        for x in gathered:
+            i = 0
+            for k in self._keys:
+                sub_norm = self.sub_norm[k]
+                size = 1 + 2 * int(np.prod(sub_norm.size))
+                sub_norm.total = _merge(sub_norm.total, sub_norm.unpack(x[i : i + size]))
+                i += size
+
     # normalize the observation
     def _normalize(self, v, clip_range=None):
         if not isinstance(v, dict):
@@ -155,6 +325,10 @@ class Normalizer:
         )
 
     def normalize(self, v, clip_range=None):
+        """
+        Normalizes arrays, or tensors on any device with mean and std copied
+        there once per change.
+        """
         if isinstance(v, list):
             return [self._normalize(x, clip_range) for x in v]
         else:
@@ -1,5 +1,6 @@
 import os
 import io
+import weakref
 from glob import glob
 from collections import OrderedDict, defaultdict
 
@@ -103,6 +104,154 @@ def compute_weight_sum(model):
     return weight_sum
 
 
+# options of sync_networks and sync_grads, set by set_sync_options
+_sync_options = {"bucket_size": 2 ** 20, "overlap": False}
+_network_syncs = weakref.WeakKeyDictionary()
+
+
+def set_sync_options(bucket_size=None, overlap=None):
+    """
+    Sets the bucket size (in number of parameters) of gradient all-reduce and
+    whether buckets are reduced during the backward pass. Applies to networks
+    synchronized for the first time afterwards.
+    """
+    if bucket_size is not None:
+        _sync_options["bucket_size"] = bucket_size
+    if overlap is not None:
+        _sync_options["overlap"] = overlap
+
+
+class _NetworkSync(object):
+    """
+    Flat parameter and gradient buffers of a network for MPI communication,
+    allocated once. Parameters are views into the flat parameter buffer, so
+    broadcasting it updates the network. Gradients are all-reduced in buckets
+    of about @bucket_size parameters. With @overlap, a bucket is all-reduced as
+    soon as backward has accumulated all its gradients, so changes to
+    gradients between backward and sync_grads (e.g. clipping) are not seen.
+    """
+
+    def __init__(self, network, bucket_size, overlap):
+        self._comm = MPI.COMM_WORLD
+        self._params = list(network.parameters())
+        self._offsets = np.cumsum([0] + [p.numel() for p in self._params])
+        self._device = self._params[0].device
+        for p in self._params:
+            assert p.dtype == torch.float32, "Only float32 parameters are supported"
+
+        size = int(self._offsets[-1])
+        self._flat_params = torch.empty(size, device=self._device)
+        self._flat_grads = torch.zeros(size, device=self._device)
+        if self._device.type == "cuda":
+            # MPI reads and writes pinned host copies of the buffers
+            self._host_params = torch.empty(size, pin_memory=True)
+            self._host_grads = torch.empty(size, pin_memory=True)
+        else:
+            self._host_params = self._flat_params
+            self._host_grads = self._flat_grads
+        self._host_params_np = self._host_params.numpy()
+        self._host_grads_np = self._host_grads.numpy()
+        self._view_params()
+
+        # buckets of consecutive parameters
+        self._buckets = [[]]
+        bucket_numel = 0
+        for i, p in enumerate(self._params):
+            if bucket_numel >= bucket_size:
+                self._buckets.append([])
+                bucket_numel = 0
+            self._buckets[-1].append(i)
+            bucket_numel += p.numel()
+        self._requests = [None] * len(self._buckets)
+        self._ready = [set() for _ in self._buckets]
+        self._ready_task = [None] * len(self._buckets)
+
+        if (
+            overlap
+            and hasattr(torch.Tensor, "register_post_accumulate_grad_hook")
+            and hasattr(torch._C, "_current_graph_task_id")
+        ):
+            for b, bucket in enumerate(self._buckets):
+                for i in bucket:
+                    self._params[i].register_post_accumulate_grad_hook(
+                        lambda p, b=b, i=i: self._on_grad_ready(b, i)
+                    )
+
+    def _view_params(self):
+        """ Moves parameters into the flat buffer. """
+        with torch.no_grad():
+            for p, start, end in zip(
+                self._params, self._offsets[:-1], self._offsets[1:]
+            ):
+                # keep the memory layout (e.g. channels-last convolutions)
+                view = self._flat_params[start:end].as_strided(p.shape, p.stride())
+                view.copy_(p.data)
+                p.data = view
+        self._param_ptrs = [p.data_ptr() for p in self._params]
+
+    def broadcast_params(self):
+        # parameters are replaced when a network is moved to another device
+        if [p.data_ptr() for p in self._params] != self._param_ptrs:
+            self._view_params()
+        if self._host_params is not self._flat_params:
+            self._host_params.copy_(self._flat_params)
+        self._comm.Bcast(self._host_params_np, root=0)
+        if self._host_params is not self._flat_params:
+            self._flat_params.copy_(self._host_params)
+
+    def _on_grad_ready(self, b, i):
+        # count only gradients of the current backward pass
+        task = torch._C._current_graph_task_id()
+        if task != self._ready_task[b]:
+            self._ready_task[b] = task
+            self._ready[b] = set()
+        self._ready[b].add(i)
+        if len(self._ready[b]) == len(self._buckets[b]):
+            self._launch(b)
+
+    def _launch(self, b):
+        """ Copies gradients of bucket @b and starts all-reducing them. """
+        if self._requests[b] is not None:
+            # reduced gradients of an earlier backward are not used
+            self._requests[b].Wait()
+        self._ready[b] = set()
+        start = self._offsets[self._buckets[b][0]]
+        end = self._offsets[self._buckets[b][-1] + 1]
+        for i in self._buckets[b]:
+            grad = self._params[i].grad
+            view = self._flat_grads[self._offsets[i] : self._offsets[i + 1]]
+            if grad is None:
+                view.zero_()
+            else:
+                view.copy_(grad.reshape(-1))
+        if self._host_grads is not self._flat_grads:
+            self._host_grads[start:end].copy_(self._flat_grads[start:end])
+        self._requests[b] = self._comm.Iallreduce(
+            MPI.IN_PLACE, self._host_grads_np[start:end], op=MPI.SUM
+        )
+
+    def reduce_grads(self):
+        for b in range(len(self._buckets)):
+            if self._requests[b] is None:
+                self._launch(b)
+        MPI.Request.Waitall(self._requests)
+        self._requests = [None] * len(self._buckets)
+
+        if self._host_grads is not self._flat_grads:
+            self._flat_grads.copy_(self._host_grads)
+        for p, start, end in zip(self._params, self._offsets[:-1], self._offsets[1:]):
+            if p.grad is not None:
+                p.grad.copy_(self._flat_grads[start:end].view_as(p.grad))
+
+
+def _get_network_sync(network):
+    if network not in _network_syncs:
+        _network_syncs[network] = _NetworkSync(
+            network, _sync_options["bucket_size"], _sync_options["overlap"]
+        )
+    return _network_syncs[network]
+
+
 # sync_networks across the different cores
 def sync_networks(network):
     """
@@ -111,44 +260,7 @@ def sync_networks(network):
     comm = MPI.COMM_WORLD
     if comm.Get_size() == 1:
         return
-    flat_params, params_shape = _get_flat_params(network)
-    comm.Bcast(flat_params, root=0)
-    # set the flat params back to the network
-    _set_flat_params(network, params_shape, flat_params)
-
-
-# get the flat params from the network
-def _get_flat_params(network):
-    param_shape = {}
-    flat_params = None
-    for key_name, value in network.named_parameters():
-        param_shape[key_name] = value.cpu().detach().numpy().shape
-        if flat_params is None:
-            flat_params = value.cpu().detach().numpy().flatten()
-        else:
-            flat_params = np.append(flat_params, value.cpu().detach().numpy().flatten())
-    return flat_params, param_shape
-
-
-# set the params from the network
-def _set_flat_params(network, params_shape, params):
-    pointer = 0
-    if hasattr(network, "_config"):
-        device = network._config.device
-    else:
-        device = torch.device("cpu")
-
-    for key_name, values in network.named_parameters():
-        # get the length of the parameters
-        len_param = np.prod(params_shape[key_name])
-        copy_params = params[pointer : pointer + len_param].reshape(
-            params_shape[key_name]
-        )
-        copy_params = torch.tensor(copy_params).to(device)
-        # copy the params
-        values.data.copy_(copy_params.data)
-        # update the pointer
-        pointer += len_param
+    _get_network_sync(network).broadcast_params()
 
 
 # sync gradients across the different cores
@@ -156,46 +268,37 @@ def sync_grads(network):
     comm = MPI.COMM_WORLD
     if comm.Get_size() == 1:
         return
-    flat_grads, grads_shape = _get_flat_grads(network)
-    global_grads = np.zeros_like(flat_grads)
-    comm.Allreduce(flat_grads, global_grads, op=MPI.SUM)
-    _set_flat_grads(network, grads_shape, global_grads)
+    _get_network_sync(network).reduce_grads()
 
 
-def _set_flat_grads(network, grads_shape, flat_grads):
-    pointer = 0
-    if hasattr(network, "_config"):
-        device = network._config.device
-    else:
-        device = torch.device("cpu")
-
-    for key_name, value in network.named_parameters():
-        if key_name in grads_shape:
-            len_grads = np.prod(grads_shape[key_name])
-            copy_grads = flat_grads[pointer : pointer + len_grads].reshape(
-                grads_shape[key_name]
-            )
-            copy_grads = torch.tensor(copy_grads).to(device)
-            # copy the grads
-            value.grad.data.copy_(copy_grads.data)
-            pointer += len_grads
-
-
-def _get_flat_grads(network):
-    grads_shape = {}
-    flat_grads = None
-    for key_name, value in network.named_parameters():
-        try:
-            grads_shape[key_name] = value.grad.data.cpu().numpy().shape
-        except:
-            print("Cannot get grad of tensor {}".format(key_name))
-            continue
-
-        if flat_grads is None:
-            flat_grads = value.grad.data.cpu().numpy().flatten()
-        else:
-            flat_grads = np.append(flat_grads, value.grad.data.cpu().numpy().flatten())
-    return flat_grads, grads_shape
+class PolyakAverager(object):
+    """
+    Target networks updated as target = (1 - tau) * source + tau * target.
+    Pairs of target and source modules are registered once, and each update
+    runs two fused multi-tensor ops per registered weight instead of a loop
+    over parameters.
+    """
+
+    def __init__(self):
+        self._groups = []
+
+    def add(self, target, source, tau):
+        """ Registers @target to track @source, keeping @tau of the target. """
+        targets = list(target.parameters())
+        sources = list(source.parameters())
+        assert len(targets) == len(sources)
+        if targets:
+            self._groups.append((targets, sources, tau))
+
+    def update(self):
+        with torch.no_grad():
+            for targets, sources, tau in self._groups:
+                if hasattr(torch, "_foreach_mul_"):
+                    torch._foreach_mul_(targets, tau)
+                    torch._foreach_add_(targets, sources, alpha=1 - tau)
+                else:
+                    for target, source in zip(targets, sources):
+                        target.mul_(tau).add_(source, alpha=1 - tau)
 
 
 def fig2tensor(draw_func):
@@ -271,6 +374,13 @@ def scale_dict_tensor(tensor, scalar):
         return tensor * scalar
 
 
+def weighted_mse_loss(input, target, weights=None):
+    """ Mean squared error where each item is scaled by @weights (e.g. IS weights). """
+    if weights is None:
+        return ((input - target) ** 2).mean()
+    return (weights * (input - target) ** 2).mean()
+
+
 # From softlearning repo
 def flatten(unflattened, parent_key="", separator="/"):
     items = []
@@ -337,19 +447,96 @@ def center_crop_images(image, out=84):
     return image
 
 
+def _crop_windows(imgs, top, left, out):
+    """
+    Crops image i of @imgs (B,...,H,W) at (@top[i], @left[i]) to @out x @out
+    with one gather from a strided view of all crop windows (no copy of the
+    view itself).
+    """
+    b = imgs.shape[0]
+    h, w = imgs.shape[-2:]
+    windows = np.lib.stride_tricks.as_strided(
+        imgs,
+        shape=(b, h - out + 1, w - out + 1) + imgs.shape[1:-2] + (out, out),
+        strides=imgs.strides[:1]
+        + imgs.strides[-2:]
+        + imgs.strides[1:-2]
+        + imgs.strides[-2:],
+        writeable=False,
+    )
+    return windows[np.arange(b), top, left]
+
+
 # from https://github.com/MishaLaskin/rad/blob/master/data_augs.py
 def random_crop(imgs, out=84):
     """
         args:
-        imgs: np.array shape (B,C,H,W)
+        imgs: np.array shape (B,C,H,W) or (B,N,C,H,W)
         out: output size (e.g. 84)
-        returns np.array
+        returns np.array shape (B,C,out,out) or (B,N,C,out,out)
+    """
+    b = imgs.shape[0]
+    h, w = imgs.shape[-2:]
+    w1 = np.random.randint(0, w - out + 1, b)
+    h1 = np.random.randint(0, h - out + 1, b)
+    return _crop_windows(imgs, h1, w1, out)
+
+
+def random_crop_tensor(imgs, out=84):
+    """
+        args:
+        imgs: torch.Tensor shape (B,C,H,W)
+        out: output size (e.g. 84)
+        returns torch.Tensor shape (B,C,out,out), cropped on the device of @imgs
     """
     b, c, h, w = imgs.shape
-    crop_max = h - out + 1
-    w1 = np.random.randint(0, crop_max, b)
-    h1 = np.random.randint(0, crop_max, b)
-    cropped = np.empty((b, c, out, out), dtype=imgs.dtype)
-    for i, (img, w11, h11) in enumerate(zip(imgs, w1, h1)):
-        cropped[i] = img[:, h11 : h11 + out, w11 : w11 + out]
-    return cropped
+    if h == out and w == out:
+        return imgs
+    device = imgs.device
+    h1 = torch.randint(0, h - out + 1, (b,), device=device)
+    w1 = torch.randint(0, w - out + 1, (b,), device=device)
+    rng = torch.arange(out, device=device)
+    rows = (h1[:, None] + rng)[:, None, :, None]
+    cols = (w1[:, None] + rng)[:, None, None, :]
+    batch = torch.arange(b, device=device)[:, None, None, None]
+    channel = torch.arange(c, device=device)[None, :, None, None]
+    return imgs[batch, channel, rows, cols]
+
+
+def discounted_cumsum(x, discount):
+    """
+    Returns y with y[t] = x[t] + discount[t] * y[t + 1] and y[T] = 0, computed
+    with a parallel (Hillis-Steele) scan in log2(T) vectorized steps.
+
+    Args:
+        x: 1D tensor of length T.
+        discount: 1D tensor of length T (e.g. gamma * lambda * (1 - done)).
+    """
+    y = x.clone()
+    a = discount.clone()
+    shift = 1
+    while shift < len(y):
+        y[:-shift] = y[:-shift] + a[:-shift] * y[shift:]
+        a[:-shift] = a[:-shift] * a[shift:]
+        shift *= 2
+    return y
+
+
+def compute_gae(rew, vpred, vpred_last, done, gamma, lam):
+    """
+    Returns advantages and returns of a rollout with generalized advantage
+    estimation, adv[t] = delta[t] + gamma * lam * (1 - done[t]) * adv[t + 1].
+
+    Args:
+        rew: 1D tensor of rewards of length T.
+        vpred: 1D tensor of value predictions of the T observations.
+        vpred_last: 1D tensor with the value prediction of the last next observation.
+        done: 1D float tensor of episode terminations of length T.
+        gamma: discount factor.
+        lam: GAE lambda.
+    """
+    nonterminal = 1 - done
+    vpred_next = torch.cat([vpred[1:], vpred_last])
+    delta = rew + gamma * vpred_next * nonterminal - vpred
+    adv = discounted_cumsum(delta, gamma * lam * nonterminal)
+    return adv, adv + vpred
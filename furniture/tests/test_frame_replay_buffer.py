@@ -0,0 +1,109 @@
+import numpy as np
+
+from method.algorithms.dataset import FrameReplayBuffer
+
+
+KEYS = ["ob", "ob_next", "ac", "done", "rew"]
+
+
+def _make_episode(rng, length, frame_stack, channels=3, size=8):
+    """
+    Returns stacked images of an episode as FrameStackWrapper creates them,
+    repeating the first frame at reset.
+    """
+    frames = rng.randint(0, 256, size=(length + 1, channels, size, size)).astype(
+        np.uint8
+    )
+    padded = np.concatenate([np.repeat(frames[:1], frame_stack - 1, axis=0), frames])
+    return np.stack(
+        [
+            padded[t : t + frame_stack].reshape(frame_stack * channels, size, size)
+            for t in range(length + 1)
+        ]
+    )
+
+
+def _make_rollouts(rng, episode_lengths, chunk_lengths, frame_stack):
+    """
+    Splits episodes of @episode_lengths into rollouts of @chunk_lengths
+    (cycled). "rew" holds the id of each transition.
+    """
+    rollouts = []
+    next_id = 0
+    chunk = 0
+    for length in episode_lengths:
+        stacks = _make_episode(rng, length, frame_stack)
+        t = 0
+        while t < length:
+            n = min(chunk_lengths[chunk % len(chunk_lengths)], length - t)
+            chunk += 1
+            ids = np.arange(next_id, next_id + n)
+            rollouts.append(
+                {
+                    "ob": {
+                        "camera_ob": stacks[t : t + n],
+                        "robot_ob": rng.randn(n, 4).astype(np.float32),
+                    },
+                    "ob_next": {
+                        "camera_ob": stacks[t + 1 : t + n + 1],
+                        "robot_ob": rng.randn(n, 4).astype(np.float32),
+                    },
+                    "ac": {"default": rng.randn(n, 2).astype(np.float32)},
+                    "done": (np.arange(t, t + n) + 1 == length).astype(np.float32),
+                    "rew": ids.astype(np.float32),
+                }
+            )
+            next_id += n
+            t += n
+    return rollouts
+
+
+def _check_round_trip(buffer_size, frame_stack, episode_lengths, chunk_lengths):
+    """
+    Stores rollouts in a FrameReplayBuffer, samples them and compares the
+    rebuilt frame stacks with the stored ones.
+    """
+    rng = np.random.RandomState(0)
+    rollouts = _make_rollouts(rng, episode_lengths, chunk_lengths, frame_stack)
+    size = rollouts[0]["ob"]["camera_ob"].shape[-1]
+    # crops of the full image size keep images unchanged
+    buffer = FrameReplayBuffer(KEYS, buffer_size, frame_stack, image_crop_size=size)
+
+    expected = {}
+    for rollout in rollouts:
+        buffer.store_episode(rollout)
+        for i, idx in enumerate(rollout["rew"].astype(int)):
+            expected[idx] = {
+                k: {key: v[i] for key, v in rollout[k].items()}
+                for k in ["ob", "ob_next"]
+            }
+
+    num_stored = len(expected)
+    assert 0 < len(buffer) <= min(buffer_size, num_stored)
+
+    batch = buffer.sample(256)
+    ids = batch["rew"].astype(int)
+    # only the newest transitions are kept
+    assert ids.min() >= num_stored - len(buffer)
+    for i, idx in enumerate(ids):
+        for k in ["ob", "ob_next"]:
+            for key, v in expected[idx][k].items():
+                np.testing.assert_array_equal(batch[k][key][i], v)
+
+
+def test_frame_replay_buffer_one_step():
+    """ 1-step rollouts, as stored by off-policy algorithms with every_steps=1. """
+    for frame_stack in [1, 3]:
+        _check_round_trip(100, frame_stack, [5, 3], [1])
+
+
+def test_frame_replay_buffer_multi_step():
+    """ Rollouts of several steps that continue and end episodes. """
+    for frame_stack in [1, 3]:
+        _check_round_trip(100, frame_stack, [12, 1, 7], [4, 1, 6, 2])
+
+
+def test_frame_replay_buffer_wrap_around():
+    """ Rollouts that wrap around the transition and frame rings. """
+    for frame_stack in [1, 3]:
+        _check_round_trip(10, frame_stack, [9, 14, 5], [3, 1, 7])
@@ -0,0 +1,54 @@
+import numpy as np
+import torch
+
+from method.utils.pytorch import compute_gae, discounted_cumsum
+
+
+def _loop_cumsum(x, discount):
+    y = np.zeros(len(x))
+    last = 0
+    for t in reversed(range(len(x))):
+        y[t] = last = x[t] + discount[t] * last
+    return y
+
+
+def _loop_gae(rew, vpred, done, gamma, lam):
+    """ Backward loop of the sequential PPO implementation. """
+    T = len(rew)
+    adv = np.empty((T,), "float32")
+    lastgaelam = 0
+    for t in reversed(range(T)):
+        nonterminal = 1 - done[t]
+        delta = rew[t] + gamma * vpred[t + 1] * nonterminal - vpred[t]
+        adv[t] = lastgaelam = delta + gamma * lam * nonterminal * lastgaelam
+    return adv, adv + vpred[:-1]
+
+
+def test_discounted_cumsum():
+    """ The parallel scan matches a backward loop for any length. """
+    rng = np.random.RandomState(0)
+    for T in [1, 2, 3, 7, 8, 100]:
+        x = rng.randn(T)
+        discount = rng.uniform(0, 1, size=T) * (rng.uniform(size=T) > 0.2)
+        y = discounted_cumsum(torch.as_tensor(x), torch.as_tensor(discount))
+        np.testing.assert_allclose(y.numpy(), _loop_cumsum(x, discount), rtol=1e-10)
+
+
+def test_compute_gae():
+    """ compute_gae matches the backward loop over rollouts with several episodes. """
+    rng = np.random.RandomState(0)
+    T = 200
+    rew = rng.randn(T).astype(np.float32)
+    vpred = rng.randn(T + 1).astype(np.float32)
+    done = (rng.uniform(size=T) < 0.05).astype(np.float32)
+    adv, ret = compute_gae(
+        torch.as_tensor(rew),
+        torch.as_tensor(vpred[:-1]),
+        torch.as_tensor(vpred[-1:]),
+        torch.as_tensor(done),
+        0.99,
+        0.95,
+    )
+    expected_adv, expected_ret = _loop_gae(rew, vpred, done, 0.99, 0.95)
+    np.testing.assert_allclose(adv.numpy(), expected_adv, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(ret.numpy(), expected_ret, rtol=1e-4, atol=1e-5)
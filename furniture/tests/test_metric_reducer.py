@@ -0,0 +1,53 @@
+from method.utils.mpi import MetricReducer
+
+from .thread_comm import run_ranks
+
+
+def _reduce_steps(infos_per_rank):
+    """
+    Adds @infos_per_rank[rank][i] and reduces on every rank for each step i.
+    Returns the reduced metrics and the number of collectives of each step per rank.
+    """
+
+    def run(comm):
+        reducer = MetricReducer(comm)
+        steps = []
+        for info in infos_per_rank[comm.Get_rank()]:
+            num_collectives = comm.num_collectives
+            reducer.add(info)
+            steps.append((reducer.reduce(), comm.num_collectives - num_collectives))
+        return steps, reducer._schema
+
+    return run_ranks(len(infos_per_rank), run)
+
+
+def test_metric_reducer_schema_growth():
+    """
+    Keys added on any rank extend the schema of all ranks, and steps without
+    new keys take a single collective.
+    """
+    results = _reduce_steps(
+        [
+            [{"a": 1.0}, {"a": [1.0, 2.0], "b": 5.0}, {"c": 1.0}, {}],
+            [{"a": 3.0}, {"c": 7.0, "skip": "text"}, {"b": 2.0}, {}],
+        ]
+    )
+    for steps, schema in results:
+        assert schema == ["a", "b", "c"]
+        (mean, maximum, total), num_collectives = steps[0]
+        assert num_collectives == 3
+        assert mean == {"a": 2.0} and maximum == {"a": 3.0} and total == {"a": 4.0}
+
+        (mean, maximum, total), num_collectives = steps[1]
+        assert num_collectives == 3
+        assert mean == {"a": 1.5, "b": 5.0, "c": 7.0}
+        assert maximum == {"a": 2.0, "b": 5.0, "c": 7.0}
+        assert total == {"a": 3.0, "b": 5.0, "c": 7.0}
+
+        (mean, maximum, total), num_collectives = steps[2]
+        assert num_collectives == 1
+        assert mean == {"b": 2.0, "c": 1.0} and total == {"b": 2.0, "c": 1.0}
+
+        (mean, maximum, total), num_collectives = steps[3]
+        assert num_collectives == 1
+        assert mean == {} and maximum == {} and total == {}
@@ -0,0 +1,69 @@
+import numpy as np
+
+from method.utils.normalizer import Normalizer, WelfordSubNormalizer, _merge
+
+
+def _make_data(rng, size):
+    """ Observations with a large offset, where sums of squares lose precision. """
+    return rng.randn(size, 3) * 5 + 1e4
+
+
+def _splits(data, sizes):
+    i = 0
+    for n in sizes:
+        yield data[i : i + n]
+        i += n
+
+
+def test_welford_merge():
+    """ Merging statistics of splits equals the statistics of all data. """
+    rng = np.random.RandomState(0)
+    data = _make_data(rng, 100)
+    stats = (0, np.zeros(3), np.zeros(3))
+    for x in _splits(data, [1, 30, 0, 2, 67]):
+        if len(x):
+            mean = x.mean(axis=0)
+            stats = _merge(stats, (len(x), mean, np.square(x - mean).sum(axis=0)))
+    count, mean, m2 = stats
+    assert count == len(data)
+    np.testing.assert_allclose(mean, data.mean(axis=0))
+    np.testing.assert_allclose(np.sqrt(m2 / count), data.std(axis=0))
+
+
+def test_welford_sub_normalizer():
+    """ WelfordSubNormalizer updated with splits matches np.mean and np.std. """
+    rng = np.random.RandomState(0)
+    data = _make_data(rng, 500)
+    norm = WelfordSubNormalizer(3, eps=1e-8)
+    for x in _splits(data, [1, 1, 98, 250, 150]):
+        norm.update(x)
+        norm.recompute_stats()
+    np.testing.assert_allclose(norm.mean, data.mean(axis=0), rtol=1e-6)
+    np.testing.assert_allclose(norm.std, data.std(axis=0), rtol=1e-5)
+
+
+def test_welford_normalizer_sync():
+    """
+    Normalizer in welford mode merges unsynced statistics into the total
+    every sync_interval updates and stays equal to the statistics of all data.
+    """
+    rng = np.random.RandomState(0)
+    data = {"a": _make_data(rng, 400), "b": _make_data(rng, 400)[:, :2]}
+    shapes = {"a": [3], "b": [2]}
+    norm = Normalizer(shapes, eps=1e-8, mode="welford", sync_interval=3)
+    for i in range(8):
+        norm.update({k: v[i * 50 : (i + 1) * 50] for k, v in data.items()})
+        norm.recompute_stats()
+        synced = (i + 1) // 3 * 3 * 50
+        for k, v in data.items():
+            sub_norm = norm.sub_norm[k]
+            assert sub_norm.total[0] == synced
+            assert sub_norm.total[0] + sub_norm.local[0] == (i + 1) * 50
+            np.testing.assert_allclose(sub_norm.mean, v[: (i + 1) * 50].mean(axis=0), rtol=1e-6)
+            np.testing.assert_allclose(sub_norm.std, v[: (i + 1) * 50].std(axis=0), rtol=1e-5)
+
+    # checkpoints load in the sum mode too
+    sum_norm = Normalizer(shapes, eps=1e-8)
+    sum_norm.load_state_dict(norm.state_dict())
+    for k, v in data.items():
+        np.testing.assert_allclose(sum_norm.sub_norm[k].mean, v.mean(axis=0), rtol=1e-6)
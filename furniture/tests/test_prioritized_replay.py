@@ -0,0 +1,78 @@
+import numpy as np
+
+from method.algorithms.prioritized_replay import PrioritizedReplayBuffer, SumTree
+
+
+KEYS = ["ob", "ob_next", "ac", "done", "rew"]
+
+
+def _make_rollout(length):
+    """ Returns a rollout whose "rew" holds the index of each transition. """
+    return {
+        "ob": {"robot_ob": np.random.randn(length, 4).astype(np.float32)},
+        "ob_next": {"robot_ob": np.random.randn(length, 4).astype(np.float32)},
+        "ac": {"default": np.random.randn(length, 2).astype(np.float32)},
+        "done": np.zeros(length, dtype=np.float32),
+        "rew": np.arange(length, dtype=np.float32),
+    }
+
+
+def test_sum_tree():
+    """ Totals and prefix-sum search of SumTree match a cumulative sum. """
+    rng = np.random.RandomState(0)
+    capacity = 37
+    tree = SumTree(capacity)
+    priorities = rng.uniform(0.1, 2.0, size=capacity)
+    tree.update(np.arange(capacity), priorities)
+    np.testing.assert_allclose(tree.total, priorities.sum())
+    np.testing.assert_allclose(tree.get(np.arange(capacity)), priorities)
+
+    # partial updates keep the ancestors consistent
+    idxs = np.array([0, 5, 36, 5])
+    tree.update(idxs, [3.0, 0.5, 1.5, 0.25])
+    priorities[idxs] = [3.0, 0.5, 1.5, 0.25]
+    np.testing.assert_allclose(tree.total, priorities.sum())
+
+    values = rng.uniform(0, priorities.sum(), size=1000)
+    leaves = np.searchsorted(np.cumsum(priorities), values)
+    np.testing.assert_array_equal(tree.find(values), leaves)
+
+
+def test_prioritized_replay_buffer():
+    """
+    After update_priorities, the tree holds (|TD error| + eps) ** alpha,
+    stratified sampling follows the priorities and importance-sampling
+    weights are normalized to a maximum of 1.
+    """
+    np.random.seed(0)
+    alpha, beta, eps = 0.6, 0.4, 1e-6
+    size = 50
+    buffer = PrioritizedReplayBuffer(KEYS, size, alpha=alpha, beta=beta, eps=eps)
+    buffer.store_episode(_make_rollout(size))
+    assert len(buffer) == size
+
+    # new transitions have the largest priority so far
+    np.testing.assert_allclose(buffer._tree.total, size * 1.0 ** alpha)
+
+    td_errors = np.random.exponential(size=size)
+    td_errors[3] = 20.0
+    buffer.update_priorities(np.arange(size), -td_errors)
+    priorities = (td_errors + eps) ** alpha
+    np.testing.assert_allclose(buffer._tree.get(np.arange(size)), priorities)
+    np.testing.assert_allclose(buffer._tree.total, priorities.sum())
+
+    probs = priorities / priorities.sum()
+    counts = np.zeros(size)
+    for _ in range(200):
+        batch = buffer.sample(100)
+        idxs = batch["idxs"]
+        # "rew" holds the index of the sampled transition
+        np.testing.assert_array_equal(batch["rew"].astype(int), idxs)
+
+        weights = (size * probs[idxs]) ** -beta
+        np.testing.assert_allclose(batch["weights"], weights / weights.max(), rtol=1e-5)
+        assert batch["weights"].max() == 1.0
+        assert (batch["weights"] > 0).all()
+        counts += np.bincount(idxs, minlength=size)
+
+    np.testing.assert_allclose(counts / counts.sum(), probs, atol=0.01)
@@ -0,0 +1,98 @@
+import numpy as np
+
+from method.algorithms import dataset
+from method.algorithms.dataset import EpisodeArrays, HERSampler, SeqSampler
+
+
+KEYS = ["ob", "ob_next", "ag", "g", "ac", "done"]
+
+
+def _goal_reward(ag, g, info):
+    return -(np.linalg.norm(ag - g, axis=-1) > 0.05).astype(np.float32)
+
+
+def _make_episodes(rng, lengths):
+    """
+    Returns EpisodeArrays and the same episodes as arrays per key, where "ob"
+    and "ag" have the final observation of an episode. Episode 0 is replaced
+    once, so its rows are not contiguous with the others.
+    """
+    dims = {"ob": 5, "ob_next": 5, "ag": 3, "g": 3, "ac": 2}
+    episodes = EpisodeArrays(KEYS, len(lengths))
+    arrays = []
+    for i, length in enumerate([lengths[0]] + list(lengths)):
+        episode = {}
+        for k in KEYS:
+            num_rows = length + 1 if k in ["ob", "ag"] else length
+            shape = (num_rows,) + ((dims[k],) if k in dims else ())
+            episode[k] = rng.randn(*shape).astype(np.float32)
+        stored = dict(episode)
+        stored["ob"] = {"ob": episode["ob"]}
+        stored["ob_next"] = {"ob": episode["ob_next"]}
+        episodes.set(max(0, i - 1), stored)
+        if i > 0:
+            arrays.append(episode)
+    return episodes, arrays
+
+
+def _fix_samples(monkeypatch, rng, arrays, batch_size):
+    """ Makes the samplers draw known episodes and time steps. """
+    episode_idxs = rng.randint(0, len(arrays), batch_size)
+    t_samples = np.array([rng.randint(len(arrays[i]["ac"])) for i in episode_idxs])
+    monkeypatch.setattr(
+        dataset, "_sample_steps", lambda episode_batch, n: (episode_idxs, t_samples)
+    )
+    return episode_idxs, t_samples
+
+
+def test_seq_sampler(monkeypatch):
+    """ SeqSampler matches a per-sample loop, padding with the last observation. """
+    rng = np.random.RandomState(0)
+    seq_length = 6
+    episodes, arrays = _make_episodes(rng, [3, 10, 1, 7])
+    episode_idxs, t_samples = _fix_samples(monkeypatch, rng, arrays, 200)
+
+    batch = SeqSampler(seq_length).sample_func(episodes, 200)
+    for j, (i, t) in enumerate(zip(episode_idxs, t_samples)):
+        for k in KEYS:
+            v = batch[k]["ob"] if k in ["ob", "ob_next"] else batch[k]
+            np.testing.assert_array_equal(v[j], arrays[i][k][t])
+
+        ob = arrays[i]["ob"]
+        seq = [ob[min(t + s, len(ob) - 1)] for s in range(seq_length)]
+        mask = [float(t + s < len(ob)) for s in range(seq_length)]
+        np.testing.assert_array_equal(
+            batch["following_sequences"]["ob"][j], np.concatenate(seq)
+        )
+        np.testing.assert_array_equal(batch["following_sequences_mask"][j], mask)
+
+
+def test_her_sampler(monkeypatch):
+    """
+    Without relabeling, HERSampler matches a per-sample loop. With relabeling,
+    goals are replaced by goals achieved later in the same episode.
+    """
+    rng = np.random.RandomState(0)
+    episodes, arrays = _make_episodes(rng, [3, 10, 1, 7])
+    episode_idxs, t_samples = _fix_samples(monkeypatch, rng, arrays, 200)
+
+    batch = HERSampler("future", 0.0, _goal_reward).sample_her_transitions(
+        episodes, 200
+    )
+    for j, (i, t) in enumerate(zip(episode_idxs, t_samples)):
+        episode = arrays[i]
+        for k in ["ac", "done", "ag", "g"]:
+            np.testing.assert_array_equal(batch[k][j], episode[k][t])
+        np.testing.assert_array_equal(batch["ob"]["ob"][j], episode["ob"][t])
+        np.testing.assert_array_equal(batch["ob_next"]["ob"][j], episode["ob"][t + 1])
+        assert batch["r"][j] == _goal_reward(episode["ag"][t + 1], episode["g"][t], None)
+
+    # random goals are never achieved, so every goal is relabeled
+    batch = HERSampler("future", 1.0, _goal_reward).sample_her_transitions(
+        episodes, 200
+    )
+    for j, (i, t) in enumerate(zip(episode_idxs, t_samples)):
+        episode = arrays[i]
+        future_ag = episode["ag"][t + 1 :]
+        assert (future_ag == batch["g"][j]).all(axis=1).any()
+        assert batch["r"][j] == _goal_reward(episode["ag"][t + 1], batch["g"][j], None)
@@ -0,0 +1,58 @@
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+from method.algorithms import shared_replay
+from method.algorithms.shared_replay import SharedReplayBuffer
+
+from .thread_comm import run_ranks
+
+
+KEYS = ["ob", "ac", "done", "rew"]
+
+
+def _make_rollout(ids):
+    """ Returns a rollout whose "rew" and "ob" hold the id of each transition. """
+    ids = np.asarray(ids, dtype=np.float32)
+    return {
+        "ob": {"robot_ob": np.repeat(ids[:, None], 4, axis=1)},
+        "ac": {"default": np.zeros((len(ids), 2), dtype=np.float32)},
+        "done": np.zeros(len(ids), dtype=np.float32),
+        "rew": ids,
+    }
+
+
+def test_shared_replay_buffer_shards(monkeypatch, tmp_path):
+    """
+    Ranks write their own shard of the shared arrays, wrapping around within
+    it, and every rank samples the live transitions of all shards.
+    """
+    local = threading.local()
+    world = SimpleNamespace(Split_type=lambda split_type: local.comm)
+    monkeypatch.setattr(
+        shared_replay, "MPI", SimpleNamespace(COMM_WORLD=world, COMM_TYPE_SHARED=0)
+    )
+
+    # shards of 10 transitions, rank 1 wraps around and rank 2 is full
+    rollouts = [[range(0, 4)], [range(100, 106), range(106, 115)], [range(200, 210)]]
+    live = set(range(0, 4)) | set(range(105, 115)) | set(range(200, 210))
+
+    def run(comm):
+        local.comm = comm
+        buffer = SharedReplayBuffer(KEYS, 31, str(tmp_path))
+        for ids in rollouts[comm.Get_rank()]:
+            buffer.store_episode(_make_rollout(ids))
+        comm.Barrier()
+
+        batch = buffer.sample(3000)
+        state = buffer.state_dict()
+        comm.Barrier()
+        return len(buffer), batch, state
+
+    for size, batch, state in run_ranks(3, run):
+        assert size == len(live)
+        ids = batch["rew"].astype(int)
+        assert set(ids) == live
+        np.testing.assert_array_equal(batch["ob"]["robot_ob"][:, 0], batch["rew"])
+        assert sorted(state["buffer"]["rew"].astype(int)) == sorted(live)
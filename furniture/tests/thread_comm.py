@@ -0,0 +1,65 @@
+"""
+MPI communicator of ranks running as threads of one process, with the
+collectives used by the training utilities.
+"""
+
+import threading
+
+import numpy as np
+
+
+class ThreadComm(object):
+    """ Communicator of rank @rank, sharing @slots and @barrier with the other ranks. """
+
+    def __init__(self, rank, slots, barrier):
+        self._rank = rank
+        self._slots = slots
+        self._barrier = barrier
+        self.num_collectives = 0
+
+    def Get_rank(self):
+        return self._rank
+
+    def Get_size(self):
+        return len(self._slots)
+
+    def Barrier(self):
+        self.allgather(None)
+
+    def allgather(self, x):
+        self.num_collectives += 1
+        self._slots[self._rank] = x
+        self._barrier.wait()
+        gathered = list(self._slots)
+        self._barrier.wait()
+        return gathered
+
+    def Allgather(self, sendbuf, recvbuf):
+        recvbuf[:] = self.allgather(np.array(sendbuf))
+
+    def bcast(self, x, root=0):
+        return self.allgather(x)[root]
+
+
+def run_ranks(num_ranks, fn):
+    """ Runs @fn(comm) on @num_ranks threads and returns the results per rank. """
+    slots = [None] * num_ranks
+    barrier = threading.Barrier(num_ranks, timeout=10)
+    results = [None] * num_ranks
+    errors = []
+
+    def run(rank):
+        try:
+            results[rank] = fn(ThreadComm(rank, slots, barrier))
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_ranks)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
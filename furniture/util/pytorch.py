@@ -386,7 +386,11 @@ def random_crop(imgs, out=84):
     crop_max = h - out + 1
     w1 = np.random.randint(0, crop_max, b)
     h1 = np.random.randint(0, crop_max, b)
-    cropped = np.empty((b, c, out, out), dtype=imgs.dtype)
-    for i, (img, w11, h11) in enumerate(zip(imgs, w1, h1)):
-        cropped[i] = img[:, h11 : h11 + out, w11 : w11 + out]
-    return cropped
+    # gather all crops at once from a strided view of the crop windows
+    windows = np.lib.stride_tricks.as_strided(
+        imgs,
+        shape=(b, crop_max, w - out + 1, c, out, out),
+        strides=imgs.strides[:1] + imgs.strides[2:] + imgs.strides[1:],
+        writeable=False,
+    )
+    return windows[np.arange(b), h1, w1]
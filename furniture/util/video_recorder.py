@@ -1,8 +1,10 @@
 import distutils.spawn
-import distutils.version
 import glob
 import os
+import queue
 import subprocess
+import threading
+import time
 
 import moviepy.editor as mpy
 import numpy as np
@@ -12,8 +14,9 @@ from .logger import logger
 
 class VideoRecorder(object):
     """
-    Records videos; Either stores all frames in RAM or writes to file at every frame.
-    Choose depending on performance or RAM size.
+    Records videos; Either stores all frames in RAM or streams them to ffmpeg.
+    In file mode, frames are encoded by a background thread (see VideoStream),
+    so recording does not block the environment loop.
     """
 
     def __init__(
@@ -32,7 +35,8 @@ class VideoRecorder(object):
         self.set_outfile(prefix)
         self._frames_per_sec = frames_per_sec
         self._output_frames_per_sec = output_frames_per_sec
-        self._encoder = None
+        self._stream = None
+        self._stream_open = False
         self._frames = []
 
     def set_outfile(self, prefix):
@@ -69,17 +73,14 @@ class VideoRecorder(object):
             self._encode_image_frame(frame)
 
     def _encode_image_frame(self, frame):
-        if not self._encoder:
-            self._encoder = ImageEncoder(
-                self._outfile,
-                frame.shape,
-                self._frames_per_sec,
-                self._output_frames_per_sec,
+        if self._stream is None:
+            self._stream = VideoStream()
+        if not self._stream_open:
+            self._stream.open(
+                self._outfile, self._frames_per_sec, self._output_frames_per_sec
             )
-        try:
-            self._encoder.capture_frame(frame)
-        except Exception:
-            logger.error("Error in storing image file for video recording.")
+            self._stream_open = True
+        self._stream.write(frame)
 
     def close(self, name=None, success=True):
         """
@@ -104,17 +105,129 @@ class VideoRecorder(object):
                 self._frames = []
 
         elif self._record_mode == "file":
-            if self._encoder is not None:
-                self._encoder.close()
-                self._encoder = None
-            else:
-                # No frames captured. Set metadata, and remove the empty output file.
-                os.remove(self._outfile)
+            if self._stream_open:
+                self._stream.close_video(self._outfile)
+                self._stream_open = False
+                logger.info("video stream stats: %s", self._stream.stats())
 
         if success:
             logger.info("closed video recorder, video at %s", self._outfile)
 
 
+class VideoStream(object):
+    """
+    Streaming video sink. Frames are put in a bounded queue and a long-lived
+    writer thread feeds them to an ffmpeg process (one per video file). The
+    producer only blocks when the queue is full; the time spent blocked is
+    reported by @stats as backpressure.
+    """
+
+    def __init__(self, max_queue_size=64):
+        """
+        Args:
+            max_queue_size: maximum number of frames waiting to be encoded.
+        """
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._outfile = None
+        self._num_frames = 0
+        self._num_blocked = 0
+        self._blocked_time = 0.0
+        self._max_qsize = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def open(self, outfile, frames_per_sec=15, output_frames_per_sec=15):
+        """ Starts a new video. The frame shape is taken from the first frame. """
+        self._outfile = outfile
+        self._put(("open", (outfile, frames_per_sec, output_frames_per_sec)))
+
+    def write(self, frame):
+        """
+        Queues a uint8 frame of shape (H, W, 3) or (H, W, 4). The frame is not
+        copied, so it must not be modified after this call.
+        """
+        self._put(("frame", frame))
+        self._num_frames += 1
+
+    def close_video(self, outfile=None):
+        """
+        Blocks until all queued frames are encoded and the video file is closed.
+        If @outfile is given, the video is renamed to @outfile.
+        """
+        self._put(("close", None))
+        self._queue.join()
+        path = self._outfile
+        if outfile is not None and path is not None and os.path.exists(path):
+            if path != outfile:
+                os.rename(path, outfile)
+            path = outfile
+        self._outfile = None
+        return path
+
+    def close(self):
+        """ Stops the writer thread. """
+        if self._thread.is_alive():
+            self._put(("stop", None))
+            self._thread.join()
+
+    def stats(self):
+        """ Returns backpressure statistics of the queue. """
+        return {
+            "num_frames": self._num_frames,
+            "num_blocked": self._num_blocked,
+            "blocked_time": self._blocked_time,
+            "max_queue_size": self._max_qsize,
+        }
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            start = time.time()
+            self._queue.put(item)
+            self._num_blocked += 1
+            self._blocked_time += time.time() - start
+        self._max_qsize = max(self._max_qsize, self._queue.qsize())
+
+    def _run(self):
+        encoder = None
+        video_args = None
+        while True:
+            cmd, data = self._queue.get()
+            try:
+                if cmd == "open":
+                    video_args = data
+                elif cmd == "frame":
+                    if encoder is None and video_args is not None:
+                        outfile, fps, output_fps = video_args
+                        encoder = ImageEncoder(outfile, data.shape, fps, output_fps)
+                    if encoder is not None:
+                        encoder.capture_frame(data)
+                elif cmd in ["close", "stop"]:
+                    if encoder is not None:
+                        encoder.close()
+                    encoder = None
+                    video_args = None
+            except Exception as e:
+                logger.error("Error in storing image file for video recording: %s", e)
+                if encoder is not None:
+                    # stop ffmpeg and release its pipe
+                    try:
+                        encoder.close()
+                    except Exception as e:
+                        logger.error("Error in closing the video encoder: %s", e)
+                encoder = None
+                video_args = None
+            finally:
+                self._queue.task_done()
+            if cmd == "stop":
+                break
+
+    def __del__(self):
+        self.close()
+
+
 class ImageEncoder(object):
     def __init__(self, outfile, frame_shape, frames_per_sec, output_frames_per_sec):
         self._proc = None
@@ -133,13 +246,17 @@ class ImageEncoder(object):
         self._frames_per_sec = frames_per_sec
         self._output_frames_per_sec = output_frames_per_sec
 
+        self._backend = self.find_backend()
+        self.start()
+
+    @staticmethod
+    def find_backend():
+        """ Returns the encoder executable or raises ImportError if there is none. """
         if distutils.spawn.find_executable("ffmpeg") is not None:
-            self._backend = "ffmpeg"
-        else:
-            raise ImportError(
-                "Could not find ffmpeg executable. On OS X, you can install ffmpeg via `brew install ffmpeg`. On most Ubuntu variants, `sudo apt-get install ffmpeg` should do it."
-            )
-        self._start()
+            return "ffmpeg"
+        raise ImportError(
+            "Could not find ffmpeg executable. On OS X, you can install ffmpeg via `brew install ffmpeg`. On most Ubuntu variants, `sudo apt-get install ffmpeg` should do it."
+        )
 
     def start(self):
         self._cmdline = (
@@ -198,15 +315,15 @@ class ImageEncoder(object):
                     frame.dtype
                 )
             )
-        if distutils.version.LooseVersion(
-            np.__version__
-        ) >= distutils.version.LooseVersion("1.9.0"):
-            self._proc.stdin.write(frame.tobytes())
-        else:
-            self._proc.stdin.write(frame.tostring())
+        # write the frame buffer directly instead of a bytes copy
+        self._proc.stdin.write(memoryview(np.ascontiguousarray(frame)).cast("B"))
 
     def close(self):
-        self._proc.stdin.close()
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg already exited
+            pass
         ret = self._proc.wait()
         if ret != 0:
             logger.error("VideoRecorder encoder exited with status {}".format(ret))